@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+
+"""Load-test the crawler of 'fetch_oeis_database.py' against a local stand-in for the OEIS server ('mock_oeis_server.py').
+
+For every combination of fetch backend, concurrency, and group commit size, the entries are fetched into a fresh
+database with 'fetch_entries_into_database', and the following are reported:
+
+    fetches/s       entries written per second of wall time.
+    p50, p99        median and 99th percentile latency of the successful requests, in milliseconds.
+    writes          number of group commits, and their mean duration ('process_responses').
+    write share     fraction of the wall time spent writing to the database.
+    server          responses of the server by HTTP status, including injected errors (503) and rate limiting (429).
+
+The concurrency is fixed for a run, so the AdaptiveController only paces the requests.
+With '--refresh', the database is populated first, and the refresh of all entries is measured instead;
+with '--mutation-rate', some of the refreshed entries have changed.
+
+The server is synthesized, or serves the entries of an existing database ('--database').
+"""
+
+import os
+import time
+import logging
+import argparse
+import tempfile
+import sqlite3
+import contextlib
+
+import fetch_oeis_database
+
+from fetch_oeis_database import FETCH_BACKENDS, make_fetcher, configure_database_connection, ensure_database_schema_created
+from crawl_controller    import AdaptiveController
+from mock_oeis_server    import start_mock_server, DatabaseContent
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+class RecordingController(AdaptiveController):
+    """An AdaptiveController with a fixed concurrency, that keeps the latencies of all successful requests."""
+
+    def __init__(self, concurrency):
+        super().__init__(initial_concurrency = concurrency, min_concurrency = concurrency, max_concurrency = concurrency, initial_rate = 10000.0, max_rate = 10000.0)
+        self.latencies = []
+
+    def record(self, host, latency, exception = None):
+        if exception is None:
+            self.latencies.append(latency)
+        super().record(host, latency, exception)
+
+@contextlib.contextmanager
+def timing_process_responses(durations):
+    """Append the duration of each call to 'fetch_oeis_database.process_responses' to 'durations', while in scope."""
+
+    process_responses = fetch_oeis_database.process_responses
+
+    def timed_process_responses(dbconn, responses):
+        t_start = time.monotonic()
+        try:
+            return process_responses(dbconn, responses)
+        finally:
+            durations.append(time.monotonic() - t_start)
+
+    fetch_oeis_database.process_responses = timed_process_responses
+    try:
+        yield
+    finally:
+        fetch_oeis_database.process_responses = process_responses
+
+def percentile(values, fraction):
+    """Return the given percentile (as a fraction) of a list of values, or NaN if the list is empty."""
+
+    if len(values) == 0:
+        return float("nan")
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def benchmark_crawler_run(server, database_filename, fetch_backend, concurrency, commit_size, entries):
+    """Fetch the entries into the database, and return a dictionary of measurements."""
+
+    controller = RecordingController(concurrency)
+
+    write_durations = []
+
+    server.status_counts.clear()
+
+    fetch_oeis_database.GROUP_COMMIT_SIZE = commit_size
+
+    with close_when_done(sqlite3.connect(database_filename)) as dbconn:
+
+        configure_database_connection(dbconn)
+        ensure_database_schema_created(dbconn)
+
+        with make_fetcher(fetch_backend, server.base_url(), controller) as fetcher, timing_process_responses(write_durations), start_timer() as timer:
+            fetch_oeis_database.fetch_entries_into_database(dbconn, entries, fetcher)
+            duration = timer.duration()
+
+    return {
+        "fetches_per_second" : len(entries) / duration,
+        "p50"                : percentile(controller.latencies, 0.50),
+        "p99"                : percentile(controller.latencies, 0.99),
+        "commits"            : len(write_durations),
+        "mean_write"         : sum(write_durations) / max(1, len(write_durations)),
+        "write_share"        : sum(write_durations) / duration,
+        "status_counts"      : dict(server.status_counts)
+    }
+
+def benchmark_crawler(server, fetch_backends, concurrencies, commit_sizes, entries, refresh_flag):
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as dirname:
+
+        for fetch_backend in fetch_backends:
+            for concurrency in concurrencies:
+                for commit_size in commit_sizes:
+
+                    database_filename = os.path.join(dirname, "benchmark_{}_{}_{}.sqlite3".format(fetch_backend, concurrency, commit_size))
+
+                    if refresh_flag:
+                        logger.info("Populating database for backend '{}', concurrency {}, commit size {} ...".format(fetch_backend, concurrency, commit_size))
+                        benchmark_crawler_run(server, database_filename, fetch_backend, concurrency, commit_size, entries)
+
+                    logger.info("Benchmarking backend '{}', concurrency {}, commit size {} ...".format(fetch_backend, concurrency, commit_size))
+
+                    result = benchmark_crawler_run(server, database_filename, fetch_backend, concurrency, commit_size, entries)
+
+                    results.append((fetch_backend, concurrency, commit_size, result))
+
+    logger.info("Results ({} {} entries):".format("refreshing" if refresh_flag else "fetching", len(entries)))
+    logger.info("backend  concurrency  commit size  fetches/s   p50 [ms]   p99 [ms]  commits  mean write [ms]  write share  server responses")
+
+    for (fetch_backend, concurrency, commit_size, result) in results:
+        logger.info("{:8} {:11} {:12} {:10.1f} {:10.1f} {:10.1f} {:8} {:16.1f} {:11.1%}  {}".format(
+            fetch_backend, concurrency, commit_size, result["fetches_per_second"], 1000.0 * result["p50"], 1000.0 * result["p99"],
+            result["commits"], 1000.0 * result["mean_write"], result["write_share"],
+            ", ".join("{}: {}".format(status, count) for (status, count) in sorted(result["status_counts"].items()))))
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",")]
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Load-test the crawler against a local mock OEIS server.")
+    parser.add_argument("--entries"       , type = int  , default = 2000 , help = "number of entries to fetch (default: 2000)")
+    parser.add_argument("--backends"      , default = ",".join(sorted(FETCH_BACKENDS)), help = "comma-separated fetch backends (default: all)")
+    parser.add_argument("--concurrency"   , type = parse_int_list, default = [16, 64], help = "comma-separated numbers of requests in flight (default: 16,64)")
+    parser.add_argument("--commit-size"   , type = parse_int_list, default = [100, 500], help = "comma-separated group commit sizes (default: 100,500)")
+    parser.add_argument("--refresh"       , action = "store_true", help = "measure the refresh of a populated database, rather than populating it")
+    parser.add_argument("--latency"       , type = float, default = 0.050, help = "server response latency in seconds (default: 0.050)")
+    parser.add_argument("--latency-jitter", type = float, default = 0.050, help = "maximum random extra server latency in seconds (default: 0.050)")
+    parser.add_argument("--error-rate"    , type = float, default = 0.0  , help = "fraction of requests that fail with HTTP status 503 (default: 0)")
+    parser.add_argument("--mutation-rate" , type = float, default = 0.0  , help = "probability that an entry changes when it is fetched (default: 0)")
+    parser.add_argument("--rate-limit"    , type = float, default = None , help = "requests per second accepted by the server (default: unlimited)")
+    parser.add_argument("--seed"          , type = int  , default = None , help = "seed of the random number generator used for injection")
+    parser.add_argument("--database"      , default = None, help = "serve the entries of this local sqlite3 database instead of synthesized entries")
+    args = parser.parse_args()
+
+    fetch_backends = args.backends.split(",")
+    for fetch_backend in fetch_backends:
+        if fetch_backend not in FETCH_BACKENDS:
+            parser.error("unknown fetch backend '{}'".format(fetch_backend))
+
+    with setup_logging(None):
+
+        content = None if args.database is None else DatabaseContent(args.database)
+
+        server = start_mock_server(highest_oeis_id = args.entries, latency = args.latency, content = content, latency_jitter = args.latency_jitter,
+                                   error_rate = args.error_rate, mutation_rate = args.mutation_rate, rate_limit = args.rate_limit, seed = args.seed)
+        try:
+            entries = list(range(1, min(args.entries, server.highest_oeis_id) + 1))
+            benchmark_crawler(server, fetch_backends, args.concurrency, args.commit_size, entries, args.refresh)
+        finally:
+            server.shutdown()
+            server.server_close()
+            if content is not None:
+                content.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+
+"""Benchmark the fetch backends of 'fetch_oeis_database.py' against a local stand-in for the OEIS server."""
+
+import logging
+import argparse
+
+from fetch_oeis_database import FETCH_BACKENDS, make_fetcher
+from mock_oeis_server    import start_mock_server
+from timer               import start_timer
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+def benchmark_fetch_backend(fetch_backend, base_url, entries):
+
+    with make_fetcher(fetch_backend, base_url) as fetcher, start_timer() as timer:
+
+        # Each fetch is a main content request followed by an unconditional b-file request, as for a new entry.
+
+        failures = 0
+        for i in range(0, len(entries), fetcher.batch_size):
+            batch = entries[i:i + fetcher.batch_size]
+            responses = fetcher.fetch_batch(batch)
+            bfile_results = fetcher.fetch_bfiles([(oeis_id, None, None) for oeis_id in batch])
+            failures += sum(response is None or bfile_result is None for (response, bfile_result) in zip(responses, bfile_results))
+
+        logger.info("Backend '{}' using {}: {} fetches took {} ({:.3f} fetches/second, {} failures).".format(
+            fetch_backend, fetcher, len(entries), timer.duration_string(), len(entries) / timer.duration(), failures))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmark the crawler fetch backends against a local mock OEIS server.")
+    parser.add_argument("--entries", type = int  , default = 2000 , help = "number of entries to fetch (default: 2000)")
+    parser.add_argument("--latency", type = float, default = 0.050, help = "server response latency in seconds (default: 0.050)")
+    parser.add_argument("backends" , nargs = "*" , metavar = "backend", help = "backends to benchmark: {} (default: all)".format(", ".join(sorted(FETCH_BACKENDS))))
+    args = parser.parse_args()
+
+    backends = args.backends or sorted(FETCH_BACKENDS)
+    for fetch_backend in backends:
+        if fetch_backend not in FETCH_BACKENDS:
+            parser.error("unknown fetch backend '{}'".format(fetch_backend))
+
+    with setup_logging(None):
+
+        server = start_mock_server(highest_oeis_id = args.entries, latency = args.latency)
+        try:
+            entries = list(range(1, args.entries + 1))
+            for fetch_backend in backends:
+                benchmark_fetch_backend(fetch_backend, server.base_url(), entries)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    main()
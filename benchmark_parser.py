@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+"""Benchmark the parse throughput of 'oeis_entry.py', in strict and in trusted mode."""
+
+import logging
+import argparse
+
+from oeis_entry          import parse_main_content, parse_oeis_entry
+from mock_oeis_server    import synthesize_main_content, synthesize_bfile_content
+from content_compression import load_content_dictionaries, decode_content
+from xz_snapshot_reader  import open_database
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+def read_database_entries(database_filename, count):
+    """Read the first 'count' entries of a local sqlite3 database or compressed snapshot, as (oeis_id, main_content, bfile_content) tuples."""
+
+    with close_when_done(open_database(database_filename)) as dbconn, close_when_done(dbconn.cursor()) as dbcursor:
+
+        load_content_dictionaries(dbconn)
+
+        dbcursor.execute("SELECT oeis_id, main_content, bfile_content FROM oeis_entries ORDER BY oeis_id LIMIT ?;", (count, ))
+
+        return [(oeis_id, decode_content(main_content), decode_content(bfile_content)) for (oeis_id, main_content, bfile_content) in dbcursor.fetchall()]
+
+def synthesize_entries(count):
+    """Synthesize 'count' entries, as served by 'mock_oeis_server.py'."""
+    return [(oeis_id, synthesize_main_content(oeis_id), synthesize_bfile_content(oeis_id)) for oeis_id in range(1, count + 1)]
+
+def benchmark_parser(description, parse_function, entries, repeat):
+    """Run the parse function over all entries, 'repeat' times, and report the best throughput."""
+
+    best_duration = None
+
+    for i in range(repeat):
+        with start_timer() as timer:
+            for entry in entries:
+                parse_function(entry)
+            if best_duration is None or timer.duration() < best_duration:
+                best_duration = timer.duration()
+
+    logger.info("{:<28}: {} entries in {:.3f} seconds ({:.1f} entries/second).".format(description, len(entries), best_duration, len(entries) / best_duration))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmark the OEIS entry parser in strict and in trusted mode.")
+    parser.add_argument("--entries" , type = int, default = 2000, help = "number of entries to parse (default: 2000)")
+    parser.add_argument("--repeat"  , type = int, default = 3   , help = "number of runs; the fastest one is reported (default: 3)")
+    parser.add_argument("--warnings", action = "store_true"     , help = "log the parser's warnings (by default, they are suppressed)")
+    parser.add_argument("database_filename", nargs = "?", help = "sqlite3 database, or compressed database snapshot, to take the entries from (default: synthesized entries)")
+    args = parser.parse_args()
+
+    with setup_logging(None):
+
+        if not args.warnings:
+            logging.getLogger("oeis_entry").setLevel(logging.CRITICAL)
+
+        if args.database_filename is None:
+            entries = synthesize_entries(args.entries)
+        else:
+            entries = read_database_entries(args.database_filename, args.entries)
+
+        # Entries that fail to parse are excluded, so both modes do the same work.
+
+        parseable_entries = []
+        for entry in entries:
+            try:
+                parse_oeis_entry(*entry)
+            except (AssertionError, ValueError):
+                continue
+            parseable_entries.append(entry)
+
+        if len(parseable_entries) < len(entries):
+            logger.info("Skipping {} of {} entries that cannot be parsed.".format(len(entries) - len(parseable_entries), len(entries)))
+
+        if len(parseable_entries) == 0:
+            logger.critical("No entries to parse! Unable to continue.")
+            return
+
+        benchmark_parser("main content, strict" , lambda entry: parse_main_content(entry[0], entry[1])                , parseable_entries, args.repeat)
+        benchmark_parser("main content, trusted", lambda entry: parse_main_content(entry[0], entry[1], trusted = True), parseable_entries, args.repeat)
+        benchmark_parser("full entry, strict"   , lambda entry: parse_oeis_entry(*entry)                              , parseable_entries, args.repeat)
+        benchmark_parser("full entry, trusted"  , lambda entry: parse_oeis_entry(*entry, trusted = True)              , parseable_entries, args.repeat)
+
+if __name__ == "__main__":
+    main()
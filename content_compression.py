@@ -0,0 +1,296 @@
+"""Compressed storage of main content and b-file content in the crawler database.
+
+By default, the 'main_content' and 'bfile_content' columns of the 'oeis_entries' table hold plain TEXT values.
+In the compressed storage mode, they hold BLOB values in the following format:
+
+    MAGIC (3 bytes) | method (1 byte) | dictionary ID (varint) | payload
+
+The methods are:
+
+    METHOD_ZLIB        the payload is zlib-compressed text, using a preset dictionary.
+    METHOD_BFILE_DELTA the payload is a zlib-compressed list of varints: the first index, the number of terms,
+                       and the zigzag-encoded differences between consecutive terms. The dictionary ID is unused (0).
+
+The main content of OEIS entries is highly repetitive: every entry starts and ends with the same header and footer,
+and uses the same directives, phrases, and URLs. Compressing entries one by one would not benefit from this,
+so we use a preset dictionary that is trained on a sample of entries ('train_dictionary').
+
+The dictionaries are stored in the 'content_dictionaries' table of the database itself, so that any reader can decode
+the content. A dictionary is never changed once it is stored; retraining adds a new one.
+
+Most b-files list consecutive indices with slowly growing values. For those, the differences encode much smaller
+than the decimal text. A b-file that cannot be reproduced exactly from its terms (e.g., because it has comments)
+is compressed with METHOD_ZLIB instead.
+
+Readers call 'load_content_dictionaries' once, and 'decode_content' on every column value.
+'decode_content' returns TEXT values unchanged, so readers work on databases in either storage mode.
+"""
+
+import re
+import zlib
+import collections
+
+MAGIC = b"OZC"
+
+METHOD_ZLIB        = 1
+METHOD_BFILE_DELTA = 2
+
+DICTIONARY_KIND_MAIN  = "main"
+DICTIONARY_KIND_BFILE = "bfile"
+
+ZLIB_LEVEL = 9
+
+MAX_DICTIONARY_SIZE = 32768 # zlib only uses the last 32 KiB of a preset dictionary.
+
+# Terms larger than this are not delta-encoded; such b-files are compressed with METHOD_ZLIB.
+MAX_DELTA_BITS = 256
+
+content_dictionaries = {} # dictionary ID -> dictionary (bytes); see 'load_content_dictionaries'.
+
+bfile_line_pattern = re.compile("(0|-?[1-9][0-9]*) (0|-?[1-9][0-9]*)$")
+
+def ensure_content_dictionaries_table(dbconn):
+    """Ensure that the 'content_dictionaries' table is present in the database."""
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS content_dictionaries (
+                 dictionary_id INTEGER  PRIMARY KEY NOT NULL, -- dictionary ID, as referenced by compressed content.
+                 kind          TEXT                 NOT NULL, -- DICTIONARY_KIND_MAIN or DICTIONARY_KIND_BFILE.
+                 dictionary    BLOB                 NOT NULL  -- zlib preset dictionary.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+    dbconn.commit()
+
+def load_content_dictionaries(dbconn):
+    """Load the dictionaries stored in the database into 'content_dictionaries', and return them.
+
+    A database without a 'content_dictionaries' table (i.e., with plain TEXT content) has no dictionaries.
+    """
+
+    dbcursor = dbconn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'content_dictionaries';")
+    if len(dbcursor.fetchall()) != 0:
+        dbcursor = dbconn.execute("SELECT dictionary_id, dictionary FROM content_dictionaries;")
+        content_dictionaries.update(dbcursor.fetchall())
+
+    return content_dictionaries
+
+def set_content_dictionaries(dictionaries):
+    """Set the known dictionaries. Used as a process pool initializer, so worker processes can decode content."""
+    content_dictionaries.update(dictionaries)
+
+def latest_content_dictionary_id(dbconn, kind):
+    """Return the ID of the most recently stored dictionary of the given kind, or None if there is none."""
+
+    dbcursor = dbconn.execute("SELECT MAX(dictionary_id) FROM content_dictionaries WHERE kind = ?;", (kind, ))
+    (dictionary_id, ) = dbcursor.fetchone()
+
+    return dictionary_id
+
+def store_content_dictionary(dbconn, kind, dictionary):
+    """Store a new dictionary of the given kind in the database, and return its ID."""
+
+    dbcursor = dbconn.execute("INSERT INTO content_dictionaries(kind, dictionary) VALUES (?, ?);", (kind, dictionary))
+    dbconn.commit()
+
+    content_dictionaries[dbcursor.lastrowid] = dictionary
+
+    return dbcursor.lastrowid
+
+def train_dictionary(samples, size = MAX_DICTIONARY_SIZE):
+    """Train a zlib preset dictionary on a list of sample texts.
+
+    The dictionary consists of the lines (and, for '%' directive lines, their leading words) that occur in many samples,
+    weighed by their length. zlib finds matches more cheaply near the end of the dictionary, so the most valuable
+    strings are put last.
+    """
+
+    MAX_PREFIX_WORDS = 6
+
+    counts = collections.Counter()
+
+    for sample in samples:
+        strings = set()
+        for line in sample.split("\n"):
+            strings.add(line + "\n")
+            if line.startswith("%"):
+                # '%X Annnnnn word word ...': skip the directive and the ID, which are cheap to encode.
+                words = line.split(" ")[2:]
+                for n in range(1, min(len(words), MAX_PREFIX_WORDS) + 1):
+                    strings.add(" " + " ".join(words[:n]))
+        counts.update(strings)
+
+    # Strings that occur in a single sample are not worth including.
+
+    candidates = [(count * len(string), string) for (string, count) in counts.items() if count > 1 and len(string) > 3]
+    candidates.sort(reverse = True)
+
+    selected = []
+    total_size = 0
+
+    for (score, string) in candidates:
+        encoded = string.encode("utf-8")
+        if total_size + len(encoded) > size:
+            continue
+        selected.append(encoded)
+        total_size += len(encoded)
+
+    return b"".join(reversed(selected))
+
+def encode_varint(value, out):
+    """Append an unsigned integer to the bytearray 'out', 7 bits per byte, least significant group first."""
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data, position):
+    """Decode an unsigned varint from 'data' at 'position'. Returns (value, new_position)."""
+
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, position)
+        shift += 7
+
+def zigzag(value):
+    """Map a signed integer to an unsigned integer: 0, -1, 1, -2, 2, ... map to 0, 1, 2, 3, 4, ..."""
+    return 2 * value if value >= 0 else -2 * value - 1
+
+def unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+def encode_bfile_delta(bfile_content):
+    """Delta-encode a b-file, or return None if the b-file cannot be reproduced exactly from its terms.
+
+    Only b-files with consecutive indices, one "n a(n)" line per term in canonical decimal notation,
+    and a final newline are delta-encoded.
+    """
+
+    if len(bfile_content) == 0 or not bfile_content.endswith("\n"):
+        return None
+
+    lines = bfile_content[:-1].split("\n")
+
+    out = bytearray()
+
+    previous_value = 0
+
+    for (i, line) in enumerate(lines):
+
+        match = bfile_line_pattern.match(line)
+        if match is None:
+            return None
+
+        (index, value) = (int(match.group(1)), int(match.group(2)))
+
+        if i == 0:
+            first_index = index
+            encode_varint(zigzag(first_index), out)
+            encode_varint(len(lines), out)
+        elif index != first_index + i:
+            return None
+
+        delta = value - previous_value
+        if delta.bit_length() > MAX_DELTA_BITS:
+            return None
+
+        encode_varint(zigzag(delta), out)
+        previous_value = value
+
+    return zlib.compress(bytes(out), ZLIB_LEVEL)
+
+def decode_bfile_delta(payload):
+    """Reconstruct a b-file from its delta encoding."""
+
+    data = zlib.decompress(payload)
+
+    (first_index, position) = decode_varint(data, 0)
+    (count      , position) = decode_varint(data, position)
+
+    first_index = unzigzag(first_index)
+
+    lines = []
+    value = 0
+
+    for i in range(count):
+        (delta, position) = decode_varint(data, position)
+        value += unzigzag(delta)
+        lines.append("{} {}\n".format(first_index + i, value))
+
+    return "".join(lines)
+
+def compress_with_dictionary(content, dictionary_id):
+    """Compress content using the given preset dictionary."""
+
+    compressor = zlib.compressobj(ZLIB_LEVEL, zdict = content_dictionaries[dictionary_id])
+
+    header = bytearray(MAGIC)
+    header.append(METHOD_ZLIB)
+    encode_varint(dictionary_id, header)
+
+    return bytes(header) + compressor.compress(content.encode("utf-8")) + compressor.flush()
+
+def compress_main_content(main_content, dictionary_id):
+    """Compress a main content string to a BLOB."""
+    return compress_with_dictionary(main_content, dictionary_id)
+
+def compress_bfile_content(bfile_content, dictionary_id):
+    """Compress a b-file content string to a BLOB, using delta encoding if possible."""
+
+    payload = encode_bfile_delta(bfile_content)
+    if payload is None:
+        return compress_with_dictionary(bfile_content, dictionary_id)
+
+    header = bytearray(MAGIC)
+    header.append(METHOD_BFILE_DELTA)
+    encode_varint(0, header)
+
+    return bytes(header) + payload
+
+def decode_content(value):
+    """Decode a 'main_content' or 'bfile_content' column value; TEXT values are returned unchanged."""
+
+    if isinstance(value, str):
+        return value
+
+    if value[:len(MAGIC)] != MAGIC:
+        raise ValueError("Content BLOB has an unknown format.")
+
+    method = value[len(MAGIC)]
+    (dictionary_id, position) = decode_varint(value, len(MAGIC) + 1)
+
+    if method == METHOD_ZLIB:
+        if dictionary_id not in content_dictionaries:
+            raise ValueError("Content BLOB refers to unknown dictionary {}; call 'load_content_dictionaries' first.".format(dictionary_id))
+        decompressor = zlib.decompressobj(zdict = content_dictionaries[dictionary_id])
+        return (decompressor.decompress(value[position:]) + decompressor.flush()).decode("utf-8")
+
+    if method == METHOD_BFILE_DELTA:
+        return decode_bfile_delta(value[position:])
+
+    raise ValueError("Content BLOB has an unknown compression method ({}).".format(method))
+
+class ContentEncoder:
+    """Encodes content for storage, using the most recent dictionaries stored in the database."""
+
+    def __init__(self, dbconn):
+        load_content_dictionaries(dbconn)
+        self.main_dictionary_id  = latest_content_dictionary_id(dbconn, DICTIONARY_KIND_MAIN)
+        self.bfile_dictionary_id = latest_content_dictionary_id(dbconn, DICTIONARY_KIND_BFILE)
+        if self.main_dictionary_id is None or self.bfile_dictionary_id is None:
+            raise ValueError("The database has no content dictionaries; run 'migrate_database_storage.py' first.")
+
+    def encode_main_content(self, main_content):
+        return compress_main_content(main_content, self.main_dictionary_id)
+
+    def encode_bfile_content(self, bfile_content):
+        return compress_bfile_content(bfile_content, self.bfile_dictionary_id)
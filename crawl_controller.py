@@ -0,0 +1,281 @@
+"""Adaptive concurrency and rate control for the OEIS crawler.
+
+The crawler used to run with a fixed number of workers and a fixed pause between batches.
+The AdaptiveController defined here measures the latency and the error and timeout rates of the fetches,
+and adjusts the number of in-flight fetches and the request rate while the crawler is running:
+
+* If a measurement window shows no sign of congestion, the concurrency and the rate are increased additively.
+* If the error rate is too high, timeouts occur, or the latency rises well above its baseline, both are decreased multiplicatively.
+
+Requests are paced by a token bucket per host. When a host responds with HTTP status 429 (Too Many Requests)
+or a 5xx status, all requests to that host are suspended with an exponentially increasing backoff.
+
+The controller only takes decisions; the fetchers enforce the concurrency limit and the delays.
+All methods are thread-safe. Decisions are logged at the PROGRESS level.
+"""
+
+import time
+import socket
+import random
+import logging
+import threading
+import urllib.error
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """A token bucket, used to pace requests to a single host."""
+
+    def __init__(self, rate, capacity):
+        self.rate     = rate     # tokens per second
+        self.capacity = capacity # maximum number of tokens
+        self.tokens   = capacity
+        self.t_update = time.monotonic()
+
+    def reserve(self, tokens):
+        """Take 'tokens' tokens from the bucket and return the number of seconds to wait until they are actually available.
+
+        The bucket may go into debt; subsequent reservations will then have to wait longer.
+        """
+
+        t_current = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (t_current - self.t_update) * self.rate)
+        self.t_update = t_current
+
+        self.tokens -= tokens
+
+        return 0.0 if self.tokens >= 0.0 else -self.tokens / self.rate
+
+def classify_fetch_exception(exception):
+    """Classify the outcome of a fetch.
+
+    The outcome is one of:
+
+    'ok'        : no exception.
+    'throttled' : HTTP status 429 or 5xx; the server asks us to slow down.
+    'timeout'   : the request timed out.
+    'error'     : some other network-level error (e.g., connection refused or reset).
+    'rejected'  : the server answered, but the answer was not usable (e.g., HTTP status 404, or a BadOeisResponse).
+
+    Only 'throttled', 'timeout', and 'error' outcomes are taken as signs of congestion.
+    """
+
+    if exception is None:
+        return "ok"
+
+    if isinstance(exception, urllib.error.HTTPError):
+        if exception.code == 429 or exception.code >= 500:
+            return "throttled"
+        return "rejected"
+
+    if isinstance(exception, (socket.timeout, TimeoutError)):
+        return "timeout"
+
+    if isinstance(exception, urllib.error.URLError) and isinstance(exception.reason, (socket.timeout, TimeoutError)):
+        return "timeout"
+
+    if isinstance(exception, OSError):
+        return "error"
+
+    return "rejected"
+
+def retry_after_seconds(exception):
+    """Return the value of a 'Retry-After' header in seconds, or None if not present or not a number."""
+
+    headers = getattr(exception, "headers", None)
+    if headers is None:
+        return None
+
+    retry_after = headers.get("Retry-After")
+    if retry_after is None:
+        return None
+
+    try:
+        return float(retry_after)
+    except ValueError:
+        return None # HTTP-date format; ignore.
+
+class AdaptiveController:
+    """AIMD-style controller for the concurrency and request rate of the crawler."""
+
+    def __init__(self, initial_concurrency = None, min_concurrency = None, max_concurrency = None,
+                 initial_rate = None, min_rate = None, max_rate = None, rate_step = None,
+                 window_duration = None, max_error_rate = None, max_latency_ratio = None,
+                 min_backoff = None, max_backoff = None):
+
+        # Handle defaults
+
+        if initial_concurrency is None:
+            initial_concurrency = 20
+
+        if min_concurrency is None:
+            min_concurrency = 1
+
+        if max_concurrency is None:
+            max_concurrency = 64
+
+        if initial_rate is None:
+            initial_rate = 40.0 # [requests/second]
+
+        if min_rate is None:
+            min_rate = 1.0 # [requests/second]
+
+        if max_rate is None:
+            max_rate = 2000.0 # [requests/second]
+
+        if rate_step is None:
+            rate_step = 4.0 # [requests/second]
+
+        if window_duration is None:
+            window_duration = 10.0 # [seconds]
+
+        if max_error_rate is None:
+            max_error_rate = 0.02
+
+        if max_latency_ratio is None:
+            max_latency_ratio = 2.0
+
+        if min_backoff is None:
+            min_backoff = 1.0 # [seconds]
+
+        if max_backoff is None:
+            max_backoff = 300.0 # [seconds]
+
+        # Store parameters
+
+        self.min_concurrency   = min_concurrency
+        self.max_concurrency   = max_concurrency
+        self.min_rate          = min_rate
+        self.max_rate          = max_rate
+        self.rate_step         = rate_step
+        self.window_duration   = window_duration
+        self.max_error_rate    = max_error_rate
+        self.max_latency_ratio = max_latency_ratio
+        self.min_backoff       = min_backoff
+        self.max_backoff       = max_backoff
+
+        # Controller state
+
+        self.concurrency = max(min_concurrency, min(max_concurrency, initial_concurrency))
+        self.rate        = max(min_rate, min(max_rate, initial_rate))
+
+        self._lock = threading.Lock()
+
+        self._buckets       = {} # host -> TokenBucket
+        self._backoff_count = {} # host -> number of consecutive throttled responses
+        self._backoff_until = {} # host -> time.monotonic() value until which requests are suspended
+
+        self._baseline_latency = None
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, t_current):
+        self._window_start     = t_current
+        self._window_requests  = 0
+        self._window_latencies = []
+        self._window_outcomes  = {"ok": 0, "throttled": 0, "timeout": 0, "error": 0, "rejected": 0}
+
+    def delay_before_request(self, host, requests = 1):
+        """Reserve 'requests' requests to 'host' and return the number of seconds the caller should wait before sending them."""
+
+        with self._lock:
+
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, capacity = max(1.0, self.rate))
+
+            bucket = self._buckets[host]
+            bucket.rate     = self.rate
+            bucket.capacity = max(1.0, self.rate)
+
+            delay = bucket.reserve(requests)
+
+            self._window_requests += requests
+
+            backoff_delay = self._backoff_until.get(host, 0.0) - time.monotonic()
+
+            return max(delay, backoff_delay)
+
+    def record(self, host, latency, exception = None):
+        """Record the outcome of a fetch. The 'exception' is None for a successful fetch."""
+
+        outcome = classify_fetch_exception(exception)
+
+        with self._lock:
+
+            t_current = time.monotonic()
+
+            self._window_outcomes[outcome] += 1
+
+            if outcome == "ok":
+                self._window_latencies.append(latency)
+                self._backoff_count[host] = 0
+            elif outcome == "throttled":
+                count = self._backoff_count.get(host, 0) + 1
+                self._backoff_count[host] = count
+                backoff = min(self.max_backoff, self.min_backoff * 2.0 ** (count - 1)) * random.uniform(1.0, 1.5)
+                retry_after = retry_after_seconds(exception)
+                if retry_after is not None:
+                    backoff = max(backoff, min(self.max_backoff, retry_after))
+                self._backoff_until[host] = max(self._backoff_until.get(host, 0.0), t_current + backoff)
+                logger.log(logging.PROGRESS, "Controller: host '{}' is throttling ({}); backing off for {:.1f} seconds.".format(host, exception, backoff))
+
+            if t_current - self._window_start >= self.window_duration:
+                self._adjust(t_current)
+
+    def _adjust(self, t_current):
+        """Take a control decision based on the measurements in the current window. Called with the lock held."""
+
+        outcomes = self._window_outcomes
+        count = sum(outcomes.values())
+
+        if count == 0:
+            self._reset_window(t_current)
+            return
+
+        error_rate = (outcomes["throttled"] + outcomes["timeout"] + outcomes["error"]) / count
+
+        latencies = sorted(self._window_latencies)
+        median_latency = latencies[len(latencies) // 2] if len(latencies) > 0 else None
+
+        # The baseline latency is the lowest median latency seen so far, slowly drifting upwards
+        # so that a permanent change in the network path is eventually accepted.
+
+        if median_latency is not None:
+            if self._baseline_latency is None or median_latency < self._baseline_latency:
+                self._baseline_latency = median_latency
+            else:
+                self._baseline_latency *= 1.01
+
+        reasons = []
+
+        if outcomes["throttled"] > 0:
+            reasons.append("{} throttled".format(outcomes["throttled"]))
+        if outcomes["timeout"] > 0:
+            reasons.append("{} timeouts".format(outcomes["timeout"]))
+        if error_rate > self.max_error_rate:
+            reasons.append("error rate {:.1f} %".format(100.0 * error_rate))
+        if median_latency is not None and median_latency > self.max_latency_ratio * self._baseline_latency:
+            reasons.append("latency {:.3f} s vs baseline {:.3f} s".format(median_latency, self._baseline_latency))
+
+        (old_concurrency, old_rate) = (self.concurrency, self.rate)
+
+        if len(reasons) > 0:
+            # Multiplicative decrease.
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.rate        = max(self.min_rate, self.rate * 0.5)
+            decision = "decrease ({})".format(", ".join(reasons))
+        else:
+            # Additive increase. If the request rate limit was (nearly) reached, we raise it;
+            # otherwise the concurrency was the limiting factor, and we raise that instead.
+            achieved_rate = self._window_requests / max(t_current - self._window_start, 1e-6)
+            if achieved_rate >= 0.8 * self.rate:
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            decision = "increase"
+
+        logger.log(logging.PROGRESS, "Controller: {} fetches in {:.1f} s, median latency {}, error rate {:.1f} %; {}: concurrency {} -> {}, rate {:.1f} -> {:.1f} requests/second.".format(
+            count, t_current - self._window_start, "n/a" if median_latency is None else "{:.3f} s".format(median_latency), 100.0 * error_rate,
+            decision, old_concurrency, self.concurrency, old_rate, self.rate))
+
+        self._reset_window(t_current)
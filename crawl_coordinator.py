@@ -0,0 +1,581 @@
+#! /usr/bin/env python3
+
+"""Distribute the crawl over several fetch worker processes, on one or more hosts.
+
+A single coordinator process owns the crawl and the SQLite database. It runs the regular database update cycle of
+'fetch_oeis_database.py', but instead of fetching the entries itself, it leases them to the workers that connect to it:
+
+* The entries to fetch are sorted and split into leases of up to LEASE_SIZE consecutive IDs.
+* A worker asks for a lease, and fetches the main content of its entries. While it waits for fetches to complete,
+  it renews the lease periodically.
+* The worker sends the main contents to the coordinator, which decides which b-files to fetch
+  ('bfile_requests_for_responses'), as it knows what is in the database. This also renews the lease.
+* The worker fetches the b-files, and sends the results, one entry per message. The b-files are sent in pieces of
+  BFILE_CHUNK_SIZE bytes, and kept in spooled temporary files, so neither side holds the b-files of a lease in memory.
+  The coordinator writes the results to the database with 'process_responses', in a single transaction per lease.
+  The entries that could not be fetched are leased again with a backoff, up to MAX_FETCH_ATTEMPTS times,
+  as in 'fetch_entries_into_database' (see 'RetrySchedule').
+
+A lease that is not renewed or completed within LEASE_DURATION seconds (e.g., because its worker hangs) expires:
+its entries are leased to another worker, and late results for it are discarded. The leases of a worker whose
+connection is lost are re-assigned immediately.
+
+The coordinator and the workers communicate over a 'multiprocessing.connection' socket, authenticated with a shared key
+(the messages are pickles, so only trusted workers may connect). Each worker has its own fetcher and AdaptiveController,
+so the load on the server is the sum of the loads of the workers.
+
+Usage:
+
+    crawl_coordinator.py coordinator [--listen HOST:PORT] [--local-workers N] ...    run the coordinator (and, optionally, local workers).
+    crawl_coordinator.py worker HOST:PORT ...                                        run a worker that connects to a coordinator.
+
+The coordinator creates the key file ('crawl_authkey') if it does not exist; copy it to the worker hosts.
+For a test on a single machine, run the coordinator with '--local-workers' and '--base-url' pointing to a local mock server.
+"""
+
+import os
+import time
+import queue
+import logging
+import argparse
+import threading
+import collections
+import multiprocessing
+import multiprocessing.connection
+
+import fetch_remote_oeis_entry
+
+from fetch_oeis_database import database_update_cycle_loop, process_responses, bfile_requests_for_responses, merge_bfile_result
+from fetch_oeis_database import make_fetcher, RetrySchedule, FETCH_BACKENDS, DEFAULT_REFRESH_BUDGET
+from crawler_metrics     import crawler_metrics
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS      = ("localhost", 8740)
+DEFAULT_AUTHKEY_FILE = "crawl_authkey"
+
+LEASE_SIZE     = 200   # [entries]
+LEASE_DURATION = 120.0 # [seconds] A lease expires if it is not renewed or completed within this time. Workers renew after a third of it.
+
+WAIT_INTERVAL = 1.0 # [seconds] Workers that ask for a lease while all entries are leased retry after this time.
+
+CONNECT_TIMEOUT = 60.0 # [seconds] Workers retry connecting to the coordinator for this long.
+
+# Messages from a worker to the coordinator, and their replies:
+#
+#   ("lease", )                                    ("lease", lease_id, oeis_ids, lease_duration), or ("wait", seconds).
+#   ("renew", lease_id)                            ("ok", ), or ("expired", ).
+#   ("bfile_requests", lease_id, main_responses)   ("bfile_requests", requests), or ("expired", ).
+#   ("result", lease_id, response)                 none; see below.
+#   ("results", lease_id, failed_ids)              ("ok", ), or ("expired", ).
+#
+# The responses are FetchResult instances. Each response of a lease is sent in a "result" message, followed by the
+# content of its b-file download (if any) in raw byte messages; see 'send_response'. The "results" message completes the lease.
+
+class LeaseExpired(Exception):
+    pass
+
+class Lease:
+    def __init__(self, lease_id, connection, oeis_ids):
+        self.lease_id   = lease_id
+        self.connection = connection
+        self.oeis_ids   = oeis_ids
+        self.deadline   = time.monotonic() + LEASE_DURATION
+        self.responses  = [] # responses received for this lease, written when the lease is completed.
+
+    def __str__(self):
+        return "lease {} (A{:06}..A{:06}, {} entries)".format(self.lease_id, self.oeis_ids[0], self.oeis_ids[-1], len(self.oeis_ids))
+
+def send_response(connection, lease_id, response):
+    """Send a response of a lease: the response without its b-file content, followed by that content in pieces."""
+
+    connection.send(("result", lease_id, response))
+
+    if response.bfile_download is not None:
+        for data in response.bfile_download.chunks():
+            connection.send_bytes(data)
+
+def receive_bfile_content(connection, bfile_download):
+    """Receive the b-file content that follows a response sent by 'send_response', into its unpickled b-file download."""
+
+    received = 0
+
+    while received < bfile_download.size:
+        data = connection.recv_bytes()
+        bfile_download.append_chunk(data)
+        received += len(data)
+
+def close_bfile_downloads(responses):
+    for response in responses:
+        if response.bfile_download is not None:
+            response.bfile_download.close()
+
+def parse_address(address):
+    """Parse a 'HOST:PORT' string into a (host, port) tuple."""
+    (host, port) = address.rsplit(":", 1)
+    return (host, int(port))
+
+def read_authkey(filename, create_flag = False):
+    """Read the shared authentication key from a file. If requested, a file with a random key is created if it does not exist."""
+
+    if create_flag and not os.path.exists(filename):
+        logger.info("Creating authentication key file '{}'.".format(filename))
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(os.urandom(32).hex() + "\n")
+
+    with open(filename) as f:
+        return f.read().strip().encode("ascii")
+
+class CrawlCoordinator:
+    """Lease entries to fetch workers, and write their results to the database.
+
+    A CrawlCoordinator must be used as a context manager, that listens for worker connections while in scope.
+    It can be passed as the fetcher to 'fetch_entries_into_database' and 'database_update_cycle', which then call
+    its 'fetch_entries_into_database' method.
+    """
+
+    def __init__(self, address = None, authkey = None):
+
+        # Handle defaults
+
+        if address is None:
+            address = DEFAULT_ADDRESS
+
+        self.address = address
+        self.authkey = authkey
+
+        self._listener        = None
+        self._accept_thread   = None
+        self._closing         = False
+        self._new_connections = queue.Queue() # connections accepted by the accept thread.
+        self._connections     = []
+
+        self._pending       = collections.deque() # OEIS IDs to be leased, in ascending order.
+        self._requeued      = []                  # OEIS IDs to be leased again, in ascending order; they are leased before the pending IDs.
+        self._retries       = RetrySchedule()     # OEIS IDs that could not be fetched, waiting for their retry.
+        self._leases        = {}                  # lease_id -> Lease
+        self._next_lease_id = 1
+
+    def __str__(self):
+        return "coordinator at {}:{} with {} connected workers".format(self.address[0], self.address[1], len(self._connections))
+
+    def __enter__(self):
+        self._listener = multiprocessing.connection.Listener(self.address, authkey = self.authkey)
+        self._accept_thread = threading.Thread(target = self._accept_connections, name = "crawl-coordinator-accept")
+        self._accept_thread.start()
+        logger.info("Crawl coordinator listening at {}:{}.".format(self.address[0], self.address[1]))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        # Wake up the accept thread with a connection of our own.
+
+        self._closing = True
+        try:
+            multiprocessing.connection.Client(self.address, authkey = self.authkey).close()
+        except OSError:
+            pass
+        self._accept_thread.join()
+        self._listener.close()
+
+        # Closing the connections tells the workers to stop.
+
+        while not self._new_connections.empty():
+            self._connections.append(self._new_connections.get())
+
+        for connection in self._connections:
+            connection.close()
+
+        self._connections = []
+
+    def _accept_connections(self):
+        """Accept worker connections, until the coordinator is closed. Runs on the accept thread."""
+
+        while not self._closing:
+            try:
+                connection = self._listener.accept()
+            except multiprocessing.AuthenticationError as exception:
+                logger.warning("Rejected worker connection: '{}'.".format(exception))
+                continue
+            except OSError as exception:
+                if not self._closing:
+                    logger.error("Unable to accept worker connection: '{}'.".format(exception))
+                break
+            if self._closing:
+                connection.close()
+                break
+            self._new_connections.put(connection)
+
+    def _add_new_connections(self, timeout):
+        """Add the connections accepted since the previous call. Waits up to 'timeout' seconds for one if there are none."""
+
+        try:
+            if len(self._connections) == 0:
+                self._connections.append(self._new_connections.get(timeout = timeout))
+            while True:
+                connection = self._new_connections.get_nowait()
+                self._connections.append(connection)
+        except queue.Empty:
+            pass
+
+    def _release_lease(self, lease, oeis_ids):
+        """End a lease. The given OEIS IDs are leased again, before any others. Responses received for the lease are discarded."""
+
+        del self._leases[lease.lease_id]
+        close_bfile_downloads(lease.responses)
+        lease.responses = []
+        self._requeue(oeis_ids)
+
+    def _requeue(self, oeis_ids):
+        """Add OEIS IDs to be leased again, keeping them in ascending order."""
+
+        if len(oeis_ids) > 0:
+            self._requeued = sorted(self._requeued + list(oeis_ids))
+
+    def _next_lease_ids(self):
+        """Take the OEIS IDs for a new lease: the IDs to be leased again (including retries that are due) if any, else the pending IDs."""
+
+        self._requeue(self._retries.due())
+
+        if len(self._requeued) > 0:
+            oeis_ids = self._requeued[:LEASE_SIZE]
+            del self._requeued[:LEASE_SIZE]
+            return oeis_ids
+
+        return [self._pending.popleft() for i in range(min(LEASE_SIZE, len(self._pending)))]
+
+    def _drop_connection(self, connection):
+
+        logger.warning("Lost connection to a worker.")
+
+        self._connections.remove(connection)
+        connection.close()
+
+        for lease in list(self._leases.values()):
+            if lease.connection is connection:
+                logger.warning("Re-assigning {} of the lost worker.".format(lease))
+                self._release_lease(lease, lease.oeis_ids)
+
+    def _expire_leases(self):
+
+        # A lease is not expired while a message from its worker (e.g., a renewal) has not been read yet.
+
+        t_current = time.monotonic()
+
+        for lease in list(self._leases.values()):
+            if t_current >= lease.deadline and not lease.connection.poll():
+                logger.warning("{} expired; re-assigning its entries.".format(lease))
+                self._release_lease(lease, lease.oeis_ids)
+
+    def _handle_message(self, dbconn, connection, message):
+        """Handle a message from a worker. Returns the number of entries that were written to the database."""
+
+        if message[0] == "lease":
+
+            oeis_ids = self._next_lease_ids()
+
+            if len(oeis_ids) == 0:
+                connection.send(("wait", WAIT_INTERVAL))
+                return 0
+
+            lease = Lease(self._next_lease_id, connection, oeis_ids)
+            self._next_lease_id += 1
+            self._leases[lease.lease_id] = lease
+
+            connection.send(("lease", lease.lease_id, oeis_ids, LEASE_DURATION))
+            return 0
+
+        lease = self._leases.get(message[1])
+
+        if message[0] == "renew":
+
+            if lease is None:
+                connection.send(("expired", ))
+                return 0
+
+            lease.deadline = time.monotonic() + LEASE_DURATION
+
+            connection.send(("ok", ))
+            return 0
+
+        if message[0] == "bfile_requests":
+
+            if lease is None:
+                connection.send(("expired", ))
+                return 0
+
+            lease.deadline = time.monotonic() + LEASE_DURATION
+
+            connection.send(("bfile_requests", bfile_requests_for_responses(dbconn, message[2])))
+            return 0
+
+        if message[0] == "result":
+
+            response = message[2]
+
+            if response.bfile_download is not None:
+                receive_bfile_content(connection, response.bfile_download)
+
+            if lease is None:
+                close_bfile_downloads([response])
+                return 0
+
+            lease.deadline = time.monotonic() + LEASE_DURATION
+
+            lease.responses.append(response)
+            return 0
+
+        if message[0] == "results":
+
+            failed_ids = message[2]
+
+            if lease is None:
+                connection.send(("expired", ))
+                return 0
+
+            # The responses are written in a single transaction. 'process_responses' closes their b-file downloads.
+
+            (responses, lease.responses) = (lease.responses, [])
+
+            processed_entries = process_responses(dbconn, responses) if len(responses) > 0 else set()
+
+            # Entries that could not be fetched are leased again once their retry is due, or dropped for this cycle.
+
+            self._release_lease(lease, [])
+
+            for oeis_id in failed_ids:
+                self._retries.failed(oeis_id)
+
+            crawler_metrics.export_if_due(dbconn)
+
+            connection.send(("ok", ))
+            return len(processed_entries)
+
+        raise ValueError("Unknown message '{}' from worker.".format(message[0]))
+
+    def fetch_entries_into_database(self, dbconn, entries):
+        """Lease the entries to the workers, and write their results to the database. Returns when all entries have been written."""
+
+        self._pending  = collections.deque(sorted(set(entries)))
+        self._requeued = []
+        self._retries  = RetrySchedule()
+
+        count_processed = 0
+
+        logger.info("Fetching data using {} for {} entries ...".format(self, len(self._pending)))
+
+        with start_timer(len(self._pending)) as timer:
+
+            while len(self._pending) > 0 or len(self._requeued) > 0 or len(self._retries) > 0 or len(self._leases) > 0:
+
+                self._add_new_connections(WAIT_INTERVAL)
+
+                self._expire_leases()
+
+                for connection in multiprocessing.connection.wait(self._connections, timeout = WAIT_INTERVAL):
+                    try:
+                        message = connection.recv()
+                        count_written = self._handle_message(dbconn, connection, message)
+                    except (EOFError, OSError):
+                        self._drop_connection(connection)
+                        continue
+
+                    if count_written > 0:
+                        count_processed += count_written
+                        count_remaining = timer.total_work - count_processed - self._retries.dropped
+                        logger.info("Estimated time to completion: {}.".format(timer.etc_string(work_remaining = count_remaining)))
+
+            logger.info("Fetched {} entries in {}; gave up on {} entries.".format(timer.total_work - self._retries.dropped, timer.duration_string(), self._retries.dropped))
+
+def fetch_lease(connection, fetcher, lease_id, oeis_ids, lease_duration):
+    """Fetch the entries of a lease, and send the results to the coordinator."""
+
+    # The fetcher's callbacks put (oeis_id, result) tuples on a queue of this lease. If the lease expires,
+    # the fetches in flight complete into a queue that is no longer read.
+
+    completed = queue.Queue()
+
+    t_renew = time.monotonic() + lease_duration / 3
+
+    def completed_fetches(count):
+        """Yield 'count' completed fetches, renewing the lease periodically. Raises LeaseExpired if the lease expired."""
+
+        nonlocal t_renew
+
+        for i in range(count):
+            while True:
+                if time.monotonic() >= t_renew:
+                    connection.send(("renew", lease_id))
+                    if connection.recv()[0] == "expired":
+                        raise LeaseExpired()
+                    t_renew = time.monotonic() + lease_duration / 3
+                try:
+                    result = completed.get(timeout = max(0.0, t_renew - time.monotonic()))
+                except queue.Empty:
+                    continue
+                yield result
+                break
+
+    for oeis_id in oeis_ids:
+        fetcher.submit_entry(oeis_id, lambda result, oeis_id = oeis_id: completed.put((oeis_id, result)))
+
+    main_responses = []
+    failed_ids = []
+
+    for (oeis_id, result) in completed_fetches(len(oeis_ids)):
+        if result is None:
+            failed_ids.append(oeis_id)
+        else:
+            main_responses.append(result)
+
+    # The coordinator decides which b-files to fetch.
+
+    connection.send(("bfile_requests", lease_id, main_responses))
+    reply = connection.recv()
+    if reply[0] == "expired":
+        raise LeaseExpired()
+
+    requests = reply[1]
+
+    responses = []
+    awaiting_bfile = {}
+
+    for response in main_responses:
+        if response.oeis_id in requests:
+            awaiting_bfile[response.oeis_id] = response
+            fetcher.submit_bfile(requests[response.oeis_id], lambda result, oeis_id = response.oeis_id: completed.put((oeis_id, result)))
+        else:
+            responses.append(response)
+
+    for (oeis_id, result) in completed_fetches(len(awaiting_bfile)):
+        response = merge_bfile_result(awaiting_bfile[oeis_id], result)
+        if response is None:
+            failed_ids.append(oeis_id)
+        else:
+            responses.append(response)
+
+    try:
+        for response in responses:
+            send_response(connection, lease_id, response)
+        connection.send(("results", lease_id, failed_ids))
+    finally:
+        close_bfile_downloads(responses)
+
+    reply = connection.recv()
+    if reply[0] == "expired":
+        logger.warning("Lease {} expired before its results were sent; they were discarded.".format(lease_id))
+        return
+
+    logger.info("Lease {} done: {} entries fetched (A{:06}..A{:06}), {} failures.".format(lease_id, len(responses), oeis_ids[0], oeis_ids[-1], len(failed_ids)))
+
+def connect_to_coordinator(address, authkey):
+    """Connect to the coordinator, retrying for up to CONNECT_TIMEOUT seconds (e.g., while it starts up)."""
+
+    t_give_up = time.monotonic() + CONNECT_TIMEOUT
+
+    while True:
+        try:
+            return multiprocessing.connection.Client(address, authkey = authkey)
+        except ConnectionRefusedError:
+            if time.monotonic() >= t_give_up:
+                raise
+            time.sleep(WAIT_INTERVAL)
+
+def run_worker(address, authkey, fetch_backend = "threads", base_url = None):
+    """Fetch leases from the coordinator at the given address, until it closes the connection."""
+
+    with close_when_done(connect_to_coordinator(address, authkey)) as connection, make_fetcher(fetch_backend, base_url) as fetcher:
+
+        logger.info("Connected to crawl coordinator at {}:{}; fetching using {}.".format(address[0], address[1], fetcher))
+
+        try:
+            while True:
+                connection.send(("lease", ))
+                reply = connection.recv()
+                if reply[0] == "wait":
+                    time.sleep(reply[1])
+                    continue
+
+                (lease_id, oeis_ids, lease_duration) = reply[1:]
+                try:
+                    fetch_lease(connection, fetcher, lease_id, oeis_ids, lease_duration)
+                except LeaseExpired:
+                    logger.warning("Lease {} expired; abandoning it.".format(lease_id))
+
+                if crawler_metrics.prometheus_filename is not None:
+                    crawler_metrics.write_prometheus_file(crawler_metrics.prometheus_filename)
+
+        except (EOFError, ConnectionError):
+            logger.info("Crawl coordinator closed the connection.")
+
+def local_worker_main(address, authkey, fetch_backend, base_url, max_bfile_size):
+    """Entry point of a local worker process, started by the coordinator."""
+
+    fetch_remote_oeis_entry.MAX_BFILE_SIZE = max_bfile_size
+
+    with setup_logging(None):
+        run_worker(address, authkey, fetch_backend, base_url)
+
+def start_local_workers(count, address, authkey, fetch_backend, base_url):
+    """Start worker processes on this machine. They are started fresh ('spawn'), not forked from the coordinator."""
+
+    context = multiprocessing.get_context("spawn")
+
+    workers = [context.Process(target = local_worker_main, args = (address, authkey, fetch_backend, base_url, fetch_remote_oeis_entry.MAX_BFILE_SIZE),
+                               name = "crawl-worker-{}".format(i + 1)) for i in range(count)]
+
+    for worker in workers:
+        worker.start()
+
+    return workers
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Distribute the crawl of the remote OEIS database over several worker processes.")
+    parser.add_argument("--authkey-file"  , default = DEFAULT_AUTHKEY_FILE, help = "file with the key shared by the coordinator and the workers (default: {})".format(DEFAULT_AUTHKEY_FILE))
+    parser.add_argument("--fetch-backend" , choices = sorted(FETCH_BACKENDS), default = "threads", help = "fetch engine of the workers (default: threads)")
+    parser.add_argument("--base-url"      , default = None, help = "base URL of the OEIS server, e.g. that of a local mock server (default: {})".format(fetch_remote_oeis_entry.DEFAULT_BASE_URL))
+    parser.add_argument("--metrics-file"  , default = None, help = "Prometheus text file to which the crawler metrics are written periodically")
+    parser.add_argument("--max-bfile-size", type = int, default = fetch_remote_oeis_entry.MAX_BFILE_SIZE >> 20, help = "size cap in MiB beyond which b-files are truncated (default: {})".format(fetch_remote_oeis_entry.MAX_BFILE_SIZE >> 20))
+
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    parser_coordinator = subparsers.add_parser("coordinator", help = "run the coordinator, which owns the database")
+    parser_coordinator.add_argument("--listen"        , type = parse_address, default = DEFAULT_ADDRESS, help = "address to listen on for workers (default: {}:{})".format(*DEFAULT_ADDRESS))
+    parser_coordinator.add_argument("--local-workers" , type = int, default = 0, help = "number of worker processes to start on this machine (default: 0)")
+    parser_coordinator.add_argument("--refresh-budget", type = int, default = DEFAULT_REFRESH_BUDGET, help = "requests per hour to spend on refreshing entries (default: {})".format(DEFAULT_REFRESH_BUDGET))
+    parser_coordinator.add_argument("database_filename", nargs = "?", default = "oeis.sqlite3", help = "sqlite3 database (default: oeis.sqlite3)")
+
+    parser_worker = subparsers.add_parser("worker", help = "run a worker, which fetches the entries leased to it by the coordinator")
+    parser_worker.add_argument("coordinator_address", type = parse_address, help = "address of the coordinator, as HOST:PORT")
+
+    args = parser.parse_args()
+
+    fetch_remote_oeis_entry.MAX_BFILE_SIZE = args.max_bfile_size << 20
+
+    crawler_metrics.prometheus_filename = args.metrics_file
+
+    if args.command == "worker":
+        with setup_logging("logfiles/crawl_worker_%Y%m%d_%H%M%S.log"):
+            run_worker(args.coordinator_address, read_authkey(args.authkey_file), args.fetch_backend, args.base_url)
+        return
+
+    with setup_logging("logfiles/crawl_coordinator_%Y%m%d_%H%M%S.log"):
+
+        authkey = read_authkey(args.authkey_file, create_flag = True)
+
+        # The local workers stop when the coordinator closes their connections.
+
+        with CrawlCoordinator(args.listen, authkey) as coordinator:
+            workers = start_local_workers(args.local_workers, args.listen, authkey, args.fetch_backend, args.base_url)
+            database_update_cycle_loop(args.database_filename, args.fetch_backend, args.refresh_budget, coordinator, args.base_url)
+
+        for worker in workers:
+            worker.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Telemetry of the OEIS crawler: request latency histograms, transfer volume, error classes, entry outcomes, and commit durations.
+
+The metrics are collected in a single process-wide CrawlerMetrics instance, 'crawler_metrics':
+
+* The fetch functions in 'fetch_remote_oeis_entry.py' and 'fetch_remote_oeis_entry_async.py' measure each request
+  with 'measure_request', split into main-content and b-file requests.
+* 'process_responses' in 'fetch_oeis_database.py' records how many entries were new, identical, updated, or failed,
+  and how long the database transaction took.
+
+All values are cumulative since the start of the process, like Prometheus counters and histograms.
+They are exported periodically (see 'CrawlerMetrics.export_if_due'):
+
+* to the 'crawler_metrics' table of the crawler database, as the increase of each value during the export interval.
+  Intervals can be summed to compare, e.g., the latency distribution of this week with that of last month.
+* to a text file in the Prometheus exposition format, if a filename is set. The file is replaced atomically,
+  so it can be picked up by the textfile collector of the Prometheus node exporter.
+
+All methods are thread-safe.
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+from crawl_controller import classify_fetch_exception
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds of the histograms, in seconds. An implicit '+Inf' bucket follows.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+REQUEST_KIND_MAIN  = "main"
+REQUEST_KIND_BFILE = "bfile"
+
+METRIC_HELP = {
+    "oeis_crawler_request_duration_seconds" : ("histogram", "Duration of requests to the OEIS server, by kind (main content or b-file)."),
+    "oeis_crawler_requests_total"           : ("counter"  , "Requests to the OEIS server, by kind and outcome (ok, not_modified, throttled, timeout, error, rejected)."),
+    "oeis_crawler_response_bytes_total"     : ("counter"  , "Bytes of response bodies received from the OEIS server (uncompressed), by kind."),
+    "oeis_crawler_entries_total"            : ("counter"  , "Entries processed by the crawler, by status (new, identical, updated, failed)."),
+    "oeis_crawler_commit_duration_seconds"  : ("histogram", "Duration of the database transactions that write fetched entries.")
+}
+
+class Histogram:
+    """A histogram with fixed buckets. Not thread-safe by itself; used under the lock of a CrawlerMetrics instance."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1) # The last count is that of the '+Inf' bucket.
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def samples(self):
+        """Yield (suffix, le, value) tuples: the cumulative bucket counts, the sum, and the count."""
+
+        cumulative_count = 0
+        for (bound, count) in zip(self.buckets + (float("inf"), ), self.counts):
+            cumulative_count += count
+            yield ("_bucket", "+Inf" if bound == float("inf") else repr(bound), cumulative_count)
+
+        yield ("_sum"  , None, self.sum)
+        yield ("_count", None, self.count)
+
+class RequestMeasurement:
+    """The measurement of a single request, filled in by the fetch functions; see 'measure_request'."""
+
+    def __init__(self):
+        self.response_bytes = 0
+        self.not_modified   = False
+
+def format_labels(labels):
+    """Format a tuple of (name, value) pairs in Prometheus syntax, e.g. 'kind="main",le="0.1"'."""
+    return ",".join("{}=\"{}\"".format(name, value) for (name, value) in labels)
+
+class CrawlerMetrics:
+    """Counters and histograms of the crawler, keyed by metric name and a tuple of (label, value) pairs."""
+
+    def __init__(self, export_interval = None, prometheus_filename = None):
+
+        # Handle defaults
+
+        if export_interval is None:
+            export_interval = 300.0 # [seconds]
+
+        self.export_interval     = export_interval
+        self.prometheus_filename = prometheus_filename # No Prometheus text file is written if None.
+
+        self._lock       = threading.Lock()
+        self._counters   = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> Histogram
+
+        self._exported_values = {} # (name, labels) -> value at the previous export to the database.
+        self._t_exported      = time.time()
+
+    def increment(self, name, labels = (), value = 1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value, buckets = LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def record_request(self, kind, duration, response_bytes, outcome):
+        """Record a request of the given kind (REQUEST_KIND_MAIN or REQUEST_KIND_BFILE)."""
+
+        self.observe("oeis_crawler_request_duration_seconds", (("kind", kind), ), duration)
+        self.increment("oeis_crawler_requests_total", (("kind", kind), ("outcome", outcome)))
+        if response_bytes > 0:
+            self.increment("oeis_crawler_response_bytes_total", (("kind", kind), ), response_bytes)
+
+    def record_entries(self, status, count):
+        if count > 0:
+            self.increment("oeis_crawler_entries_total", (("status", status), ), count)
+
+    def record_commit(self, duration):
+        self.observe("oeis_crawler_commit_duration_seconds", (), duration)
+
+    def samples(self):
+        """Return a list of (name, labels, value) samples, ordered by metric, with the histograms expanded into buckets, sum, and count."""
+
+        samples = []
+
+        with self._lock:
+
+            for (name, labels) in sorted(set(self._counters) | set(self._histograms)):
+                if (name, labels) in self._counters:
+                    samples.append((name, format_labels(labels), self._counters[(name, labels)]))
+                else:
+                    for (suffix, le, value) in self._histograms[(name, labels)].samples():
+                        samples.append((name + suffix, format_labels(labels if le is None else labels + (("le", le), )), value))
+
+        return samples
+
+    def prometheus_text(self):
+        """Return the metrics in the Prometheus text exposition format."""
+
+        lines = []
+
+        described = set()
+
+        for (name, labels, value) in self.samples():
+
+            base_name = next((base_name for base_name in METRIC_HELP if name.startswith(base_name)), None)
+
+            if base_name is not None and base_name not in described:
+                (metric_type, help_text) = METRIC_HELP[base_name]
+                lines.append("# HELP {} {}".format(base_name, help_text))
+                lines.append("# TYPE {} {}".format(base_name, metric_type))
+                described.add(base_name)
+
+            lines.append("{}{{{}}} {}".format(name, labels, value) if labels else "{} {}".format(name, value))
+
+        return "".join(line + "\n" for line in lines)
+
+    def write_prometheus_file(self, filename):
+        """Write the metrics to a Prometheus text file. The file is written under a temporary name first, and then renamed."""
+
+        temp_filename = filename + ".tmp"
+
+        with open(temp_filename, "w") as f:
+            f.write(self.prometheus_text())
+
+        os.replace(temp_filename, filename)
+
+    def write_metrics_table(self, dbconn):
+        """Append the increase of all metrics since the previous export to the 'crawler_metrics' table, and commit.
+
+        Metrics that did not change are not written.
+        """
+
+        t_current = time.time()
+
+        rows = []
+        exported_values = {}
+
+        for (name, labels, value) in self.samples():
+            exported_values[(name, labels)] = value
+            increase = value - self._exported_values.get((name, labels), 0)
+            if increase != 0:
+                rows.append((self._t_exported, t_current, name, labels, increase))
+
+        dbconn.executemany("INSERT INTO crawler_metrics(t1, t2, name, labels, value) VALUES (?, ?, ?, ?, ?);", rows)
+        dbconn.commit()
+
+        self._exported_values = exported_values
+        self._t_exported      = t_current
+
+    def export(self, dbconn):
+        """Export the metrics to the database and, if a filename is set, to the Prometheus text file."""
+
+        self.write_metrics_table(dbconn)
+
+        if self.prometheus_filename is not None:
+            try:
+                self.write_prometheus_file(self.prometheus_filename)
+            except OSError as exception:
+                logger.error("Unable to write metrics file '{}': '{}'.".format(self.prometheus_filename, exception))
+
+    def export_if_due(self, dbconn):
+        """Export the metrics if at least 'export_interval' seconds have passed since the previous export."""
+
+        if time.time() >= self._t_exported + self.export_interval:
+            self.export(dbconn)
+
+crawler_metrics = CrawlerMetrics()
+
+@contextlib.contextmanager
+def measure_request(kind):
+    """Measure a request of the given kind, and record it in 'crawler_metrics'.
+
+    The body of the with-statement performs the request, and fills in the RequestMeasurement that is returned.
+    If it raises an exception, the outcome is classified with 'classify_fetch_exception', and the exception is re-raised.
+    """
+
+    measurement = RequestMeasurement()
+
+    t_start = time.monotonic()
+
+    try:
+        yield measurement
+    except Exception as exception:
+        crawler_metrics.record_request(kind, time.monotonic() - t_start, measurement.response_bytes, classify_fetch_exception(exception))
+        raise
+
+    crawler_metrics.record_request(kind, time.monotonic() - t_start, measurement.response_bytes, "not_modified" if measurement.not_modified else "ok")
+
+def ensure_metrics_table_created(dbconn):
+    """Ensure that the 'crawler_metrics' table is present in the database."""
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS crawler_metrics (
+                 t1            REAL                 NOT NULL, -- start of the export interval.
+                 t2            REAL                 NOT NULL, -- end of the export interval.
+                 name          TEXT                 NOT NULL, -- sample name, e.g. 'oeis_crawler_request_duration_seconds_bucket'.
+                 labels        TEXT                 NOT NULL, -- labels in Prometheus syntax, e.g. 'kind="main",le="0.1"'; empty if none.
+                 value         REAL                 NOT NULL  -- increase of the sample during the export interval.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+    dbconn.execute("CREATE INDEX IF NOT EXISTS crawler_metrics_name ON crawler_metrics(name, t2);")
+
+    dbconn.commit()
@@ -2,14 +2,15 @@
 
 import os
 import sys
-import sqlite3
 import logging
 import shutil
 import json
 
-from timer         import start_timer
-from exit_scope    import close_when_done
-from setup_logging import setup_logging
+from content_compression import load_content_dictionaries, decode_content
+from xz_snapshot_reader  import open_database, strip_snapshot_extension
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +20,6 @@ def process_database_entries(database_filename_in, dirname_out):
         logger.critical("Database file '{}' not found! Unable to continue.".format(database_filename_in))
         return
 
-    (root, ext) = os.path.splitext(database_filename_in)
-
     if os.path.exists(dirname_out):
         logger.info("Removing stale directory '{}' ...".format(dirname_out))
         shutil.rmtree(dirname_out)
@@ -30,7 +29,9 @@ def process_database_entries(database_filename_in, dirname_out):
     BATCH_SIZE = 1000
 
     with start_timer() as timer:
-        with close_when_done(sqlite3.connect(database_filename_in)) as dbconn_in, close_when_done(dbconn_in.cursor()) as dbcursor_in:
+        with close_when_done(open_database(database_filename_in)) as dbconn_in, close_when_done(dbconn_in.cursor()) as dbcursor_in:
+
+            load_content_dictionaries(dbconn_in)
 
             dbcursor_in.execute("SELECT oeis_id, t1, t2, main_content, bfile_content FROM oeis_entries ORDER BY oeis_id;")
 
@@ -52,22 +53,22 @@ def process_database_entries(database_filename_in, dirname_out):
                         json.dump(metadata, f)
 
                     with open(os.path.join(directory, "main_content.txt"), "w") as f:
-                        f.write(main_content)
+                        f.write(decode_content(main_content))
 
                     with open(os.path.join(directory, "bfile_content.txt"), "w") as f:
-                        f.write(bfile_content)
+                        f.write(decode_content(bfile_content))
 
         logger.info("Processed all database entries in {}.".format(timer.duration_string()))
 
 def main():
 
     if len(sys.argv) != 2:
-        print("Please specify the name of an OEIS database in Sqlite3 format.")
+        print("Please specify the name of an OEIS database in Sqlite3 format, or of a compressed database snapshot.")
         return
 
     database_filename_in = sys.argv[1]
 
-    (root, ext) = os.path.splitext(os.path.basename(database_filename_in))
+    (root, ext) = os.path.splitext(os.path.basename(strip_snapshot_extension(database_filename_in)))
 
     dirname_out = os.path.join("data", root + "_directory")
 
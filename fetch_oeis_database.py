@@ -8,6 +8,12 @@ will periodically refresh its local entries.
 Once every day, a consolidated version of the SQLite database will be compressed and
 written to the local directory. This file will be called "oeis_vYYYYMMDD.sqlite3.xz".
 Stale versions of this consolidated file will be removed automatically.
+
+The crawler's telemetry (request latencies, transfer volume, errors, entry outcomes, and commit durations) is
+exported periodically to the 'crawler_metrics' table and to a Prometheus text file; see 'crawler_metrics.py'.
+
+When the content of an entry changes, the superseded version is kept as a delta, and the change is appended
+to a change log that downstream consumers can tail; see 'oeis_revisions.py'.
 """
 
 import os
@@ -18,12 +24,28 @@ import sqlite3
 import random
 import logging
 import lzma
+import hashlib
+import argparse
+import threading
+import queue
+import collections
+import heapq
+import contextlib
 import concurrent.futures
 
-from fetch_remote_oeis_entry import fetch_remote_oeis_entry, BadOeisResponse
-from timer                   import start_timer
-from exit_scope              import close_when_done
-from setup_logging           import setup_logging
+import fetch_remote_oeis_entry as remote_entry_module # For the 'MAX_BFILE_SIZE' setting; the name is taken by the function below.
+
+from fetch_remote_oeis_entry       import fetch_remote_oeis_entry, fetch_remote_oeis_bfile, bfile_link_lines, BadOeisResponse, oeis_host
+from fetch_remote_oeis_entry_async import AsyncioFetcher
+from crawl_controller              import AdaptiveController
+from crawler_metrics               import crawler_metrics, ensure_metrics_table_created
+from oeis_revisions                import ensure_revisions_table_created, record_revisions
+from refresh_scheduler             import next_due_time, refresh_count_for_budget, select_stalest_entries
+from parallel_xz                   import compress_file_parallel, worker_memory_usage
+from content_compression           import ContentEncoder, ensure_content_dictionaries_table, load_content_dictionaries, decode_content
+from timer                         import start_timer
+from exit_scope                    import close_when_done
+from setup_logging                 import setup_logging
 
 logger = logging.getLogger(__name__)
 
@@ -36,11 +58,17 @@ def ensure_database_schema_created(dbconn):
 
     schema = """
              CREATE TABLE IF NOT EXISTS oeis_entries (
-                 oeis_id       INTEGER  PRIMARY KEY NOT NULL, -- OEIS ID number.
-                 t1            REAL                 NOT NULL, -- earliest timestamp when the content below was first fetched.
-                 t2            REAL                 NOT NULL, -- most recent timestamp when the content below was fetched.
-                 main_content  TEXT                 NOT NULL, -- main content (i.e., lines starting with '%' sign).
-                 bfile_content TEXT                 NOT NULL  -- b-file content (secondary file containing sequence entries).
+                 oeis_id             INTEGER  PRIMARY KEY NOT NULL, -- OEIS ID number.
+                 t1                  REAL                 NOT NULL, -- earliest timestamp when the content below was first fetched.
+                 t2                  REAL                 NOT NULL, -- most recent timestamp when the content below was fetched.
+                 main_content        TEXT                 NOT NULL, -- main content (i.e., lines starting with '%' sign); see 'make_content_encoder'.
+                 bfile_content       TEXT                 NOT NULL, -- b-file content (secondary file containing sequence entries); idem.
+                 main_digest         BLOB                         , -- digest of the main content (see 'content_digest').
+                 bfile_digest        BLOB                         , -- digest of the b-file content (see 'content_digest').
+                 bfile_etag          TEXT                         , -- 'ETag' header of the b-file response ("" if absent; NULL if unknown).
+                 bfile_last_modified TEXT                         , -- 'Last-Modified' header of the b-file response ("" if absent; NULL if unknown).
+                 source              TEXT                         , -- NULL if fetched from the server; 'dump' if ingested from dump files (see 'ingest_oeis_dump.py').
+                 bfile_truncated     INTEGER                        -- 1 if the b-file exceeded the size cap, and was truncated at a line boundary; NULL otherwise.
              );
              """
 
@@ -52,239 +80,1147 @@ def ensure_database_schema_created(dbconn):
 
     dbconn.execute(schema)
 
-def find_highest_oeis_id():
-    """Find the highest entry ID in the remote OEIS database by performing HTTP queries and doing a binary search."""
+    # Databases created before the digest, b-file validator, source, and truncation columns were introduced get them added here.
 
-    SLEEP_AFTER_FAILURE = 5.0
+    columns = [column_name for (cid, column_name, column_type, notnull, default_value, pk) in dbconn.execute("PRAGMA table_info(oeis_entries);")]
 
-    success_id =  263000 # We know a-priori that this entry exists.
-    failure_id = 1000000 # We know a-priori that this entry does not exist.
+    for (column_name, column_type) in [("main_digest", "BLOB"), ("bfile_digest", "BLOB"), ("bfile_etag", "TEXT"), ("bfile_last_modified", "TEXT"), ("source", "TEXT"), ("bfile_truncated", "INTEGER")]:
+        if column_name not in columns:
+            logger.info("Adding column '{}' to table 'oeis_entries' ...".format(column_name))
+            dbconn.execute("ALTER TABLE oeis_entries ADD COLUMN {} {};".format(column_name, column_type))
 
-    # Do a binary search, looking for the success/failure boundary.
-    while success_id + 1 != failure_id:
+    # The digest columns are stored after the (potentially very large) content columns.
+    # A covering index allows us to look up the digests without reading the content columns at all.
 
-        fetch_id = (success_id + failure_id) // 2
+    dbconn.execute("CREATE INDEX IF NOT EXISTS oeis_entries_digests ON oeis_entries(oeis_id, main_digest, bfile_digest);")
 
-        logger.info("OEIS search range is ({}, {}), attempting to fetch entry {} ...".format(success_id, failure_id, fetch_id))
+    # A partial index on the entries that have been fetched only once, see 'update_database_entries_for_nonzero_time_window'.
 
-        try:
-            fetch_remote_oeis_entry(fetch_id, fetch_bfile_flag = False)
-        except BadOeisResponse:
-            # This exception happens when trying to read beyond the last entry in the database.
-            # We mark the failure and continue the binary search.
-            logging.info("OEIS entry {} does not exist.".format(fetch_id))
-            failure_id = fetch_id
-        except BaseException as exception:
-            # Some other error occurred. We have to retry.
-            logger.error("Unexpected fetch result ({}), retrying in {} seconds.".format(exception, SLEEP_AFTER_FAILURE))
-            time.sleep(SLEEP_AFTER_FAILURE)
-        else:
-            # We mark the success and continue the binary search.
-            logging.info("OEIS entry {} exists.".format(fetch_id))
-            success_id = fetch_id
+    dbconn.execute("CREATE INDEX IF NOT EXISTS oeis_entries_zero_time_window ON oeis_entries(oeis_id) WHERE t1 = t2;")
+
+    # A partial index on the entries that were ingested from dump files, so they can be recognized without reading the content columns.
+
+    dbconn.execute("CREATE INDEX IF NOT EXISTS oeis_entries_ingested ON oeis_entries(oeis_id, source) WHERE source IS NOT NULL;")
+
+    # The refresh queue holds, for each entry, the time at which it is due for a refresh.
+    # It is maintained by 'process_responses'; see 'ensure_refresh_queue_populated'.
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS refresh_queue (
+                 oeis_id       INTEGER  PRIMARY KEY NOT NULL, -- OEIS ID number.
+                 next_due      REAL                 NOT NULL  -- timestamp when the entry is due for a refresh; 0 if it was never fetched.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+    dbconn.execute("CREATE INDEX IF NOT EXISTS refresh_queue_next_due ON refresh_queue(next_due);")
+
+    # The change statistics are used to estimate the change rate of each entry; see 'refresh_scheduler.py'.
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS change_statistics (
+                 oeis_id       INTEGER  PRIMARY KEY NOT NULL, -- OEIS ID number.
+                 change_count  INTEGER              NOT NULL, -- number of fetches that found changed content.
+                 observed_time REAL                 NOT NULL  -- total time [seconds] between consecutive fetches.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+    # The fetch log records the outcome of every fetch. It is the input of 'simulate_refresh_policy.py'.
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS fetch_log (
+                 oeis_id       INTEGER              NOT NULL, -- OEIS ID number.
+                 timestamp     REAL                 NOT NULL, -- timestamp of the fetch.
+                 status        INTEGER              NOT NULL  -- 0: new entry, 1: identical content, 2: updated content.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+    # Miscellaneous crawler state that must survive a restart; see 'get_crawler_state' and 'set_crawler_state'.
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS crawler_state (
+                 name          TEXT     PRIMARY KEY NOT NULL, -- name of the state variable.
+                 value                                        -- value of the state variable.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+    # The dictionaries used for compressed content storage; see 'content_compression.py'.
+
+    ensure_content_dictionaries_table(dbconn)
+
+    # The crawler's telemetry, exported periodically; see 'crawler_metrics.py'.
+
+    ensure_metrics_table_created(dbconn)
+
+    # The superseded versions of the entries, and the change log; see 'oeis_revisions.py'.
+
+    ensure_revisions_table_created(dbconn)
+
+    dbconn.commit()
+
+def get_crawler_state(dbconn, name, default_value = None):
+    """Get the value of a crawler state variable, or 'default_value' if it has not been set."""
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+        dbcursor.execute("SELECT value FROM crawler_state WHERE name = ?;", (name, ))
+        rows = dbcursor.fetchall()
+
+    return default_value if len(rows) == 0 else rows[0][0]
+
+def set_crawler_state(dbconn, name, value):
+    """Set the value of a crawler state variable."""
+
+    dbconn.execute("INSERT INTO crawler_state(name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value;", (name, value))
+    dbconn.commit()
+
+# The content storage mode is either "text" (the default) or "compressed"; see 'content_compression.py'.
+# It is recorded in the 'crawler_state' table, and changed by 'migrate_database_storage.py'.
+
+CONTENT_STORAGE_TEXT       = "text"
+CONTENT_STORAGE_COMPRESSED = "compressed"
+
+def make_content_encoder(dbconn):
+    """Return a ContentEncoder if the database uses compressed content storage, or None if it stores plain text."""
+
+    if get_crawler_state(dbconn, "content_storage", CONTENT_STORAGE_TEXT) == CONTENT_STORAGE_TEXT:
+        return None
+
+    return ContentEncoder(dbconn)
+
+def content_digest(content):
+    """Return a compact digest of a main content or b-file content string, used to detect changed content."""
+    return hashlib.blake2b(content.encode("utf-8"), digest_size = 16).digest()
+
+def ensure_content_digests_present(dbconn):
+    """Calculate the digests for all entries that do not have them yet.
+
+    This is a one-time backfill for databases that were created before the digest columns were introduced.
+    It reads the content of all entries once; afterwards, the digests are maintained by 'process_responses'.
+    """
+
+    BATCH_SIZE = 1000
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+        dbcursor.execute("SELECT oeis_id FROM oeis_entries INDEXED BY oeis_entries_digests WHERE main_digest IS NULL OR bfile_digest IS NULL LIMIT 1;")
+        if len(dbcursor.fetchall()) == 0:
+            return # all digests are present.
+
+    with start_timer() as timer:
+
+        logger.info("Calculating content digests for existing entries ...")
+
+        count = 0
+        last_oeis_id = 0
+
+        while True:
+
+            with close_when_done(dbconn.cursor()) as dbcursor:
+                query = "SELECT oeis_id, main_content, bfile_content FROM oeis_entries WHERE oeis_id > ? AND (main_digest IS NULL OR bfile_digest IS NULL) ORDER BY oeis_id LIMIT ?;"
+                dbcursor.execute(query, (last_oeis_id, BATCH_SIZE))
+                oeis_entries = dbcursor.fetchall()
+
+            if len(oeis_entries) == 0:
+                break
+
+            logger.log(logging.PROGRESS, "Calculating content digests for entries A{:06} to A{:06} ...".format(oeis_entries[0][0], oeis_entries[-1][0]))
+
+            query = "UPDATE oeis_entries SET main_digest = ?, bfile_digest = ? WHERE oeis_id = ?;"
+            dbconn.executemany(query, ((content_digest(decode_content(main_content)), content_digest(decode_content(bfile_content)), oeis_id) for (oeis_id, main_content, bfile_content) in oeis_entries))
+            dbconn.commit()
+
+            count += len(oeis_entries)
+            last_oeis_id = oeis_entries[-1][0]
+
+        logger.info("Calculated content digests for {} entries in {}.".format(count, timer.duration_string()))
+
+def probe_remote_oeis_entry(oeis_id, base_url = None):
+    """Check if an entry exists in the remote OEIS database.
+
+    Returns True if the entry exists, False if it does not exist, and None if the check failed for some other reason.
+    """
+
+    try:
+        fetch_remote_oeis_entry(oeis_id, False, base_url)
+    except BadOeisResponse:
+        # This exception happens when trying to read beyond the last entry in the database.
+        return False
+    except BaseException as exception:
+        logger.error("Unexpected fetch result for entry {} ({}).".format(oeis_id, exception))
+        return None
+    else:
+        return True
+
+highest_oeis_id_cache = {} # base_url -> (timestamp, highest_oeis_id)
+
+def find_highest_oeis_id(dbconn = None, base_url = None):
+    """Find the highest entry ID in the remote OEIS database by performing HTTP queries.
+
+    The search starts from the highest entry ID in the local database, if available; that entry is known to exist.
+    Each round, several candidate IDs are probed in parallel:
+
+    - As long as no non-existing entry is known, we gallop upwards: the candidates are at exponentially increasing
+      distances from the highest known entry, and the distances grow from one round to the next.
+    - Once the success/failure boundary is bracketed, the bracket is divided into equal parts (a k-ary search).
+
+    Since the local database is usually only a few entries behind, this takes one or two rounds.
+
+    The result is cached for an hour, so update cycles that follow each other quickly do not repeat the search.
+    """
+
+    SLEEP_AFTER_FAILURE =    5.0 # [seconds]
+    PROBES_PER_ROUND    =      8
+    CACHE_TTL           = 3600.0 # [seconds]
+
+    t_current = time.time()
+
+    if base_url in highest_oeis_id_cache:
+        (timestamp, highest_oeis_id) = highest_oeis_id_cache[base_url]
+        if t_current - timestamp < CACHE_TTL:
+            logger.info("Last valid OEIS entry is A{:06} (cached).".format(highest_oeis_id))
+            return highest_oeis_id
+
+    success_id = 263000 # We know a-priori that this entry exists.
+    failure_id = None   # No entry is known not to exist yet.
+
+    if dbconn is not None:
+        with close_when_done(dbconn.cursor()) as dbcursor:
+            dbcursor.execute("SELECT MAX(oeis_id) FROM oeis_entries;")
+            (local_highest_oeis_id, ) = dbcursor.fetchone()
+        if local_highest_oeis_id is not None:
+            success_id = max(success_id, local_highest_oeis_id)
+
+    gallop_step = 1
+
+    with concurrent.futures.ThreadPoolExecutor(PROBES_PER_ROUND) as executor:
+
+        while failure_id is None or success_id + 1 != failure_id:
+
+            if failure_id is None:
+                candidates = [success_id + gallop_step * 2 ** i for i in range(PROBES_PER_ROUND)]
+            else:
+                gap = failure_id - success_id
+                count = min(PROBES_PER_ROUND, gap - 1)
+                candidates = sorted(set(success_id + (gap * i) // (count + 1) for i in range(1, count + 1)))
+
+            logger.info("OEIS search range is ({}, {}), attempting to fetch entries {} ...".format(success_id, "?" if failure_id is None else failure_id, ", ".join(str(candidate) for candidate in candidates)))
+
+            results = list(executor.map(lambda candidate: probe_remote_oeis_entry(candidate, base_url), candidates))
+
+            # We mark the successes and failures and continue the search.
+
+            for (candidate, exists) in zip(candidates, results):
+                if exists is True and (failure_id is None or candidate < failure_id):
+                    success_id = max(success_id, candidate)
+                elif exists is False and candidate > success_id:
+                    failure_id = candidate if failure_id is None else min(failure_id, candidate)
+
+            if failure_id is None:
+                gallop_step *= 2 ** PROBES_PER_ROUND
+
+            if None in results:
+                # Some other error occurred. We have to retry.
+                logger.error("Unexpected fetch results, retrying in {} seconds.".format(SLEEP_AFTER_FAILURE))
+                time.sleep(SLEEP_AFTER_FAILURE)
 
     logger.info("Last valid OEIS entry is A{:06}.".format(success_id))
 
+    highest_oeis_id_cache[base_url] = (t_current, success_id)
+
     return success_id
 
-def safe_fetch_remote_oeis_entry(entry):
-    """Fetch a single OEIS entry from the remote OEIS database, and swallow any exceptions.
+def safe_fetch(fetch, description, base_url = None, controller = None):
+    """Perform a single request to the remote OEIS database by calling 'fetch()', and swallow any exceptions.
 
-    If no issues are encountered, this function is identical to the 'fetch_remote_oeis_entry' function.
     In case of an exception, a log message is generated and 'None' is returned.
 
-    The purpose of this function in to be used in a "map", where we want to inhibit exceptions.
+    If a controller is given, the request is paced by it, and its outcome and latency are reported to it.
     """
 
+    host = oeis_host(base_url)
+
+    if controller is not None:
+        delay = controller.delay_before_request(host)
+        if delay > 0.0:
+            time.sleep(delay)
+
+    t_start = time.monotonic()
+
     # Intercepts and reports any exceptions.
     # In case of an exception, a log message is generated, and None is returned.
     try:
-        result = fetch_remote_oeis_entry(entry, True)
+        result = fetch()
     except BaseException as exception:
-        logger.error("Unable to fetch entry {}: '{}'.".format(entry, exception))
+        logger.error("Unable to fetch {}: '{}'.".format(description, exception))
         result = None
+        if controller is not None:
+            controller.record(host, time.monotonic() - t_start, exception)
+    else:
+        if controller is not None:
+            controller.record(host, time.monotonic() - t_start)
     return result
 
+def safe_fetch_remote_oeis_entry(entry, base_url = None, controller = None):
+    """Fetch the main content of a single OEIS entry from the remote OEIS database, and swallow any exceptions.
+
+    If no issues are encountered, this function is identical to the 'fetch_remote_oeis_entry' function (without b-file).
+    In case of an exception, a log message is generated and 'None' is returned.
+
+    The purpose of this function in to be used in a "map", where we want to inhibit exceptions.
+    """
+    return safe_fetch(lambda: fetch_remote_oeis_entry(entry, False, base_url), "entry {}".format(entry), base_url, controller)
+
+def safe_fetch_remote_oeis_bfile(request, base_url = None, controller = None):
+    """Fetch the b-file of a single OEIS entry, given an (oeis_id, etag, last_modified) request, and swallow any exceptions.
+
+    If no issues are encountered, this function is identical to the 'fetch_remote_oeis_bfile' function.
+    In case of an exception, a log message is generated and 'None' is returned.
+    """
+    (oeis_id, etag, last_modified) = request
+    return safe_fetch(lambda: fetch_remote_oeis_bfile(oeis_id, etag, last_modified, base_url), "b-file of entry {}".format(oeis_id), base_url, controller)
+
+class ThreadPoolFetcher:
+    """Fetch OEIS entries using a pool of worker threads, in batches ('fetch_batch', 'fetch_bfiles') or one by one ('submit_entry', 'submit_bfile').
+
+    Each fetch opens a fresh connection to the server. This is the original (and default) fetch backend.
+
+    The number of fetches in flight, and the pace at which they are started, are set by an AdaptiveController.
+    The batch size follows the controller's concurrency.
+    """
+
+    BATCH_SIZE_PER_SLOT = 25
+    MIN_BATCH_SIZE      = 100
+
+    @staticmethod
+    def default_controller():
+        return AdaptiveController(initial_concurrency = 20, max_concurrency = 64)
+
+    def __init__(self, base_url = None, controller = None):
+        if controller is None:
+            controller = self.default_controller()
+        self.base_url   = base_url
+        self.controller = controller
+        self._executor  = None
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def __str__(self):
+        return "{} of {} worker threads".format(self.controller.concurrency, self.controller.max_concurrency)
+
+    @property
+    def batch_size(self):
+        return max(self.MIN_BATCH_SIZE, self.BATCH_SIZE_PER_SLOT * self.controller.concurrency)
+
+    def __enter__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.controller.max_concurrency)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown()
+        self._executor = None
+
+    def _gated(self, safe_fetch_function, argument):
+
+        # Wait until the number of fetches in flight is below the controller's current concurrency.
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.controller.concurrency)
+            self._in_flight += 1
+
+        try:
+            return safe_fetch_function(argument, self.base_url, self.controller)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def fetch_batch(self, entries):
+        """Fetch the main content of the given entries. The b-files are fetched separately, see 'fetch_bfiles'."""
+        return list(self._executor.map(lambda entry: self._gated(safe_fetch_remote_oeis_entry, entry), entries))
+
+    def fetch_bfiles(self, requests):
+        """Fetch b-files, given a list of (oeis_id, etag, last_modified) requests. Returns a list of BfileFetchResult instances or None."""
+        return list(self._executor.map(lambda request: self._gated(safe_fetch_remote_oeis_bfile, request), requests))
+
+    def _submit(self, safe_fetch_function, argument, callback):
+        future = self._executor.submit(self._gated, safe_fetch_function, argument)
+        future.add_done_callback(lambda future: callback(future.result()))
+
+    def submit_entry(self, oeis_id, callback):
+        """Start fetching the main content of an entry. The result (a FetchResult or None) is passed to 'callback', on a worker thread."""
+        self._submit(safe_fetch_remote_oeis_entry, oeis_id, callback)
+
+    def submit_bfile(self, request, callback):
+        """Start fetching a b-file, given an (oeis_id, etag, last_modified) request. The result (a BfileFetchResult or None) is passed to 'callback', on a worker thread."""
+        self._submit(safe_fetch_remote_oeis_bfile, request, callback)
+
+FETCH_BACKENDS = {
+    "threads" : ThreadPoolFetcher,
+    "asyncio" : AsyncioFetcher
+}
+
+def make_fetcher(fetch_backend, base_url = None, controller = None):
+    """Make a fetcher for the given backend name. The fetcher must be used as a context manager.
+
+    If no controller is given, a controller with defaults suitable for the backend is made.
+    """
+    return FETCH_BACKENDS[fetch_backend](base_url = base_url, controller = controller)
+
+def make_controller(fetch_backend):
+    """Make an AdaptiveController with defaults suitable for the given backend name."""
+    return FETCH_BACKENDS[fetch_backend].default_controller()
+
+# The refresh queue orders entries by the time at which their staleness probability reaches
+# refresh_scheduler.STALENESS_THRESHOLD (see 'next_due_time'). Entries that were never fetched have next_due = NEVER_FETCHED.
+
+NEVER_FETCHED = 0.0
+
+def ensure_change_statistics_present(dbconn):
+    """Initialize the change statistics for entries that do not have them yet.
+
+    This is a one-time migration for databases that were created before the change statistics were introduced.
+    All we know about these entries is their current (t1, t2) window: no change was seen during that time.
+    The refresh queue is rescheduled accordingly.
+    """
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+
+        dbcursor.execute("SELECT oeis_id FROM change_statistics LIMIT 1;")
+        if len(dbcursor.fetchall()) != 0:
+            return # change statistics are present.
+
+        dbcursor.execute("SELECT oeis_id FROM oeis_entries LIMIT 1;")
+        if len(dbcursor.fetchall()) == 0:
+            return # empty database.
+
+        with start_timer() as timer:
+
+            logger.info("Initializing change statistics for existing entries ...")
+
+            dbcursor.execute("INSERT INTO change_statistics(oeis_id, change_count, observed_time) SELECT oeis_id, 0, t2 - t1 FROM oeis_entries;")
+
+            query = """
+                    UPDATE refresh_queue SET next_due = (
+                        SELECT next_due_time(e.t2, c.change_count, c.observed_time) FROM oeis_entries AS e, change_statistics AS c
+                        WHERE e.oeis_id = refresh_queue.oeis_id AND c.oeis_id = refresh_queue.oeis_id
+                    ) WHERE next_due > ?;
+                    """
+            dbcursor.execute(query, (NEVER_FETCHED, ))
+
+            logger.info("Initializing change statistics took {}.".format(timer.duration_string()))
+
+    dbconn.commit()
+
+def ensure_refresh_queue_populated(dbconn, highest_oeis_id):
+    """Make sure that the refresh queue has an entry for each OEIS ID up to and including 'highest_oeis_id'.
+
+    On the first run with an existing database, the queue is populated from the 'oeis_entries' table (once).
+    After that, only IDs beyond the highest ID already in the queue are added, as never-fetched entries.
+    """
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+
+        dbcursor.execute("SELECT MAX(oeis_id) FROM refresh_queue;")
+        (highest_queued_oeis_id, ) = dbcursor.fetchone()
+
+        if highest_queued_oeis_id is None:
+            logger.info("Populating refresh queue from local database ...")
+            query = """
+                    INSERT OR IGNORE INTO refresh_queue(oeis_id, next_due)
+                        SELECT e.oeis_id, next_due_time(e.t2, coalesce(c.change_count, 0), coalesce(c.observed_time, e.t2 - e.t1))
+                        FROM oeis_entries AS e LEFT JOIN change_statistics AS c ON c.oeis_id = e.oeis_id WHERE true;
+                    """
+            dbcursor.execute(query)
+            highest_queued_oeis_id = 0
+
+        if highest_queued_oeis_id < highest_oeis_id:
+            query = "INSERT OR IGNORE INTO refresh_queue(oeis_id, next_due) VALUES (?, ?);"
+            dbcursor.executemany(query, ((oeis_id, NEVER_FETCHED) for oeis_id in range(highest_queued_oeis_id + 1, highest_oeis_id + 1)))
+
+    dbconn.commit()
+
+def configure_database_connection(dbconn):
+    """Configure a connection to the crawler database.
+
+    We use write-ahead logging: commits are cheap, and readers (e.g., a consolidation in progress) do not block the crawler.
+    In WAL mode, synchronous = NORMAL is safe against corruption; at worst, the most recent batches are lost on power failure.
+
+    The 'next_due_time' function of the refresh scheduler is made available to SQL statements.
+    """
+
+    dbconn.execute("PRAGMA journal_mode = WAL;")
+    dbconn.execute("PRAGMA synchronous = NORMAL;")
+
+    # The refresh schedule is calculated in SQL statements; see 'refresh_scheduler.py'.
+
+    dbconn.create_function("next_due_time", 3, next_due_time, deterministic = True)
+
 def process_responses(dbconn, responses):
     """Process a batch of responses by updating the local SQLite database.
 
     A logging message is produced that summarizes how the batch of responses was processed.
     This function returns a set of OEIS IDs that have been succesfully processed.
+
+    Changes are detected by comparing content digests rather than the content itself,
+    so the (potentially very large) content columns are never read back from the database.
+
+    A response without a b-file download (see 'bfile_requests_for_responses') keeps the b-file that is in the database.
+    Such responses are only made for entries that are already present in the database.
+
+    In plain text storage mode, the b-files are never read into memory as a whole: they are written piece by piece
+    from their BfileDownload into a BLOB ('blobopen'), which is converted to TEXT when it is copied into 'oeis_entries'.
+    In compressed storage mode, a b-file has to be read completely to be encoded.
+    The b-file downloads are closed when the responses have been processed.
+
+    The batch is written in bulk, inside a single transaction:
+
+    - All responses are staged into a temporary table with a single 'executemany'.
+    - Each staged response is classified as new, identical, or updated by comparing digests with the 'oeis_entries' table.
+      Entries that were ingested from dump files (see 'ingest_oeis_dump.py') are classified as new: their first fetch
+      replaces the ingested content, and is not an observation of change.
+    - New and updated entries are recorded in the change log, and the versions that the updated entries supersede
+      are kept as deltas (see 'oeis_revisions.py').
+    - New and updated entries are written with a single INSERT ... ON CONFLICT DO UPDATE statement.
+    - Identical entries just get their t2 timestamp bumped, with a single UPDATE statement.
+    - The change statistics of all processed entries are updated, and their fetches are appended to the fetch log.
+    - The refresh queue is updated for all processed entries, with a single INSERT ... ON CONFLICT DO UPDATE statement.
+
+    The outcome counts and the duration of the transaction are recorded in 'crawler_metrics'.
     """
 
-    countFailures         = 0
-    countNewEntries       = 0
-    countIdenticalEntries = 0
-    countUpdatedEntries   = 0
+    STATUS_NEW       = 0
+    STATUS_IDENTICAL = 1
+    STATUS_UPDATED   = 2
+
+    # Skip entries that are not okay.
+    # Do not record the failures in the processed_entries set.
+
+    countFailures = sum(response is None for response in responses)
+
+    responses = [response for response in responses if response is not None]
+
+    # In compressed storage mode, the content is stored as compressed BLOBs. The digests are those of the text.
+
+    encoder = make_content_encoder(dbconn)
+
+    stream_bfiles = encoder is None and hasattr(dbconn, "blobopen")
+
+    def staged_bfile_content(bfile_download):
+        if bfile_download is None or stream_bfiles:
+            return None # Streamed into a zero-filled BLOB of the right size, see below.
+        if encoder is None:
+            return bfile_download.read()
+        return encoder.encode_bfile_content(bfile_download.text())
 
-    processed_entries = set()
+    staged_rows = [(response.oeis_id, response.timestamp,
+                    response.main_content if encoder is None else encoder.encode_main_content(response.main_content),
+                    staged_bfile_content(response.bfile_download),
+                    None if response.bfile_download is None else response.bfile_download.size,
+                    content_digest(response.main_content),
+                    None if response.bfile_download is None else response.bfile_download.digest,
+                    response.bfile_etag, response.bfile_last_modified,
+                    1 if response.bfile_download is not None and response.bfile_download.truncated else None) for response in responses]
+
+    schema = """
+             CREATE TEMPORARY TABLE IF NOT EXISTS staged_responses (
+                 oeis_id             INTEGER  PRIMARY KEY NOT NULL,
+                 timestamp           REAL                 NOT NULL,
+                 main_content        TEXT                 NOT NULL, -- plain text, or a compressed BLOB; see 'make_content_encoder'.
+                 bfile_content       BLOB                         , -- UTF-8 text, or a compressed BLOB; NULL if the b-file was not fetched, or did not change.
+                 bfile_size          INTEGER                      , -- size of the UTF-8 text of the b-file; NULL if it was not fetched, or did not change.
+                 main_digest         BLOB                 NOT NULL,
+                 bfile_digest        BLOB                         ,
+                 bfile_etag          TEXT                         ,
+                 bfile_last_modified TEXT                         ,
+                 bfile_truncated     INTEGER                      ,
+                 status              INTEGER                      , -- one of STATUS_NEW, STATUS_IDENTICAL, STATUS_UPDATED.
+                 previous_t2         REAL                           -- t2 of the entry before this fetch; NULL for new entries.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
 
     with close_when_done(dbconn.cursor()) as dbcursor:
 
-        for response in responses:
-
-            if response is None:
-                # Skip entries that are not okay.
-                # Do not record the failures in the processed_entries set.
-                countFailures += 1
-                continue
-
-            query = "SELECT main_content, bfile_content FROM oeis_entries WHERE oeis_id = ?;"
-            dbcursor.execute(query, (response.oeis_id, ))
-
-            previous_content = dbcursor.fetchall()
-
-            assert len(previous_content) <= 1
-            previous_content = None if len(previous_content) == 0 else previous_content[0]
-
-            if previous_content is None:
-                # The oeis_id does not occur in the database yet.
-                # We will insert it as a new entry.
-                query = "INSERT INTO oeis_entries(oeis_id, t1, t2, main_content, bfile_content) VALUES (?, ?, ?, ?, ?);"
-                dbcursor.execute(query, (response.oeis_id, response.timestamp, response.timestamp, response.main_content, response.bfile_content))
-                countNewEntries += 1
-            elif previous_content != (response.main_content, response.bfile_content):
-                # The database content is stale.
-                # Update t1, t2, and content.
-                query = "UPDATE oeis_entries SET t1 = ?, t2 = ?, main_content = ?, bfile_content = ? WHERE oeis_id = ?;"
-                dbcursor.execute(query, (response.timestamp, response.timestamp, response.main_content, response.bfile_content, response.oeis_id))
-                countUpdatedEntries += 1
-            else:
-                # The database content is identical to the freshly fetched content.
-                # We will just update the t2 field, indicating the fresh fetch.
-                query = "UPDATE oeis_entries SET t2 = ? WHERE oeis_id = ?;"
-                dbcursor.execute(query, (response.timestamp, response.oeis_id))
-                countIdenticalEntries += 1
+        dbcursor.execute(schema)
 
-            processed_entries.add(response.oeis_id)
+        t_start = time.monotonic()
+
+        try:
+            dbcursor.execute("DELETE FROM temp.staged_responses;") # This starts the transaction.
+
+            query = "INSERT OR REPLACE INTO temp.staged_responses(oeis_id, timestamp, main_content, bfile_content, bfile_size, main_digest, bfile_digest, bfile_etag, bfile_last_modified, bfile_truncated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+            dbcursor.executemany(query, staged_rows)
+
+            # Stream the b-files into their staged BLOBs.
+
+            if stream_bfiles:
+
+                dbcursor.execute("UPDATE temp.staged_responses SET bfile_content = zeroblob(bfile_size) WHERE bfile_content IS NULL AND bfile_size IS NOT NULL;")
+
+                for response in dict((response.oeis_id, response) for response in responses).values():
+                    if response.bfile_download is not None:
+                        with dbconn.blobopen("staged_responses", "bfile_content", response.oeis_id, name = "temp") as blob:
+                            for data in response.bfile_download.chunks():
+                                blob.write(data)
+
+            # Responses without b-file content keep the b-file that is in the database.
+
+            query = """
+                    UPDATE temp.staged_responses SET bfile_digest = (
+                        SELECT e.bfile_digest FROM main.oeis_entries AS e INDEXED BY oeis_entries_digests WHERE e.oeis_id = staged_responses.oeis_id
+                    ) WHERE bfile_content IS NULL;
+                    """
+            dbcursor.execute(query)
+
+            # Classify the staged responses. Entries that do not occur in the database yet, or that were ingested from dump files, are new.
+
+            query = """
+                    UPDATE temp.staged_responses SET status = coalesce((
+                        SELECT CASE WHEN e.main_digest IS staged_responses.main_digest AND e.bfile_digest IS staged_responses.bfile_digest THEN ? ELSE ? END
+                        FROM main.oeis_entries AS e INDEXED BY oeis_entries_digests WHERE e.oeis_id = staged_responses.oeis_id
+                    ), ?), previous_t2 = (
+                        SELECT e.t2 FROM main.oeis_entries AS e WHERE e.oeis_id = staged_responses.oeis_id
+                    );
+                    """
+            dbcursor.execute(query, (STATUS_IDENTICAL, STATUS_UPDATED, STATUS_NEW))
+
+            query = """
+                    UPDATE temp.staged_responses SET status = ?, previous_t2 = NULL WHERE status != ? AND EXISTS (
+                        SELECT 1 FROM main.oeis_entries AS e INDEXED BY oeis_entries_ingested WHERE e.oeis_id = staged_responses.oeis_id AND e.source IS NOT NULL
+                    );
+                    """
+            dbcursor.execute(query, (STATUS_NEW, STATUS_NEW))
+
+            dbcursor.execute("SELECT status, COUNT(*) FROM temp.staged_responses GROUP BY status;")
+            status_counts = dict(dbcursor.fetchall())
+
+            # Record the changes in the change log, and keep the versions that are about to be superseded.
+
+            record_revisions(dbcursor, dict((response.oeis_id, (response.main_content, response.bfile_download)) for response in responses), STATUS_NEW, STATUS_UPDATED)
+
+            # New entries are inserted; stale entries get new t1, t2, and content.
+            # In plain text storage mode, the staged UTF-8 BLOBs of the b-files are stored as TEXT.
+
+            query = """
+                    INSERT INTO main.oeis_entries(oeis_id, t1, t2, main_content, bfile_content, main_digest, bfile_digest, bfile_etag, bfile_last_modified, bfile_truncated)
+                        SELECT oeis_id, timestamp, timestamp, main_content, CASE WHEN ? THEN CAST(bfile_content AS TEXT) ELSE bfile_content END,
+                            main_digest, bfile_digest, bfile_etag, bfile_last_modified, bfile_truncated
+                        FROM temp.staged_responses WHERE status != ? AND bfile_content IS NOT NULL
+                    ON CONFLICT(oeis_id) DO UPDATE SET
+                        t1 = excluded.t1, t2 = excluded.t2, main_content = excluded.main_content, bfile_content = excluded.bfile_content,
+                        main_digest = excluded.main_digest, bfile_digest = excluded.bfile_digest,
+                        bfile_etag = excluded.bfile_etag, bfile_last_modified = excluded.bfile_last_modified, source = NULL,
+                        bfile_truncated = excluded.bfile_truncated;
+                    """
+            dbcursor.execute(query, (encoder is None, STATUS_IDENTICAL))
+
+            # Stale entries of which only the main content changed keep their b-file.
+
+            query = """
+                    UPDATE main.oeis_entries SET (t1, t2, main_content, main_digest) = (
+                        SELECT timestamp, timestamp, main_content, main_digest FROM temp.staged_responses AS s WHERE s.oeis_id = oeis_entries.oeis_id
+                    ) WHERE oeis_id IN (SELECT oeis_id FROM temp.staged_responses WHERE status = ? AND bfile_content IS NULL);
+                    """
+            dbcursor.execute(query, (STATUS_UPDATED, ))
+
+            # The database content of the identical entries is identical to the freshly fetched content.
+            # We will just update the t2 field, indicating the fresh fetch, and the b-file validators if the b-file was fetched.
+
+            query = """
+                    UPDATE main.oeis_entries SET (t2, bfile_etag, bfile_last_modified) = (
+                        SELECT timestamp, coalesce(s.bfile_etag, oeis_entries.bfile_etag), coalesce(s.bfile_last_modified, oeis_entries.bfile_last_modified)
+                        FROM temp.staged_responses AS s WHERE s.oeis_id = oeis_entries.oeis_id
+                    ) WHERE oeis_id IN (SELECT oeis_id FROM temp.staged_responses WHERE status = ?);
+                    """
+            dbcursor.execute(query, (STATUS_IDENTICAL, ))
+
+            # Update the change statistics. The time since the previous fetch is added to the observed time,
+            # and the change count is incremented if the content was updated.
+
+            query = """
+                    INSERT INTO main.change_statistics(oeis_id, change_count, observed_time)
+                        SELECT oeis_id, status = ?, coalesce(max(timestamp - previous_t2, 0.0), 0.0) FROM temp.staged_responses WHERE true
+                    ON CONFLICT(oeis_id) DO UPDATE SET
+                        change_count = change_count + excluded.change_count, observed_time = observed_time + excluded.observed_time;
+                    """
+            dbcursor.execute(query, (STATUS_UPDATED, ))
+
+            dbcursor.execute("INSERT INTO main.fetch_log(oeis_id, timestamp, status) SELECT oeis_id, timestamp, status FROM temp.staged_responses;")
+
+            # Reschedule the processed entries in the refresh queue.
+
+            query = """
+                    INSERT INTO main.refresh_queue(oeis_id, next_due)
+                        SELECT e.oeis_id, next_due_time(e.t2, c.change_count, c.observed_time) FROM main.oeis_entries AS e, main.change_statistics AS c
+                        WHERE e.oeis_id IN (SELECT oeis_id FROM temp.staged_responses) AND c.oeis_id = e.oeis_id
+                    ON CONFLICT(oeis_id) DO UPDATE SET next_due = excluded.next_due;
+                    """
+            dbcursor.execute(query)
+
+            dbcursor.execute("DELETE FROM temp.staged_responses;")
+
+        except BaseException:
+            dbconn.rollback()
+            raise
 
     dbconn.commit()
 
-    logger.info("Processed {} responses (failures: {}, new: {}, identical: {}, updated: {}).".format(len(responses), countFailures, countNewEntries, countIdenticalEntries, countUpdatedEntries))
+    crawler_metrics.record_commit(time.monotonic() - t_start)
+
+    for response in responses:
+        if response.bfile_download is not None:
+            response.bfile_download.close()
+
+    countNewEntries       = status_counts.get(STATUS_NEW      , 0)
+    countIdenticalEntries = status_counts.get(STATUS_IDENTICAL, 0)
+    countUpdatedEntries   = status_counts.get(STATUS_UPDATED  , 0)
+
+    crawler_metrics.record_entries("new"      , countNewEntries)
+    crawler_metrics.record_entries("identical", countIdenticalEntries)
+    crawler_metrics.record_entries("updated"  , countUpdatedEntries)
+    crawler_metrics.record_entries("failed"   , countFailures)
+
+    processed_entries = set(response.oeis_id for response in responses)
+
+    logger.info("Processed {} responses (failures: {}, new: {}, identical: {}, updated: {}).".format(len(responses) + countFailures, countFailures, countNewEntries, countIdenticalEntries, countUpdatedEntries))
 
     return processed_entries
 
-def fetch_entries_into_database(dbconn, entries):
+def bfile_requests_for_responses(dbconn, responses):
+    """Decide which b-files to fetch for a number of main-content responses, fetching only those that may have changed.
+
+    b-files are by far the largest part of an entry. For each response, the b-file is:
+
+    - fetched unconditionally if the entry is new, or if the '%H' line that links to the b-file changed;
+    - fetched with a conditional request (If-None-Match / If-Modified-Since) if the main content changed otherwise,
+      or if the main content is unchanged and we know the validators of the b-file in the database;
+    - fetched unconditionally if the main content is unchanged and the validators of the b-file in the database are unknown
+      (this happens once for entries fetched before validators were recorded);
+    - not fetched if the main content is unchanged and the server does not provide validators for the b-file.
+
+    Returns a dictionary that maps OEIS IDs to (oeis_id, etag, last_modified) requests. Responses without a request
+    keep the b-file that is in the database.
+    """
+
+    if len(responses) == 0:
+        return {}
+
+    oeis_ids = [response.oeis_id for response in responses]
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+
+        query = "SELECT oeis_id, main_digest, bfile_etag, bfile_last_modified FROM oeis_entries WHERE oeis_id IN ({});".format(", ".join("?" * len(oeis_ids)))
+        dbcursor.execute(query, oeis_ids)
+        known_entries = dict((oeis_id, (main_digest, etag, last_modified)) for (oeis_id, main_digest, etag, last_modified) in dbcursor.fetchall())
+
+        # Only read the main content from the database for entries of which the main content changed.
+
+        changed_oeis_ids = [response.oeis_id for response in responses
+                            if response.oeis_id in known_entries and known_entries[response.oeis_id][0] != content_digest(response.main_content)]
+
+        query = "SELECT oeis_id, main_content FROM oeis_entries WHERE oeis_id IN ({});".format(", ".join("?" * len(changed_oeis_ids)))
+        dbcursor.execute(query, changed_oeis_ids)
+        known_main_contents = dict((oeis_id, decode_content(main_content)) for (oeis_id, main_content) in dbcursor.fetchall())
+
+    requests = {}
+
+    for response in responses:
+
+        oeis_id = response.oeis_id
+
+        if oeis_id not in known_entries:
+            requests[oeis_id] = (oeis_id, None, None)
+            continue
+
+        (main_digest, etag, last_modified) = known_entries[oeis_id]
+
+        if oeis_id in known_main_contents:
+            if bfile_link_lines(oeis_id, response.main_content) != bfile_link_lines(oeis_id, known_main_contents[oeis_id]):
+                requests[oeis_id] = (oeis_id, None, None)
+            else:
+                requests[oeis_id] = (oeis_id, etag, last_modified)
+        elif etag is None and last_modified is None:
+            requests[oeis_id] = (oeis_id, None, None)
+        elif etag or last_modified:
+            requests[oeis_id] = (oeis_id, etag, last_modified)
+
+    return requests
+
+def merge_bfile_result(response, bfile_result):
+    """Update a main-content response with the result of its b-file request.
+
+    A b-file content of None in the updated response means that the b-file in the database is still current.
+    If the b-file fetch failed, None is returned, so the entry will be retried.
+    """
+
+    if bfile_result is None:
+        return None
+
+    if bfile_result.bfile_download is not None:
+        response.bfile_download      = bfile_result.bfile_download
+        response.bfile_etag          = bfile_result.etag
+        response.bfile_last_modified = bfile_result.last_modified
+
+    return response
+
+GROUP_COMMIT_SIZE     =  500 # [responses]
+GROUP_COMMIT_INTERVAL = 10.0 # [seconds]
+
+MAX_FETCH_ATTEMPTS = 5    # An entry that could not be fetched this many times is given up on, until the next update cycle.
+RETRY_DELAY        = 2.0  # [seconds] Delay before the first retry of an entry; it doubles with every further attempt.
+MAX_RETRY_DELAY    = 60.0 # [seconds]
+
+class RetrySchedule:
+    """Decide when entries that could not be fetched are retried.
+
+    An entry is retried after RETRY_DELAY seconds, doubling with every failed attempt up to MAX_RETRY_DELAY seconds,
+    for at most MAX_FETCH_ATTEMPTS attempts in total. After that, it is dropped for the current update cycle.
+    The AdaptiveController does not back off on 'rejected' outcomes (e.g., HTTP status 404), so without a limit
+    an entry that fails permanently would be retried forever, at full speed.
+    """
+
+    def __init__(self):
+        self._attempts = collections.Counter() # oeis_id -> number of failed attempts.
+        self._delayed  = []                    # heap of (t_due, oeis_id) of the entries waiting for a retry.
+        self.dropped   = 0
+
+    def __len__(self):
+        return len(self._delayed)
+
+    def failed(self, oeis_id):
+        """Record a failed attempt to fetch an entry. Returns True if it will be retried, or False if it is dropped."""
+
+        self._attempts[oeis_id] += 1
+
+        attempts = self._attempts[oeis_id]
+
+        if attempts >= MAX_FETCH_ATTEMPTS:
+            logger.warning("[A{:06}] Unable to fetch entry after {} attempts; giving up until the next update cycle.".format(oeis_id, attempts))
+            self.dropped += 1
+            return False
+
+        delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+        heapq.heappush(self._delayed, (time.monotonic() + delay, oeis_id))
+
+        return True
+
+    def due(self):
+        """Return the OEIS IDs whose retry is due, in ascending order."""
+
+        t_current = time.monotonic()
+
+        oeis_ids = []
+        while len(self._delayed) > 0 and self._delayed[0][0] <= t_current:
+            oeis_ids.append(heapq.heappop(self._delayed)[1])
+
+        return sorted(oeis_ids)
+
+    def time_until_due(self):
+        """Return the number of seconds until the next retry is due, or None if no retries are waiting."""
+
+        if len(self._delayed) == 0:
+            return None
+
+        return max(0.0, self._delayed[0][0] - time.monotonic())
+
+def fetch_entries_into_database(dbconn, entries, fetcher = None):
     """Fetch a set of entries from the remote OEIS database and store the results in the database.
 
     The 'entries' parameter contains a number of OEIS IDs.
     This function can handle a large number of entries, up to the entire size of the OEIS database.
 
-    Entries are processed in randomized batches.
-    We use a pool of worker threads to perform the actual fetches.
-    This enhances fetch performance (in terms of fetche-per-second) dramatically.
-    Typical fetch performance is about 20 fetches per second.
+    Entries are fetched in random order.
+    The actual fetches are performed by the 'fetcher', either a pool of worker threads (the default)
+    or an asyncio event loop with persistent connections; see 'make_fetcher'.
+    This enhances fetch performance (in terms of fetches-per-second) dramatically.
+
+    Fetching and writing are pipelined, rather than alternated batch by batch:
+
+    - This thread submits fetches to the fetcher, which runs them concurrently. Completed fetches are passed back
+      on a queue. As soon as the main content of an entry arrives, its b-file is requested if it may have changed
+      (see 'bfile_requests_for_responses').
+    - Completed responses are written by this thread, using the 'process_responses' function defined above,
+      in group commits of at most GROUP_COMMIT_SIZE responses, and at least every GROUP_COMMIT_INTERVAL seconds.
+    - At most 'fetcher.batch_size' entries are in the pipeline (being fetched, or waiting to be written).
+      When the pipeline is full, no new fetches are submitted until responses are written (backpressure).
 
-    The responses of each batch of entries are processed by the 'process_responses' function defined above.
+    So a slow fetch only holds up its own entry, and the fetcher keeps fetching while the database is written.
+
+    The fetcher's AdaptiveController sets the number of fetches in flight and paces the requests,
+    so we run as fast as the server tolerates. The pipeline size follows the controller's concurrency.
+    Entries that could not be fetched are submitted again, with a backoff and a limit on the number of attempts;
+    see 'RetrySchedule'.
     """
 
-    FETCH_BATCH_SIZE  =  500 # 100 -- 1000 are reasonable
-    NUM_WORKERS       =   20 # 10 -- 20 are reasonable
-    SLEEP_AFTER_BATCH =  2.0 # [seconds]
+    if fetcher is None:
+        with make_fetcher("threads") as fetcher:
+            fetch_entries_into_database(dbconn, entries, fetcher)
+        return
+
+    # A CrawlCoordinator leases the entries to worker processes, and writes their results itself; see 'crawl_coordinator.py'.
 
-    entries = set(entries) # make a copy, and ensure it is a set.
+    if hasattr(fetcher, "fetch_entries_into_database"):
+        fetcher.fetch_entries_into_database(dbconn, entries)
+        return
 
-    with start_timer(len(entries)) as timer, concurrent.futures.ThreadPoolExecutor(NUM_WORKERS) as executor:
+    FETCHED_MAIN  = 0
+    FETCHED_BFILE = 1
 
-        while len(entries) > 0:
+    entries = list(set(entries))
+    random.shuffle(entries)
 
-            batch_size = min(FETCH_BATCH_SIZE, len(entries))
+    unsubmitted = collections.deque(entries)
 
-            batch = random.sample(entries, batch_size)
+    retries = RetrySchedule()
 
-            logger.info("Fetching data using {} {} for {} out of {} entries ...".format(NUM_WORKERS, "worker" if NUM_WORKERS == 1 else "workers", batch_size, len(entries)))
+    # The fetcher's callbacks put (oeis_id, kind, result) tuples on the queue. There is at most one fetch
+    # in flight per entry in the pipeline, so the size of the queue is bounded by the pipeline size.
 
-            with start_timer() as batch_timer:
+    completed = queue.Queue()
 
-                # Execute fetches in parallel.
-                responses = list(executor.map(safe_fetch_remote_oeis_entry, batch))
+    def submit_entry(oeis_id):
+        fetcher.submit_entry(oeis_id, lambda result: completed.put((oeis_id, FETCHED_MAIN, result)))
 
-                logger.info("{} fetches took {} ({:.3f} fetches/second).".format(batch_size, batch_timer.duration_string(), batch_size / batch_timer.duration()))
+    def submit_bfile(request):
+        fetcher.submit_bfile(request, lambda result: completed.put((request[0], FETCHED_BFILE, result)))
 
-            # Process the responses by updating the database.
+    in_flight         = 0  # number of entries with a fetch in flight.
+    awaiting_bfile    = {} # oeis_id -> FetchResult of which the b-file is being fetched.
+    responses         = [] # responses waiting to be written; None for failed fetches.
+    t_first_response  = None
+    bfile_statistics  = collections.Counter()
 
-            processed_entries = process_responses(dbconn, responses)
+    count_remaining = len(entries)
 
-            entries -= processed_entries
+    logger.info("Fetching data using {} for {} entries ...".format(fetcher, len(entries)))
 
-            # Calculate and show estimated-time-to-completion.
+    with start_timer(len(entries)) as timer:
 
-            logger.info("Estimated time to completion: {}.".format(timer.etc_string(work_remaining = len(entries))))
+        t_commit = time.monotonic()
 
-            # Sleep if we need to fetch more
-            if len(entries) > 0:
-                logger.info("Sleeping for {:.1f} seconds ...".format(SLEEP_AFTER_BATCH))
-                time.sleep(SLEEP_AFTER_BATCH)
+        while in_flight > 0 or len(unsubmitted) > 0 or len(retries) > 0:
 
-        logger.info("Fetched {} entries in {}.".format(timer.total_work, timer.duration_string()))
+            # Keep the pipeline filled. Failed entries are submitted again once their retry is due.
 
-def make_database_complete(dbconn, highest_oeis_id):
-    """Fetch all entries from the remote OEIS database that are not yet present in the local SQLite database."""
+            unsubmitted.extend(retries.due())
 
-    with close_when_done(dbconn.cursor()) as dbcursor:
-        dbcursor.execute("SELECT oeis_id FROM oeis_entries;")
-        present_entries = dbcursor.fetchall()
+            while len(unsubmitted) > 0 and in_flight + len(responses) < fetcher.batch_size:
+                submit_entry(unsubmitted.popleft())
+                in_flight += 1
 
-    present_entries = [oeis_id for (oeis_id, ) in present_entries]
-    logger.info("Entries present in local database: {}.".format(len(present_entries)))
+            # Wait for completed fetches until the next group commit is due. Then take all completed fetches,
+            # so the b-files to fetch are decided for all of them at once.
 
-    all_entries = range(1, highest_oeis_id + 1)
+            results = []
 
-    missing_entries = set(all_entries) - set(present_entries)
-    logger.info("Missing entries to be fetched: {}.".format(len(missing_entries)))
+            if in_flight > 0:
+                timeout = GROUP_COMMIT_INTERVAL if t_first_response is None else max(0.0, t_first_response + GROUP_COMMIT_INTERVAL - time.monotonic())
+                if retries.time_until_due() is not None:
+                    timeout = min(timeout, retries.time_until_due())
+                try:
+                    results.append(completed.get(timeout = timeout))
+                    while True:
+                        results.append(completed.get_nowait())
+                except queue.Empty:
+                    pass
+            elif len(unsubmitted) == 0 and len(responses) == 0:
+                # Nothing to do but wait for the next retry.
+                time.sleep(retries.time_until_due())
+
+            main_responses = []
+
+            for (oeis_id, kind, result) in results:
+
+                in_flight -= 1
+
+                if kind == FETCHED_BFILE:
+                    bfile_statistics["requested"] += 1
+                    if result is None:
+                        bfile_statistics["failures"] += 1
+                    elif result.bfile_download is None:
+                        bfile_statistics["not modified"] += 1
+                    elif result.bfile_download.truncated:
+                        bfile_statistics["truncated"] += 1
+                    result = merge_bfile_result(awaiting_bfile.pop(oeis_id), result)
+                elif result is not None:
+                    main_responses.append(result)
+                    continue
+
+                if result is None and not retries.failed(oeis_id):
+                    count_remaining -= 1
+
+                responses.append(result)
 
-    fetch_entries_into_database(dbconn, missing_entries)
+            requests = bfile_requests_for_responses(dbconn, main_responses)
 
-def update_database_entries_randomly(dbconn, howmany):
-    """Re-fetch (update) a random subset of entries that are already present in the local SQLite database."""
+            for response in main_responses:
+                if response.oeis_id in requests:
+                    awaiting_bfile[response.oeis_id] = response
+                    submit_bfile(requests[response.oeis_id])
+                    in_flight += 1
+                else:
+                    bfile_statistics["skipped"] += 1
+                    responses.append(response)
+
+            if len(responses) > 0 and t_first_response is None:
+                t_first_response = time.monotonic()
+
+            # Write the completed responses.
+
+            if len(responses) > 0 and (len(responses) >= GROUP_COMMIT_SIZE or in_flight == 0 or time.monotonic() >= t_first_response + GROUP_COMMIT_INTERVAL):
+
+                t_current = time.monotonic()
+
+                logger.info("{} responses in {:.3f} seconds ({:.3f} responses/second); {} entries in flight.".format(len(responses), t_current - t_commit, len(responses) / max(t_current - t_commit, 1e-6), in_flight))
+                logger.info("Requested {} b-files (skipped: {}, not modified: {}, truncated: {}, failures: {}).".format(
+                    bfile_statistics["requested"], bfile_statistics["skipped"], bfile_statistics["not modified"], bfile_statistics["truncated"], bfile_statistics["failures"]))
+
+                processed_entries = process_responses(dbconn, responses)
+
+                crawler_metrics.export_if_due(dbconn)
+
+                count_remaining -= len(processed_entries)
+
+                responses = []
+                t_first_response = None
+                bfile_statistics.clear()
+
+                t_commit = t_current
+
+                # Calculate and show estimated-time-to-completion.
+
+                logger.info("Estimated time to completion: {}.".format(timer.etc_string(work_remaining = count_remaining)))
+
+        logger.info("Fetched {} entries in {}; gave up on {} entries.".format(timer.total_work - retries.dropped, timer.duration_string(), retries.dropped))
+
+def make_database_complete(dbconn, highest_oeis_id, fetcher = None):
+    """Fetch all entries from the remote OEIS database that are not yet present in the local SQLite database.
+
+    The missing entries are the never-fetched entries in the refresh queue, found by an index range scan.
+    """
+
+    ensure_refresh_queue_populated(dbconn, highest_oeis_id)
 
     with close_when_done(dbconn.cursor()) as dbcursor:
-        dbcursor.execute("SELECT oeis_id FROM oeis_entries;")
-        present_entries = dbcursor.fetchall()
+        dbcursor.execute("SELECT oeis_id FROM refresh_queue WHERE next_due <= ?;", (NEVER_FETCHED, ))
+        missing_entries = dbcursor.fetchall()
+
+    missing_entries = [oeis_id for (oeis_id, ) in missing_entries]
+    logger.info("Missing entries to be fetched: {}.".format(len(missing_entries)))
+
+    fetch_entries_into_database(dbconn, missing_entries, fetcher)
+
+def update_database_entries_randomly(dbconn, howmany, highest_oeis_id, fetcher = None):
+    """Re-fetch (update) a random subset of entries that are already present in the local SQLite database.
+
+    Rather than reading all IDs from the database, we draw random IDs and keep those that are present.
+    The candidates are looked up in batches, to stay well below SQLite's limit on the number of query parameters.
+    """
+
+    MAX_ROUNDS = 10
+    BATCH_SIZE = 1000
+
+    random_entries = set()
 
-    present_entries = [oeis_id for (oeis_id, ) in present_entries]
+    for round_nr in range(MAX_ROUNDS):
 
-    random_entries_count = min(howmany, len(present_entries))
+        count = min(howmany - len(random_entries), highest_oeis_id)
+        if count <= 0:
+            break
+
+        candidates = random.sample(range(1, highest_oeis_id + 1), count)
 
-    random_entries = random.sample(present_entries, random_entries_count)
+        with close_when_done(dbconn.cursor()) as dbcursor:
+            for batch_start in range(0, len(candidates), BATCH_SIZE):
+                batch = candidates[batch_start:batch_start + BATCH_SIZE]
+                query = "SELECT oeis_id FROM refresh_queue WHERE next_due > ? AND oeis_id IN ({});".format(", ".join("?" * len(batch)))
+                dbcursor.execute(query, [NEVER_FETCHED] + batch)
+                random_entries |= set(oeis_id for (oeis_id, ) in dbcursor.fetchall())
 
     logger.info("Random entries in local database selected for refresh: {}.".format(len(random_entries)))
 
-    fetch_entries_into_database(dbconn, random_entries)
+    fetch_entries_into_database(dbconn, random_entries, fetcher)
 
-def update_database_entries_by_priority(dbconn, howmany):
-    """Re-fetch entries that are old, relative to their stability.
+def update_database_entries_by_staleness(dbconn, howmany, fetcher = None):
+    """Re-fetch the entries that are most likely to have changed since they were last fetched.
 
-    For each entry, a priority is determined, as follows:
+    The probability that an entry is stale follows from its estimated change rate and its age;
+    see 'refresh_scheduler.py'. Entries that change often are refreshed more often than stable entries.
 
-    The _age_ is defined as the number of seconds ago that the entry was last fetched in its current state.
-    The _stability_ is defined as the number of seconds between the first and last fetches in the current state.
-    The _priority_ is the _age_ divided by the _stability_.
+    Rather than calculating the staleness of all entries, we take the entries from the refresh queue that have the earliest
+    time at which their staleness probability reaches the threshold (an index range scan), and rank those candidates.
+    The ranking matters for candidates that are well past their due time: an entry that changes often
+    may have become stale after an entry that is overdue, but be more likely to be stale right now.
+    """
+
+    CANDIDATE_FACTOR = 4
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+        query = """
+                SELECT q.oeis_id, e.t2, c.change_count, c.observed_time
+                FROM (SELECT oeis_id FROM refresh_queue WHERE next_due > ? ORDER BY next_due LIMIT ?) AS q, oeis_entries AS e, change_statistics AS c
+                WHERE e.oeis_id = q.oeis_id AND c.oeis_id = q.oeis_id;
+                """
+        dbcursor.execute(query, (NEVER_FETCHED, howmany * CANDIDATE_FACTOR))
+        candidates = dbcursor.fetchall()
 
-    A high priority indicates that the entry is old and/or unstable.
-    Such entries are fetched in preference to entries that are recent and/or stable (and have a lower priority).
+    stalest_entries = select_stalest_entries(candidates, howmany, time.time())
+
+    logger.info("Stalest entries in local database selected for refresh: {}.".format(len(stalest_entries)))
+
+    fetch_entries_into_database(dbconn, stalest_entries, fetcher)
+
+def refresh_count_for_cycle(dbconn, requests_per_hour):
+    """Determine how many entries to refresh in this cycle, given a budget in requests per hour.
+
+    The budget accrues from the start of the previous cycle's refresh, as recorded in the 'crawler_state' table.
+    After a long interruption, the accrued budget is capped, so that we do not hammer the server to catch up.
     """
 
+    DEFAULT_INTERVAL = 1800.0 # [seconds] Used on the first run.
+    MAX_INTERVAL     = 7200.0 # [seconds]
+
     t_current = time.time()
 
-    with close_when_done(dbconn.cursor()) as dbcursor:
-        query = "SELECT oeis_id FROM oeis_entries ORDER BY (? - t2) / max(t2 - t1, 1e-6) DESC LIMIT ?;"
-        dbcursor.execute(query, (t_current, howmany))
-        highest_priority_entries = dbcursor.fetchall()
+    t_previous = get_crawler_state(dbconn, "last_refresh_time")
 
-    highest_priority_entries = [oeis_id for (oeis_id, ) in highest_priority_entries]
+    interval = DEFAULT_INTERVAL if t_previous is None else min(MAX_INTERVAL, max(0.0, t_current - t_previous))
 
-    logger.info("Highest-priority entries in local database selected for refresh: {}.".format(len(highest_priority_entries)))
+    set_crawler_state(dbconn, "last_refresh_time", t_current)
 
-    fetch_entries_into_database(dbconn, highest_priority_entries)
+    refresh_count = refresh_count_for_budget(requests_per_hour, interval)
 
-def update_database_entries_for_nonzero_time_window(dbconn):
-    """ Re-fetch entries in the database that have a 0-second time window. These are entries that have been fetched only once."""
+    logger.info("Refresh budget for the last {:.1f} seconds at {} requests/hour: {} entries.".format(interval, requests_per_hour, refresh_count))
+
+    return refresh_count
+
+def update_database_entries_for_nonzero_time_window(dbconn, fetcher = None):
+    """ Re-fetch entries in the database that have a 0-second time window. These are entries that have been fetched only once.
+
+    The entries are found using the partial index 'oeis_entries_zero_time_window'.
+    Entries ingested from dump files also have a 0-second time window; they are left to the refresh schedule.
+    """
 
     while True:
 
         with close_when_done(dbconn.cursor()) as dbcursor:
-            dbcursor.execute("SELECT oeis_id FROM oeis_entries WHERE t1 = t2;")
+            dbcursor.execute("SELECT oeis_id FROM oeis_entries INDEXED BY oeis_entries_zero_time_window WHERE t1 = t2 EXCEPT SELECT oeis_id FROM oeis_entries INDEXED BY oeis_entries_ingested WHERE source IS NOT NULL;")
             zero_timewindow_entries = dbcursor.fetchall()
 
         if len(zero_timewindow_entries) == 0:
@@ -294,7 +1230,15 @@ def update_database_entries_for_nonzero_time_window(dbconn):
 
         logger.info("Entries with zero time window in local database selected for refresh: {}.".format(len(zero_timewindow_entries)))
 
-        fetch_entries_into_database(dbconn, zero_timewindow_entries)
+        fetch_entries_into_database(dbconn, zero_timewindow_entries, fetcher)
+
+class ConsolidationCancelled(Exception):
+    pass
+
+def check_cancelled(cancel_event):
+    """Raise ConsolidationCancelled if the 'cancel_event' (which may be None) is set."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise ConsolidationCancelled()
 
 def vacuum_database(dbconn):
     """Perform a VACUUM command on the database."""
@@ -304,55 +1248,150 @@ def vacuum_database(dbconn):
         dbconn.execute("VACUUM;")
         logger.info("VACUUM done in {}.".format(timer.duration_string()))
 
-def compress_file(from_filename, to_filename):
-    """Compress a file using the 'xz' compression algorithm."""
+# The consolidation is compressed while the crawler runs, so it may only use part of the machine.
+
+CONSOLIDATION_MAX_WORKERS   = None    # Number of compressor processes; None: half the CPU cores, within CONSOLIDATION_MEMORY_BUDGET.
+CONSOLIDATION_MEMORY_BUDGET = 2 << 30 # [bytes] Memory that the compressor processes may use together.
+
+def compression_workers(preset):
+    """Return the number of compressor processes to use for the consolidation; see CONSOLIDATION_MAX_WORKERS."""
+
+    if CONSOLIDATION_MAX_WORKERS is not None:
+        return CONSOLIDATION_MAX_WORKERS
+
+    return max(1, min((os.cpu_count() or 1) // 2, CONSOLIDATION_MEMORY_BUDGET // worker_memory_usage(preset)))
+
+def compress_file(from_filename, to_filename, cancel_event = None):
+    """Compress a file using the 'xz' compression algorithm.
+
+    The file is split into independent xz blocks that are compressed in parallel, by a bounded number of processes
+    (see 'compression_workers'). The result is a standard single-stream xz file; see 'parallel_xz.py'.
+
+    If the 'cancel_event' is set, ConsolidationCancelled is raised after the next block.
+    """
+
+    def progress(bytes_done, bytes_total):
+        logger.log(logging.PROGRESS, "Compressing data: {} of {} MiB done ...".format(bytes_done >> 20, bytes_total >> 20))
+        check_cancelled(cancel_event)
 
     PRESET = 9 # level 9 without 'extra' works best on our data.
 
-    BLOCKSIZE = 1048576 # Process data in blocks of 1 megabyte.
+    max_workers = compression_workers(PRESET)
 
     with start_timer() as timer:
-        logger.info("Compressing data from '{}' to '{}' ...".format(from_filename, to_filename))
-        with open(from_filename, "rb") as fi, lzma.open(to_filename, "wb", format = lzma.FORMAT_XZ, check = lzma.CHECK_CRC64, preset = PRESET) as fo:
-            while True:
-                data = fi.read(BLOCKSIZE)
-                if len(data) == 0:
-                    break
-                fo.write(data)
-        logger.info("Compressing data took {}.".format(timer.duration_string()))
-
-def consolidate_database_monthly(database_filename, remove_stale_files_flag):
-    """Make a consolidated version of the database, once per day.
+        logger.info("Compressing data from '{}' to '{}' using {} processes ...".format(from_filename, to_filename, max_workers))
+        block_count = compress_file_parallel(from_filename, to_filename, preset = PRESET, check = lzma.CHECK_CRC64, max_workers = max_workers, progress = progress)
+        logger.info("Compressing data to {} blocks took {}.".format(block_count, timer.duration_string()))
+
+def backup_database(database_filename, backup_filename, cancel_event = None):
+    """Make a consistent copy of a database that may be written to while the copy is made, using the online backup API.
+
+    The pages are copied in small steps, with short pauses in between, so that the copy does not monopolize the disk.
+    Throughout the copy, we hold a read transaction on the source database. In WAL mode, this gives us a stable snapshot
+    that writers do not block, and vice versa. (Without it, the backup would restart after every commit of the crawler,
+    and never finish.) The cost is that the WAL file cannot be checkpointed beyond the snapshot until the copy is done.
+
+    The copy is switched to the rollback journal mode, so that it is a self-contained file.
+
+    If the 'cancel_event' is set, ConsolidationCancelled is raised after the next step.
+    """
+
+    PAGES_PER_STEP = 1024  # 4 MiB at the default page size.
+    STEP_PAUSE     = 0.010 # [seconds]
+
+    if os.path.exists(backup_filename):
+        os.remove(backup_filename)
+
+    with start_timer() as timer:
+
+        logger.info("Copying database '{}' to '{}' ...".format(database_filename, backup_filename))
+
+        def progress(status, remaining, total):
+            logger.log(logging.PROGRESS, "Copying database: {} of {} pages remaining ...".format(remaining, total))
+            check_cancelled(cancel_event)
+
+        with close_when_done(sqlite3.connect(database_filename, isolation_level = None)) as dbconn_src, close_when_done(sqlite3.connect(backup_filename)) as dbconn_dst:
+
+            dbconn_src.execute("BEGIN;")
+            try:
+                dbconn_src.execute("SELECT COUNT(*) FROM sqlite_master;") # Start the read transaction.
+                dbconn_src.backup(dbconn_dst, pages = PAGES_PER_STEP, progress = progress, sleep = STEP_PAUSE)
+            finally:
+                dbconn_src.execute("COMMIT;")
+
+            dbconn_dst.execute("PRAGMA journal_mode = DELETE;")
+
+        logger.info("Copying database took {}.".format(timer.duration_string()))
+
+def consolidation_filename(now = None):
+    """Return the filename of the consolidated version of the database to be made now, or None if no consolidation is due.
+
+    A consolidation is due on the first day of the month, if it has not been made yet.
+    """
+
+    if now is None:
+        now = datetime.datetime.now()
+
+    if now.day != 1:
+        return None
+
+    xz_filename = now.strftime("oeis_v%Y%m%d.sqlite3.xz")
+    if os.path.exists(xz_filename):
+        return None # file already exists.
+
+    return xz_filename
+
+def consolidate_database_monthly(database_filename, remove_stale_files_flag, cancel_event = None):
+    """Make a consolidated version of the database, once per month.
 
     The consolidated version will have a standardized filename 'oeis_vYYYYMMDD.sqlite3.xz'.
 
     If this filename already exists, we return immediately.
 
-    If not, we vacuum the database, and compress its file. This process takes ~ 2 hours on a fast desktop PC.
+    If not, we make a consistent copy of the live database (see 'backup_database'), vacuum the copy, and compress it.
+    The live database is only read, and the crawler may keep writing to it; see 'BackgroundConsolidator'.
+    The compressed file is written under a temporary name, and renamed when it is complete.
+    The copy and the temporary file are removed when we are done, also if the consolidation fails.
+
+    If the 'cancel_event' is set, the consolidation stops as soon as possible, raising ConsolidationCancelled.
 
     When the compressed database is written, we remove all 'stale' consolidated files,
     i.e., all files that are called 'oeis_vYYYYMMDD.sqlite3.xz' except the one we just wrote.
     """
 
-    now = datetime.datetime.now()
-
-    if now.day != 1:
+    xz_filename = consolidation_filename()
+    if xz_filename is None:
         return
 
-    xz_filename = now.strftime("oeis_v%Y%m%d.sqlite3.xz")
-    if os.path.exists(xz_filename):
-        return # file already exists.
+    snapshot_filename = xz_filename[:-len(".xz")]
+    xz_temp_filename  = xz_filename + ".tmp"
 
     with start_timer() as timer:
 
         logger.info("Consolidating database to '{}' ...".format(xz_filename))
 
-        # Vacuum the database
-        with close_when_done(sqlite3.connect(database_filename)) as dbconn:
-            vacuum_database(dbconn)
-
-        # Create the xz file.
-        compress_file(database_filename, xz_filename)
+        try:
+            # Copy the database.
+            backup_database(database_filename, snapshot_filename, cancel_event)
+
+            # Vacuum the copy. The progress handler interrupts the VACUUM if the consolidation is cancelled.
+            with close_when_done(sqlite3.connect(snapshot_filename)) as dbconn:
+                if cancel_event is not None:
+                    dbconn.set_progress_handler(cancel_event.is_set, 100000)
+                try:
+                    vacuum_database(dbconn)
+                except sqlite3.OperationalError:
+                    check_cancelled(cancel_event)
+                    raise
+
+            # Create the xz file.
+            compress_file(snapshot_filename, xz_temp_filename, cancel_event)
+            os.replace(xz_temp_filename, xz_filename)
+
+        finally:
+            for filename in (snapshot_filename, xz_temp_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
 
         # Remove stale files.
         if remove_stale_files_flag:
@@ -363,51 +1402,158 @@ def consolidate_database_monthly(database_filename, remove_stale_files_flag):
 
         logger.info("Consolidating data took {}.".format(timer.duration_string()))
 
-def database_update_cycle(database_filename):
-    """Perform a single cycle of the database update loop."""
+class BackgroundConsolidator:
+    """Runs 'consolidate_database_monthly' in a background thread, so that fetching carries on during consolidation.
 
-    with start_timer() as timer:
+    At most one consolidation runs at any time. Errors are logged; the consolidation will be retried in a later cycle.
+    When the crawler stops, it must call 'stop', which cancels a running consolidation and waits for it to clean up.
+    """
 
-        highest_oeis_id = find_highest_oeis_id() # Check OEIS server for highest entry ID.
+    def __init__(self, database_filename, remove_stale_files_flag):
+        self.database_filename       = database_filename
+        self.remove_stale_files_flag = remove_stale_files_flag
+        self._thread = None
+        self._cancel = threading.Event()
 
-        with close_when_done(sqlite3.connect(database_filename)) as dbconn:
-            ensure_database_schema_created(dbconn)
-            make_database_complete(dbconn, highest_oeis_id)                      # Make sure we have all entries (full fetch on first run).
-            update_database_entries_randomly(dbconn, highest_oeis_id // 1000)    # Refresh 0.1 % of entries randomly.
-            update_database_entries_by_priority(dbconn, highest_oeis_id //  200) # Refresh 0.5 % of entries by priority.
-            update_database_entries_for_nonzero_time_window(dbconn)              # Make sure we have t1 != t2 for all entries (full fetch on first run).
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
 
-        consolidate_database_monthly(database_filename, remove_stale_files_flag = False)
+    def start_if_due(self):
+        """Start a consolidation in the background if one is due, and none is running."""
 
-        logger.info("Full database update cycle took {}.".format(timer.duration_string()))
-
-def database_update_cycle_loop(database_filename):
-    """Call the database update cycle in an infinite loop, with random pauses in between."""
+        if self.is_running() or consolidation_filename() is None:
+            return
 
-    while True:
+        self._thread = threading.Thread(target = self._run, name = "consolidation", daemon = True)
+        self._thread.start()
 
+    def _run(self):
         try:
-            database_update_cycle(database_filename)
-        except KeyboardInterrupt:
-            logger.info("Keyboard interrupt request received, ending database update cycle loop...")
-            break
+            consolidate_database_monthly(self.database_filename, self.remove_stale_files_flag, self._cancel)
+        except ConsolidationCancelled:
+            logger.info("Consolidation cancelled.")
         except BaseException as exception:
-            logger.error("Error while performing database update cycle: '{}'.".format(exception))
+            logger.error("Error while consolidating database: '{}'.".format(exception))
+
+    def stop(self):
+        """Cancel a running consolidation, and wait until it has stopped."""
+
+        if self.is_running():
+            logger.info("Cancelling consolidation ...")
+            self._cancel.set()
+
+        self.join()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+# The fraction of the refresh budget that is spent on randomly selected entries rather than the stalest entries.
+# Random refreshes keep the change statistics of entries that are believed to be stable up to date.
+
+RANDOM_REFRESH_FRACTION = 0.2
+
+DEFAULT_REFRESH_BUDGET = 7200 # [requests/hour]
+
+def database_update_cycle(database_filename, fetch_backend = "threads", controller = None, refresh_budget = DEFAULT_REFRESH_BUDGET, consolidator = None, fetcher = None, base_url = None):
+    """Perform a single cycle of the database update loop.
 
-        # Pause between update cycles.
-        pause = max(300.0, random.gauss(1800.0, 600.0))
-        logger.info("Sleeping for {:.1f} seconds ...".format(pause))
-        time.sleep(pause)
+    The 'refresh_budget' is the number of requests per hour to spend on refreshing entries that are already present.
+
+    If a BackgroundConsolidator is given, a due consolidation is started in the background at the start of the cycle.
+    Otherwise, it is performed at the end of the cycle.
+
+    If a fetcher is given (e.g., a CrawlCoordinator), it is used instead of a fetcher made for 'fetch_backend'.
+    The base URL can be overridden, e.g. to point to a local stand-in server.
+    """
+
+    if consolidator is not None:
+        consolidator.start_if_due()
+
+    if fetcher is None:
+        fetcher = make_fetcher(fetch_backend, base_url, controller)
+    else:
+        fetcher = contextlib.nullcontext(fetcher)
+
+    with start_timer() as timer:
+
+        with close_when_done(sqlite3.connect(database_filename)) as dbconn, fetcher as fetcher:
+            configure_database_connection(dbconn)
+            ensure_database_schema_created(dbconn)
+            load_content_dictionaries(dbconn)
+            ensure_content_digests_present(dbconn)
+            ensure_change_statistics_present(dbconn)
+            highest_oeis_id = find_highest_oeis_id(dbconn, base_url) # Check OEIS server for highest entry ID.
+            make_database_complete(dbconn, highest_oeis_id, fetcher)                                # Make sure we have all entries (full fetch on first run).
+            refresh_count = refresh_count_for_cycle(dbconn, refresh_budget)                         # Spend the refresh budget accrued since the last cycle:
+            random_count = int(refresh_count * RANDOM_REFRESH_FRACTION)
+            update_database_entries_randomly(dbconn, random_count, highest_oeis_id, fetcher)        # - partly on random entries;
+            update_database_entries_by_staleness(dbconn, refresh_count - random_count, fetcher)     # - mostly on the entries most likely to be stale.
+            update_database_entries_for_nonzero_time_window(dbconn, fetcher)                        # Make sure we have t1 != t2 for all entries (full fetch on first run).
+
+        if consolidator is None:
+            consolidate_database_monthly(database_filename, remove_stale_files_flag = False)
+
+        logger.info("Full database update cycle took {}.".format(timer.duration_string()))
+
+def database_update_cycle_loop(database_filename, fetch_backend = "threads", refresh_budget = DEFAULT_REFRESH_BUDGET, fetcher = None, base_url = None):
+    """Call the database update cycle in an infinite loop, with random pauses in between.
+
+    The fetch controller is kept between cycles, so that what it learned about the server is not lost.
+    Consolidation runs in the background, and may span several cycles.
+
+    If a fetcher is given, it is used in all cycles; see 'database_update_cycle'.
+    """
+
+    controller = make_controller(fetch_backend)
+
+    consolidator = BackgroundConsolidator(database_filename, remove_stale_files_flag = False)
+
+    # The consolidation thread is stopped however the loop ends, so that it does not leave its files behind.
+
+    try:
+        while True:
+
+            try:
+                database_update_cycle(database_filename, fetch_backend, controller, refresh_budget, consolidator, fetcher, base_url)
+            except KeyboardInterrupt:
+                logger.info("Keyboard interrupt request received, ending database update cycle loop...")
+                break
+            except BaseException as exception:
+                logger.error("Error while performing database update cycle: '{}'.".format(exception))
+
+            # Pause between update cycles.
+            pause = max(300.0, random.gauss(1800.0, 600.0))
+            logger.info("Sleeping for {:.1f} seconds ...".format(pause))
+            time.sleep(pause)
+    finally:
+        consolidator.stop()
 
 def main():
     """Initialize logger and run the database update cycle loop."""
 
+    parser = argparse.ArgumentParser(description = "Fetch and refresh the remote OEIS database into a local SQLite3 database.")
+    parser.add_argument("--fetch-backend" , choices = sorted(FETCH_BACKENDS), default = "threads", help = "fetch engine to use (default: threads)")
+    parser.add_argument("--refresh-budget", type = int, default = DEFAULT_REFRESH_BUDGET, help = "requests per hour to spend on refreshing entries (default: {})".format(DEFAULT_REFRESH_BUDGET))
+    parser.add_argument("--metrics-file"  , default = "crawler_metrics.prom", help = "Prometheus text file to which the crawler metrics are written periodically (default: crawler_metrics.prom)")
+    parser.add_argument("--max-bfile-size", type = int, default = remote_entry_module.MAX_BFILE_SIZE >> 20, help = "size cap in MiB beyond which b-files are truncated (default: {})".format(remote_entry_module.MAX_BFILE_SIZE >> 20))
+    parser.add_argument("--consolidation-workers", type = int, default = None, help = "number of processes that compress the monthly consolidation (default: half the CPU cores, within {} MiB)".format(CONSOLIDATION_MEMORY_BUDGET >> 20))
+    args = parser.parse_args()
+
+    global CONSOLIDATION_MAX_WORKERS
+
+    remote_entry_module.MAX_BFILE_SIZE = args.max_bfile_size << 20
+
+    CONSOLIDATION_MAX_WORKERS = args.consolidation_workers
+
+    crawler_metrics.prometheus_filename = args.metrics_file
+
     database_filename = "oeis.sqlite3"
 
     logfile = "logfiles/fetch_oeis_database_%Y%m%d_%H%M%S.log"
 
     with setup_logging(logfile):
-        database_update_cycle_loop(database_filename)
+        database_update_cycle_loop(database_filename, args.fetch_backend, args.refresh_budget)
 
 if __name__ == "__main__":
     main()
@@ -1,26 +1,254 @@
 
 import urllib.request
+import urllib.parse
+import urllib.error
 import time
 import logging
+import re
+import codecs
+import hashlib
+import tempfile
+
+from crawler_metrics import measure_request, REQUEST_KIND_MAIN, REQUEST_KIND_BFILE
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BASE_URL = "http://oeis.org"
+
+FETCH_TIMEOUT = 60.0 # [seconds]
+
+BFILE_CHUNK_SIZE = 65536    # [bytes] b-files are received, and written to the database, in pieces of this size.
+BFILE_SPOOL_SIZE = 1 << 20  # [bytes] b-files up to this size are kept in memory; larger ones are spooled to a temporary file.
+MAX_BFILE_SIZE   = 64 << 20 # [bytes] b-files larger than this are truncated at a line boundary, and flagged as such.
+
+# A b-file line is blank, a comment, or an 'n a(n)' pair.
+
+bfile_line_pattern = re.compile("[ \t\r]*(#.*)?$|[ \t]*-?[0-9]+[ \t]+-?[0-9]+[ \t\r]*$")
+
 class BadOeisResponse(Exception):
     def __init__(self, message):
         self.message = message
     def __str__(self):
         return self.message
 
+class BfileDownload:
+    """The content of a b-file, received piece by piece.
+
+    The content is decoded, validated, and hashed while it is received, and kept as UTF-8 in a spooled temporary file.
+    So the memory used by a download is bounded, regardless of the size of the b-file.
+
+    Content beyond 'max_size' bytes is dropped: the b-file is truncated after its last complete line that fits,
+    and flagged as 'truncated'. The digest is that of the stored content, and equals 'content_digest' of its text.
+
+    Lines that are neither blank, a comment, nor an 'n a(n)' pair are counted as malformed, but kept.
+    Content that cannot be decoded raises a BadOeisResponse.
+    """
+
+    def __init__(self, charset = None, max_size = None):
+
+        # Handle defaults
+
+        if charset is None:
+            charset = "utf-8"
+
+        if max_size is None:
+            max_size = MAX_BFILE_SIZE
+
+        self.charset         = charset
+        self.max_size        = max_size
+        self.received_bytes  = 0     # [bytes] size of the response body received.
+        self.size            = 0     # [bytes] size of the stored content, in UTF-8.
+        self.truncated       = False # True if the b-file exceeded 'max_size', and was truncated.
+        self.malformed_lines = 0
+
+        self._decoder = codecs.getincrementaldecoder(charset)()
+        self._pending = [] # pieces of the last, incomplete line.
+        self._pending_length = 0 # [bytes] size of the pending pieces, in UTF-8 (as they will be stored).
+        self._hash    = hashlib.blake2b(digest_size = 16)
+        self._file    = tempfile.SpooledTemporaryFile(BFILE_SPOOL_SIZE)
+        self.digest   = None # available after 'finish'.
+
+    def _store(self, text):
+        """Validate, hash, and store complete lines of text, or as many of them as fit."""
+
+        data = text.encode("utf-8")
+
+        if self.size + len(data) > self.max_size:
+            data = data[:data.rfind(b"\n", 0, self.max_size - self.size) + 1]
+            text = data.decode("utf-8")
+            self.truncated = True
+
+        lines = text.split("\n")
+        if lines[-1] == "":
+            del lines[-1]
+
+        self.malformed_lines += sum(1 for line in lines if bfile_line_pattern.match(line) is None)
+
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def feed(self, data):
+        """Add a piece of the response body. Returns False if the size cap was reached, so no more content is needed."""
+
+        if self.truncated:
+            return False
+
+        self.received_bytes += len(data)
+
+        try:
+            text = self._decoder.decode(data)
+        except UnicodeDecodeError as exception:
+            raise BadOeisResponse("b-file content is not valid {} ({})".format(self.charset, exception))
+
+        # Complete lines are stored; the incomplete last line is kept until its end is received.
+
+        end = text.rfind("\n") + 1
+
+        if end > 0:
+            self._store("".join(self._pending) + text[:end])
+            self._pending = []
+            self._pending_length = 0
+            text = text[end:]
+
+        if len(text) > 0:
+            self._pending.append(text)
+            self._pending_length += len(text.encode("utf-8"))
+
+        if self.size + self._pending_length > self.max_size:
+            self.truncated = True
+
+        return not self.truncated
+
+    def finish(self):
+        """Store the last line, which may lack a line end, and finalize the digest. Returns the BfileDownload itself."""
+
+        if not self.truncated:
+            try:
+                text = self._decoder.decode(b"", True)
+            except UnicodeDecodeError as exception:
+                raise BadOeisResponse("b-file content is not valid {} ({})".format(self.charset, exception))
+            text = "".join(self._pending) + text
+            if len(text) > 0:
+                self._store(text)
+
+        self._pending = []
+        self._pending_length = 0
+
+        self.digest = self._hash.digest()
+
+        return self
+
+    def chunks(self):
+        """Yield the stored content in pieces of BFILE_CHUNK_SIZE bytes."""
+
+        self._file.seek(0)
+        while True:
+            data = self._file.read(BFILE_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            yield data
+
+    def read(self):
+        """Return the stored content as UTF-8 bytes."""
+        self._file.seek(0)
+        return self._file.read()
+
+    def text(self):
+        """Return the stored content as a string."""
+        return self.read().decode("utf-8")
+
+    def close(self):
+        self._file.close()
+
+    # A finished download can be pickled, e.g. to pass it from a crawl worker to the coordinator ('crawl_coordinator.py').
+    # The stored content is not included in the pickle, so that it is never held in memory as a whole: it is passed
+    # separately, in pieces ('chunks'), which are added to the unpickled download with 'append_chunk'.
+
+    def __getstate__(self):
+        return dict((name, value) for (name, value) in self.__dict__.items() if not name.startswith("_"))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pending = []
+        self._pending_length = 0
+        self._file = tempfile.SpooledTemporaryFile(BFILE_SPOOL_SIZE)
+
+    def append_chunk(self, data):
+        """Add a piece of the stored content, as yielded by 'chunks', to an unpickled download."""
+        self._file.write(data)
+
 class FetchResult:
-    def __init__(self, oeis_id, timestamp, main_content, bfile_content):
-        self.oeis_id       = oeis_id
-        self.timestamp     = timestamp
-        self.main_content  = main_content
-        self.bfile_content = bfile_content
+    def __init__(self, oeis_id, timestamp, main_content, bfile_download, bfile_etag = None, bfile_last_modified = None):
+        self.oeis_id             = oeis_id
+        self.timestamp           = timestamp
+        self.main_content        = main_content
+        self.bfile_download      = bfile_download      # a BfileDownload; None if the b-file was not fetched, or did not change.
+        self.bfile_etag          = bfile_etag          # the b-file's 'ETag' header ("" if absent); None if the b-file was not fetched.
+        self.bfile_last_modified = bfile_last_modified # the b-file's 'Last-Modified' header ("" if absent); None if the b-file was not fetched.
+
+class BfileFetchResult:
+    def __init__(self, oeis_id, bfile_download, etag, last_modified):
+        self.oeis_id        = oeis_id
+        self.bfile_download = bfile_download # a BfileDownload; None if the server indicated that the b-file was not modified.
+        self.etag           = etag
+        self.last_modified  = last_modified
+
+def fetch_url(url, measurement = None):
+    """Fetch a URL and return its content as a string. The size of the response body is added to the RequestMeasurement, if given."""
+    with urllib.request.urlopen(url, timeout = FETCH_TIMEOUT) as response:
+        body = response.read()
+        if measurement is not None:
+            measurement.response_bytes += len(body)
+        return body.decode(response.headers.get_content_charset() or 'utf-8')
+
+def conditional_request_headers(etag, last_modified):
+    """The headers of a conditional GET request, given the validators of the version we have. Empty validators are ignored."""
+
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    return headers
+
+def download_url_conditional(url, etag = None, last_modified = None, measurement = None):
+    """Download a b-file URL in pieces, unless it was not modified since the version identified by 'etag' and/or 'last_modified'.
+
+    Returns a (download, etag, last_modified) tuple, where the download is a finished BfileDownload.
+    The download is None if the server responds with HTTP status 304 (Not Modified); in that case, the validators passed in are returned.
+    Validators that are absent from the response are returned as empty strings.
+
+    If the b-file exceeds the size cap, the rest of the response is not read.
 
-def fetch_url(url):
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(response.headers.get_content_charset() or 'utf-8')
+    If a RequestMeasurement is given, the size of the response body, or the fact that it was not modified, is recorded in it.
+    """
+
+    request = urllib.request.Request(url, headers = conditional_request_headers(etag, last_modified))
+
+    try:
+        with urllib.request.urlopen(request, timeout = FETCH_TIMEOUT) as response:
+            download = BfileDownload(response.headers.get_content_charset())
+            try:
+                while True:
+                    data = response.read(BFILE_CHUNK_SIZE)
+                    if len(data) == 0 or not download.feed(data):
+                        break
+                download.finish()
+            except BaseException:
+                download.close()
+                raise
+            finally:
+                if measurement is not None:
+                    measurement.response_bytes += download.received_bytes
+            return (download, response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""))
+    except urllib.error.HTTPError as exception:
+        if exception.code == 304:
+            if measurement is not None:
+                measurement.not_modified = True
+            return (None, etag, last_modified)
+        raise
 
 def main_content_ok(content):
 
@@ -42,20 +270,73 @@ def main_content_ok(content):
 
     return content_ok
 
-def fetch_remote_oeis_entry(oeis_id, fetch_bfile_flag):
+def bfile_link_lines(oeis_id, main_content):
+    """Return the '%H' lines of the main content that link to the entry's b-file.
+
+    The text of the link describes the b-file (e.g., "Table of n, a(n) for n = 0..10000"), so it usually changes
+    when the b-file is replaced.
+    """
+
+    bfile_path = "/A{0:06d}/b{0:06d}.txt".format(oeis_id)
+
+    return [line for line in main_content.split("\n") if line.startswith("%H") and bfile_path in line]
+
+def log_bfile_download_issues(oeis_id, bfile_download):
+    if bfile_download is None:
+        return
+    if bfile_download.truncated:
+        logger.warning("b-file of entry A{:06} exceeds {} bytes; truncated to {} bytes.".format(oeis_id, bfile_download.max_size, bfile_download.size))
+    if bfile_download.malformed_lines > 0:
+        logger.warning("b-file of entry A{:06} has {} malformed lines.".format(oeis_id, bfile_download.malformed_lines))
+
+def oeis_host(base_url = None):
+    if base_url is None:
+        base_url = DEFAULT_BASE_URL
+    return urllib.parse.urlsplit(base_url).netloc
+
+def oeis_main_url(oeis_id, base_url = None):
+    if base_url is None:
+        base_url = DEFAULT_BASE_URL
+    return "{base_url}/search?q=id:A{oeis_id:06d}&fmt=text".format(base_url = base_url, oeis_id = oeis_id)
+
+def oeis_bfile_url(oeis_id, base_url = None):
+    if base_url is None:
+        base_url = DEFAULT_BASE_URL
+    return "{base_url}/A{oeis_id:06d}/b{oeis_id:06d}.txt".format(base_url = base_url, oeis_id = oeis_id)
+
+def fetch_remote_oeis_bfile(oeis_id, etag = None, last_modified = None, base_url = None):
+
+    # If validators of the version we have are given, the b-file is only transferred if it was modified.
+    # The b-file is received in pieces, into a BfileDownload. Each request is measured in 'crawler_metrics'.
+
+    bfile_url = oeis_bfile_url(oeis_id, base_url)
+
+    with measure_request(REQUEST_KIND_BFILE) as measurement:
+        (bfile_download, etag, last_modified) = download_url_conditional(bfile_url, etag, last_modified, measurement)
+
+    log_bfile_download_issues(oeis_id, bfile_download)
+
+    return BfileFetchResult(oeis_id, bfile_download, etag, last_modified)
+
+def fetch_remote_oeis_entry(oeis_id, fetch_bfile_flag, base_url = None):
 
     # We fetch a raw version of the OEIS entry, which is easy to parse.
+    # The base URL can be overridden, e.g. to point to a local stand-in server for benchmarking.
 
-    main_url  = "http://oeis.org/search?q=id:A{oeis_id:06d}&fmt=text".format(oeis_id = oeis_id)
-    bfile_url = "http://oeis.org/A{oeis_id:06d}/b{oeis_id:06d}.txt".format(oeis_id = oeis_id)
+    main_url = oeis_main_url(oeis_id, base_url)
 
     timestamp = time.time()
 
-    main_content = fetch_url(main_url)
+    with measure_request(REQUEST_KIND_MAIN) as measurement:
+
+        main_content = fetch_url(main_url, measurement)
+
+        if not main_content_ok(main_content):
+            raise BadOeisResponse("OEIS server response indicates failure (url: {})".format(main_url))
 
-    if not main_content_ok(main_content):
-        raise BadOeisResponse("OEIS server response indicates failure (url: )".format(main_url))
+    if not fetch_bfile_flag:
+        return FetchResult(oeis_id, timestamp, main_content, None)
 
-    bfile_content = fetch_url(bfile_url) if fetch_bfile_flag else None
+    bfile = fetch_remote_oeis_bfile(oeis_id, base_url = base_url)
 
-    return FetchResult(oeis_id, timestamp, main_content, bfile_content)
+    return FetchResult(oeis_id, timestamp, main_content, bfile.bfile_download, bfile.etag, bfile.last_modified)
@@ -0,0 +1,456 @@
+"""An asyncio-based engine to fetch OEIS entries from the remote OEIS database.
+
+The thread-pool based fetcher in 'fetch_oeis_database.py' opens a fresh connection for each request,
+which limits throughput to about 20 fetches per second.
+
+This module keeps a bounded pool of persistent HTTP/1.1 keep-alive connections per host, asks the server
+for gzip-compressed responses, and runs hundreds of requests concurrently on a single event loop.
+
+The results are the same 'FetchResult' instances as those produced by 'fetch_remote_oeis_entry'.
+Like there, b-files are streamed piece by piece into a BfileDownload, so they are never held in memory as a whole.
+"""
+
+import asyncio
+import gzip
+import zlib
+import time
+import logging
+import threading
+import urllib.parse
+import urllib.error
+import email.message
+
+from fetch_remote_oeis_entry import FetchResult, BfileFetchResult, BfileDownload, BadOeisResponse, FETCH_TIMEOUT, BFILE_CHUNK_SIZE, main_content_ok, log_bfile_download_issues, conditional_request_headers, oeis_host, oeis_main_url, oeis_bfile_url
+from crawl_controller        import AdaptiveController
+from crawler_metrics         import measure_request, REQUEST_KIND_MAIN, REQUEST_KIND_BFILE
+
+logger = logging.getLogger(__name__)
+
+class HttpConnection:
+    """A single persistent HTTP/1.1 connection to a host."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.request_count = 0
+        self.response_started = False # True once the status line of the current response has been received.
+
+    async def _body_pieces(self, status, headers):
+        """Yield the body of a response in pieces of at most BFILE_CHUNK_SIZE bytes, as received (i.e., still content-encoded)."""
+
+        async def read_exactly(size):
+            while size > 0:
+                piece = await self.reader.readexactly(min(size, BFILE_CHUNK_SIZE))
+                size -= len(piece)
+                yield piece
+
+        if status in (204, 304) or 100 <= status < 200:
+            return
+        elif (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+            while True:
+                size_line = await self.reader.readline()
+                chunk_size = int(size_line.split(b";", 1)[0].strip(), 16)
+                if chunk_size == 0:
+                    # Skip trailer headers, up to and including the empty line.
+                    while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                async for piece in read_exactly(chunk_size):
+                    yield piece
+                await self.reader.readexactly(2) # CRLF after chunk data.
+        elif headers.get("Content-Length") is not None:
+            async for piece in read_exactly(int(headers.get("Content-Length"))):
+                yield piece
+        else:
+            # The body is delimited by the server closing the connection.
+            while True:
+                piece = await self.reader.read(BFILE_CHUNK_SIZE)
+                if len(piece) == 0:
+                    break
+                yield piece
+
+    async def request(self, host, target, request_headers = None, open_body_sink = None):
+        """Perform a GET request on the connection, with optional extra request headers.
+
+        Returns a (status, reason, headers, body, keep_alive) tuple.
+        The body is returned as bytes, with any gzip content-encoding already undone.
+
+        If 'open_body_sink' is given, the body of a response with status 200 is not returned (but b"") but streamed:
+        'open_body_sink(headers)' is called to obtain a sink, and the sink is called with each decoded piece of the body.
+        If the sink returns False, the rest of the body is not read, and the connection is not kept alive.
+        """
+
+        extra_headers = "".join("{}: {}\r\n".format(name, value) for (name, value) in (request_headers or {}).items())
+
+        request = "GET {} HTTP/1.1\r\nHost: {}\r\nAccept-Encoding: gzip\r\nConnection: keep-alive\r\nUser-Agent: oeis-tools\r\n{}\r\n".format(target, host, extra_headers)
+
+        self.writer.write(request.encode("ascii"))
+        await self.writer.drain()
+
+        self.request_count += 1
+
+        self.response_started = False
+
+        status_line = await self.reader.readline()
+        if len(status_line) == 0:
+            raise ConnectionResetError("Connection closed by server before response.")
+
+        self.response_started = True
+
+        (version, status, reason) = (status_line.decode("iso-8859-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        status = int(status)
+
+        headers = email.message.Message()
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, value) = line.decode("iso-8859-1").split(":", 1)
+            headers[name.strip()] = value.strip()
+
+        connection_header = (headers.get("Connection") or "").lower()
+        keep_alive = (version == "HTTP/1.1" and connection_header != "close") or connection_header == "keep-alive"
+
+        if not (status in (204, 304) or 100 <= status < 200) and headers.get("Transfer-Encoding") is None and headers.get("Content-Length") is None:
+            keep_alive = False # The body is delimited by the server closing the connection.
+
+        gzip_encoded = (headers.get("Content-Encoding") or "").lower() == "gzip"
+
+        pieces = self._body_pieces(status, headers)
+
+        if open_body_sink is None or status != 200:
+            body = b"".join([piece async for piece in pieces])
+            if gzip_encoded:
+                body = gzip.decompress(body)
+            return (status, reason, headers, body, keep_alive)
+
+        # Stream the body to the sink. The decompressed output is limited per call, so it stays bounded as well.
+
+        sink = open_body_sink(headers)
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzip_encoded else None
+
+        try:
+            async for piece in pieces:
+                if decompressor is None:
+                    wanted = sink(piece)
+                else:
+                    wanted = sink(decompressor.decompress(piece, BFILE_CHUNK_SIZE))
+                    while wanted and len(decompressor.unconsumed_tail) > 0:
+                        wanted = sink(decompressor.decompress(decompressor.unconsumed_tail, BFILE_CHUNK_SIZE))
+                if not wanted:
+                    keep_alive = False
+                    break
+            else:
+                if decompressor is not None:
+                    sink(decompressor.flush())
+        finally:
+            await pieces.aclose()
+
+        return (status, reason, headers, b"", keep_alive)
+
+    def close(self):
+        self.writer.close()
+
+class HttpConnectionPool:
+    """A bounded pool of persistent HTTP/1.1 connections, keyed by (scheme, host, port).
+
+    At most 'max_connections_per_host' connections to a single host are open at any time.
+    Requests beyond that wait until a connection becomes available.
+    """
+
+    def __init__(self, max_connections_per_host = 64, timeout = FETCH_TIMEOUT):
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout                  = timeout
+        self._idle       = {} # key -> list of idle HttpConnection instances
+        self._semaphores = {} # key -> asyncio.Semaphore limiting the number of connections per key
+
+    async def _open_connection(self, scheme, host, port):
+        (reader, writer) = await asyncio.open_connection(host, port, ssl = (scheme == "https"))
+        return HttpConnection(reader, writer)
+
+    async def get(self, url, request_headers = None, open_body_sink = None):
+        """Fetch a URL, returning a (status, reason, headers, body) tuple. See 'HttpConnection.request' for 'open_body_sink'."""
+
+        parsed = urllib.parse.urlsplit(url)
+
+        scheme = parsed.scheme
+        host   = parsed.hostname
+        port   = parsed.port or (443 if scheme == "https" else 80)
+        target = parsed.path + ("?" + parsed.query if parsed.query else "")
+
+        host_header = host if parsed.port is None else "{}:{}".format(host, parsed.port)
+
+        key = (scheme, host, port)
+
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(self.max_connections_per_host)
+            self._idle[key] = []
+
+        async with self._semaphores[key]:
+
+            idle = self._idle[key]
+
+            # An idle connection may have been closed by the server in the meantime.
+            # If a reused connection fails before the response starts, we retry once on a fresh connection.
+
+            for attempt in range(2):
+
+                reused = len(idle) > 0
+
+                connection = idle.pop() if reused else await asyncio.wait_for(self._open_connection(scheme, host, port), self.timeout)
+
+                try:
+                    (status, reason, headers, body, keep_alive) = await asyncio.wait_for(connection.request(host_header, target, request_headers, open_body_sink), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+                    if reused and attempt == 0 and not connection.response_started:
+                        continue
+                    raise
+                except BaseException:
+                    connection.close()
+                    raise
+
+                if keep_alive:
+                    idle.append(connection)
+                else:
+                    connection.close()
+
+                return (status, reason, headers, body)
+
+    async def close(self):
+        """Close all idle connections."""
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+            idle.clear()
+
+async def get_following_redirects(pool, url, request_headers = None, open_body_sink = None):
+    """Fetch a URL using the connection pool, following redirects. Returns the final (url, status, reason, headers, body)."""
+
+    MAX_REDIRECTS = 5
+
+    for redirect in range(MAX_REDIRECTS + 1):
+        (status, reason, headers, body) = await pool.get(url, request_headers, open_body_sink)
+        if status not in (301, 302, 303, 307, 308) or headers.get("Location") is None:
+            break
+        url = urllib.parse.urljoin(url, headers.get("Location"))
+
+    return (url, status, reason, headers, body)
+
+async def fetch_url_async(pool, url, measurement = None):
+    """Fetch a URL using the connection pool and return its content as a string.
+
+    Redirects are followed, and other non-200 responses raise a urllib.error.HTTPError, just like 'fetch_url' does.
+    The size of the (uncompressed) response body is added to the RequestMeasurement, if given.
+    """
+
+    (url, status, reason, headers, body) = await get_following_redirects(pool, url)
+
+    if status != 200:
+        raise urllib.error.HTTPError(url, status, reason, headers, None)
+
+    if measurement is not None:
+        measurement.response_bytes += len(body)
+
+    return body.decode(headers.get_content_charset() or "utf-8")
+
+async def download_url_conditional_async(pool, url, etag = None, last_modified = None, measurement = None):
+    """The asyncio counterpart of 'download_url_conditional'."""
+
+    downloads = []
+
+    def open_body_sink(headers):
+        downloads.append(BfileDownload(headers.get_content_charset()))
+        return downloads[-1].feed
+
+    try:
+        (url, status, reason, headers, body) = await get_following_redirects(pool, url, conditional_request_headers(etag, last_modified), open_body_sink)
+
+        if status == 304:
+            if measurement is not None:
+                measurement.not_modified = True
+            return (None, etag, last_modified)
+
+        if status != 200:
+            raise urllib.error.HTTPError(url, status, reason, headers, None)
+
+        download = downloads[-1].finish()
+
+    except BaseException:
+        for download in downloads:
+            download.close()
+        raise
+
+    finally:
+        if measurement is not None:
+            measurement.response_bytes += sum(download.received_bytes for download in downloads)
+
+    return (download, headers.get("ETag", ""), headers.get("Last-Modified", ""))
+
+async def fetch_remote_oeis_entry_async(pool, oeis_id, fetch_bfile_flag, base_url = None):
+    """The asyncio counterpart of 'fetch_remote_oeis_entry'."""
+
+    main_url = oeis_main_url(oeis_id, base_url)
+
+    timestamp = time.time()
+
+    with measure_request(REQUEST_KIND_MAIN) as measurement:
+
+        main_content = await fetch_url_async(pool, main_url, measurement)
+
+        if not main_content_ok(main_content):
+            raise BadOeisResponse("OEIS server response indicates failure (url: {})".format(main_url))
+
+    if not fetch_bfile_flag:
+        return FetchResult(oeis_id, timestamp, main_content, None)
+
+    bfile = await fetch_remote_oeis_bfile_async(pool, oeis_id, base_url = base_url)
+
+    return FetchResult(oeis_id, timestamp, main_content, bfile.bfile_download, bfile.etag, bfile.last_modified)
+
+async def fetch_remote_oeis_bfile_async(pool, oeis_id, etag = None, last_modified = None, base_url = None):
+    """The asyncio counterpart of 'fetch_remote_oeis_bfile'."""
+
+    bfile_url = oeis_bfile_url(oeis_id, base_url)
+
+    with measure_request(REQUEST_KIND_BFILE) as measurement:
+        (bfile_download, etag, last_modified) = await download_url_conditional_async(pool, bfile_url, etag, last_modified, measurement)
+
+    log_bfile_download_issues(oeis_id, bfile_download)
+
+    return BfileFetchResult(oeis_id, bfile_download, etag, last_modified)
+
+class AsyncioFetcher:
+    """Fetch OEIS entries on an asyncio event loop.
+
+    The event loop runs on a background thread. It and the connection pool persist between fetches, so keep-alive
+    connections are re-used.
+
+    Fetches can be made in batches, or one by one:
+
+    - The 'fetch_batch' and 'fetch_bfiles' methods have the same semantics as mapping 'safe_fetch_remote_oeis_entry'
+      and 'safe_fetch_remote_oeis_bfile' over their arguments: they return a list of results, with None for failed fetches.
+    - The 'submit_entry' and 'submit_bfile' methods start a single fetch and return immediately. The result is passed
+      to a callback, which is called on the event loop thread.
+
+    The number of fetches in flight, and the pace at which they are started, are set by an AdaptiveController.
+    The batch size follows the controller's concurrency.
+    """
+
+    BATCH_SIZE_PER_SLOT = 25
+    MIN_BATCH_SIZE      = 100
+
+    @staticmethod
+    def default_controller():
+        return AdaptiveController(initial_concurrency = 64, max_concurrency = 512, initial_rate = 200.0)
+
+    def __init__(self, base_url = None, controller = None, max_connections = 64):
+        if controller is None:
+            controller = self.default_controller()
+        self.base_url        = base_url
+        self.controller      = controller
+        self.max_connections = max_connections
+        self._loop      = None
+        self._thread    = None
+        self._pool      = None
+        self._condition = None
+        self._in_flight = 0
+
+    def __str__(self):
+        return "{} of {} concurrent requests over {} keep-alive connections".format(self.controller.concurrency, self.controller.max_concurrency, self.max_connections)
+
+    @property
+    def batch_size(self):
+        return max(self.MIN_BATCH_SIZE, self.BATCH_SIZE_PER_SLOT * self.controller.concurrency)
+
+    def __enter__(self):
+        self._loop      = asyncio.new_event_loop()
+        self._pool      = HttpConnectionPool(self.max_connections)
+        self._condition = asyncio.Condition()
+        self._thread    = threading.Thread(target = self._loop.run_forever, name = "AsyncioFetcher", daemon = True)
+        self._thread.start()
+        return self
+
+    async def _shutdown(self):
+
+        # Fetches may still be in flight if we are leaving because of an exception.
+
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+        await self._pool.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop      = None
+        self._thread    = None
+        self._pool      = None
+        self._condition = None
+
+    async def _safe_fetch(self, description, make_coroutine):
+
+        # Wait until the number of fetches in flight is below the controller's current concurrency.
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.controller.concurrency)
+            self._in_flight += 1
+
+        try:
+            host = oeis_host(self.base_url)
+
+            delay = self.controller.delay_before_request(host)
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+
+            t_start = time.monotonic()
+
+            try:
+                result = await make_coroutine()
+            except Exception as exception:
+                logger.error("Unable to fetch {}: '{}'.".format(description, exception))
+                self.controller.record(host, time.monotonic() - t_start, exception)
+                return None
+
+            self.controller.record(host, time.monotonic() - t_start)
+            return result
+
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _safe_fetch_entry(self, oeis_id):
+        return self._safe_fetch("entry {}".format(oeis_id), lambda: fetch_remote_oeis_entry_async(self._pool, oeis_id, False, self.base_url))
+
+    def _safe_fetch_bfile(self, request):
+        (oeis_id, etag, last_modified) = request
+        return self._safe_fetch("b-file of entry {}".format(oeis_id), lambda: fetch_remote_oeis_bfile_async(self._pool, oeis_id, etag, last_modified, self.base_url))
+
+    async def _gather(self, coroutines):
+        return await asyncio.gather(*coroutines)
+
+    def _submit(self, coroutine, callback):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        future.add_done_callback(lambda future: None if future.cancelled() else callback(future.result()))
+
+    def fetch_batch(self, entries):
+        """Fetch the main content of the given entries. The b-files are fetched separately, see 'fetch_bfiles'."""
+        return asyncio.run_coroutine_threadsafe(self._gather([self._safe_fetch_entry(oeis_id) for oeis_id in entries]), self._loop).result()
+
+    def fetch_bfiles(self, requests):
+        """Fetch b-files, given a list of (oeis_id, etag, last_modified) requests. Returns a list of BfileFetchResult instances or None."""
+        return asyncio.run_coroutine_threadsafe(self._gather([self._safe_fetch_bfile(request) for request in requests]), self._loop).result()
+
+    def submit_entry(self, oeis_id, callback):
+        """Start fetching the main content of an entry. The result (a FetchResult or None) is passed to 'callback'."""
+        self._submit(self._safe_fetch_entry(oeis_id), callback)
+
+    def submit_bfile(self, request, callback):
+        """Start fetching a b-file, given an (oeis_id, etag, last_modified) request. The result (a BfileFetchResult or None) is passed to 'callback'."""
+        self._submit(self._safe_fetch_bfile(request), callback)
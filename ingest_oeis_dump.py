@@ -0,0 +1,330 @@
+#! /usr/bin/env python3
+
+"""Seed a local sqlite3 OEIS database from the bulk dump files published by the OEIS, rather than by crawling.
+
+The OEIS publishes the terms and names of all entries as two gzip-compressed flat files:
+
+    stripped.gz     one line per entry: "A000045 ,0,1,1,2,3,5,8,13,21,34,55,89,144,233,377,610,987,..."
+    names.gz        one line per entry: "A000045 Fibonacci numbers: F(n) = F(n-1) + F(n-2) with F(0) = 0 and F(1) = 1."
+
+Lines starting with '#' are comments. Both files are sorted by OEIS ID, so they are read side by side,
+decompressing on the fly, without holding either of them in memory.
+
+Optionally, a directory of b-files can be given. It is searched recursively for files named 'bNNNNNN.txt'
+(or 'bNNNNNN.txt.gz'), which are stored as the entries' b-file content.
+
+From these, a main content is synthesized in the format served by the OEIS server, with the %I, %S/%T/%U, %V/%W/%X,
+%N, %K, and (if a b-file is present) %O directives. The keyword is 'sign' or 'nonn', depending on the terms;
+the first offset is the first index of the b-file. Nothing is made up for what the dump files do not have:
+without a b-file the offset is unknown, and the author (%A) is always unknown. Everything else (comments, formulas,
+programs, ...) is absent until the entry is fetched from the server.
+
+'parse_oeis_database.py' parses ingested entries with the parser's 'ingested' flag, so the missing %A and %O
+directives are not reported (P01, P02), and marks them with source = 'dump' in the parsed database: their offset
+and author are NULL, meaning unknown, until the entry is fetched.
+
+The entries are written in batches, with t1 = t2 = the modification time of the 'stripped' file, and marked as
+ingested (source = 'dump'). The crawler ('fetch_oeis_database.py') then only needs to refresh them:
+
+- they are scheduled in the refresh queue like entries that were fetched once;
+- they are not re-fetched by the zero time window pass;
+- their first fetch replaces the ingested content, and counts as the entry's first fetch.
+
+Entries that are already present in the database and were fetched from the server are left alone.
+Entries that were ingested from an earlier dump are replaced.
+"""
+
+import os
+import re
+import gzip
+import logging
+import sqlite3
+import argparse
+
+from fetch_oeis_database import ensure_database_schema_created, configure_database_connection, make_content_encoder, content_digest, NEVER_FETCHED
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DUMP = "dump"
+
+MAX_VALUE_LINE_LENGTH = 70 # The %S, %T, and %U lines (and %V, %W, and %X lines) are wrapped at this length, at a comma.
+
+dump_line_pattern  = re.compile("A([0-9]{6,}) (.*)$")
+bfile_name_pattern = re.compile("b([0-9]{6,})\\.txt(\\.gz)?$")
+
+def open_text_file(filename):
+    """Open a text file for reading, decompressing on the fly if its name ends in '.gz'."""
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt", encoding = "utf-8")
+    return open(filename, "r", encoding = "utf-8")
+
+def read_dump_file(filename):
+    """Yield (oeis_id, value) tuples from a 'stripped' or 'names' style dump file, in order of OEIS ID."""
+
+    previous_oeis_id = 0
+
+    with open_text_file(filename) as f:
+        for line in f:
+
+            line = line.rstrip("\n")
+
+            if line.startswith("#") or len(line) == 0:
+                continue
+
+            match = dump_line_pattern.match(line)
+            if match is None:
+                logger.warning("Skipping unexpected line in '{}': {!r}.".format(filename, line))
+                continue
+
+            oeis_id = int(match.group(1))
+
+            if oeis_id <= previous_oeis_id:
+                raise ValueError("Dump file '{}' is not sorted by OEIS ID (A{:06} follows A{:06}).".format(filename, oeis_id, previous_oeis_id))
+
+            previous_oeis_id = oeis_id
+
+            yield (oeis_id, match.group(2))
+
+def merge_dump_files(stripped_filename, names_filename):
+    """Yield (oeis_id, values, name) tuples from the 'stripped' and 'names' dump files, in order of OEIS ID.
+
+    The 'values' are the terms as a comma-separated string. An entry that is missing from one of the files
+    gets an empty string for the missing part.
+    """
+
+    stripped = read_dump_file(stripped_filename)
+    names    = read_dump_file(names_filename)
+
+    stripped_record = next(stripped, None)
+    names_record    = next(names, None)
+
+    while stripped_record is not None or names_record is not None:
+
+        stripped_oeis_id = stripped_record[0] if stripped_record is not None else None
+        names_oeis_id    = names_record[0]    if names_record    is not None else None
+
+        oeis_id = min(oeis_id for oeis_id in (stripped_oeis_id, names_oeis_id) if oeis_id is not None)
+
+        values = ""
+        name   = ""
+
+        if stripped_oeis_id == oeis_id:
+            values = stripped_record[1].strip().strip(",")
+            stripped_record = next(stripped, None)
+
+        if names_oeis_id == oeis_id:
+            name = names_record[1].strip()
+            names_record = next(names, None)
+
+        yield (oeis_id, values, name)
+
+def find_bfiles(dirname):
+    """Return a dictionary that maps OEIS IDs to the b-files found in the given directory and its subdirectories."""
+
+    bfiles = {}
+
+    for (dirpath, dirnames, filenames) in os.walk(dirname):
+        for filename in filenames:
+            match = bfile_name_pattern.match(filename)
+            if match is not None:
+                bfiles[int(match.group(1))] = os.path.join(dirpath, filename)
+
+    return bfiles
+
+def read_bfile(filename):
+    with open_text_file(filename) as f:
+        return f.read()
+
+def bfile_first_index(bfile_content):
+    """Return the index on the first line of a b-file that is not a comment, or None if there is no such line."""
+
+    for line in bfile_content.split("\n"):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        try:
+            return int(line.split()[0])
+        except ValueError:
+            return None
+
+    return None
+
+def wrap_values(values):
+    """Wrap a comma-separated list of values in up to three lines of at most MAX_VALUE_LINE_LENGTH characters, breaking after a comma.
+
+    All lines but the last end with a comma, as expected by 'oeis_entry.parse_value_directives'.
+    """
+
+    lines = []
+    line  = ""
+
+    for value in values.split(","):
+        if len(line) > 0 and len(line) + len(value) + 1 > MAX_VALUE_LINE_LENGTH and len(lines) < 2:
+            lines.append(line + ",")
+            line = value
+        else:
+            line = value if len(line) == 0 else line + "," + value
+
+    lines.append(line)
+
+    return lines
+
+def synthesize_main_content(oeis_id, values, name, bfile_content):
+    """Synthesize the main content of an entry, in the format served by the OEIS server, from the data in the dump files."""
+
+    terms = [int(value) for value in values.split(",")] if len(values) > 0 else []
+
+    unsigned_values = ",".join(str(abs(term)) for term in terms)
+
+    directives = [("I", "")]
+
+    directives.extend(zip("STU", wrap_values(unsigned_values)))
+
+    signed = any(term < 0 for term in terms)
+
+    if signed:
+        directives.extend(zip("VWX", wrap_values(values)))
+
+    directives.append(("N", name))
+    directives.append(("K", "sign" if signed else "nonn"))
+
+    first_index = bfile_first_index(bfile_content)
+
+    if first_index is not None:
+        # The second offset is the (1-based) position of the first term with a magnitude exceeding 1.
+        position = next((i + 1 for (i, term) in enumerate(terms) if abs(term) > 1), 1)
+        directives.append(("O", "{},{}".format(first_index, position)))
+
+    header = "# Greetings from The On-Line Encyclopedia of Integer Sequences! http://oeis.org/\n\nSearch: id:a{:06}\nShowing 1-1 of 1\n\n".format(oeis_id)
+    footer = "\n# Content is available under The OEIS End-User License Agreement: http://oeis.org/LICENSE\n"
+
+    lines = "".join("%{} A{:06}{}{}\n".format(directive, oeis_id, "" if value == "" else " ", value) for (directive, value) in directives)
+
+    return header + lines + footer
+
+def write_ingested_entries(dbconn, rows):
+    """Write a batch of ingested (oeis_id, timestamp, main_content, bfile_content, main_digest, bfile_digest) rows.
+
+    Entries that were fetched from the server are left alone. The change statistics and refresh queue of the written
+    entries are initialized as for entries that were fetched once.
+    """
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+
+        query = """
+                INSERT INTO oeis_entries(oeis_id, t1, t2, main_content, bfile_content, main_digest, bfile_digest, source)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(oeis_id) DO UPDATE SET
+                    t1 = CASE WHEN main_digest IS excluded.main_digest AND bfile_digest IS excluded.bfile_digest THEN t1 ELSE excluded.t1 END,
+                    t2 = excluded.t2, main_content = excluded.main_content, bfile_content = excluded.bfile_content,
+                    main_digest = excluded.main_digest, bfile_digest = excluded.bfile_digest
+                WHERE oeis_entries.source IS NOT NULL;
+                """
+        dbcursor.executemany(query, ((oeis_id, timestamp, timestamp, main_content, bfile_content, main_digest, bfile_digest, SOURCE_DUMP)
+                                     for (oeis_id, timestamp, main_content, bfile_content, main_digest, bfile_digest) in rows))
+
+        oeis_id_range = (rows[0][0], rows[-1][0])
+
+        query = """
+                INSERT OR IGNORE INTO change_statistics(oeis_id, change_count, observed_time)
+                    SELECT oeis_id, 0, 0.0 FROM oeis_entries INDEXED BY oeis_entries_ingested WHERE oeis_id BETWEEN ? AND ? AND source IS NOT NULL;
+                """
+        dbcursor.execute(query, oeis_id_range)
+
+        query = """
+                INSERT INTO refresh_queue(oeis_id, next_due)
+                    SELECT e.oeis_id, next_due_time(e.t2, c.change_count, c.observed_time) FROM oeis_entries AS e, change_statistics AS c
+                    WHERE e.oeis_id IN (SELECT oeis_id FROM oeis_entries INDEXED BY oeis_entries_ingested WHERE oeis_id BETWEEN ? AND ? AND source IS NOT NULL)
+                    AND c.oeis_id = e.oeis_id
+                ON CONFLICT(oeis_id) DO UPDATE SET next_due = excluded.next_due;
+                """
+        dbcursor.execute(query, oeis_id_range)
+
+    dbconn.commit()
+
+def ingest_oeis_dump(database_filename, stripped_filename, names_filename, bfile_dirname):
+
+    BATCH_SIZE = 5000
+
+    for filename in (stripped_filename, names_filename):
+        if not os.path.exists(filename):
+            logger.critical("Dump file '{}' not found! Unable to continue.".format(filename))
+            return
+
+    timestamp = os.path.getmtime(stripped_filename)
+
+    if bfile_dirname is None:
+        bfiles = {}
+    else:
+        logger.info("Searching for b-files in '{}' ...".format(bfile_dirname))
+        bfiles = find_bfiles(bfile_dirname)
+        logger.info("Found {} b-files.".format(len(bfiles)))
+
+    with close_when_done(sqlite3.connect(database_filename)) as dbconn:
+
+        configure_database_connection(dbconn)
+        ensure_database_schema_created(dbconn)
+
+        encoder = make_content_encoder(dbconn)
+
+        with start_timer() as timer:
+
+            count = 0
+            highest_oeis_id = 0
+
+            rows = []
+
+            for (oeis_id, values, name) in merge_dump_files(stripped_filename, names_filename):
+
+                bfile_content = read_bfile(bfiles[oeis_id]) if oeis_id in bfiles else ""
+
+                main_content = synthesize_main_content(oeis_id, values, name, bfile_content)
+
+                main_digest  = content_digest(main_content)
+                bfile_digest = content_digest(bfile_content)
+
+                if encoder is not None:
+                    main_content  = encoder.encode_main_content(main_content)
+                    bfile_content = encoder.encode_bfile_content(bfile_content)
+
+                rows.append((oeis_id, timestamp, main_content, bfile_content, main_digest, bfile_digest))
+
+                highest_oeis_id = oeis_id
+
+                if len(rows) == BATCH_SIZE:
+                    logger.log(logging.PROGRESS, "Writing entries A{:06} to A{:06} ...".format(rows[0][0], rows[-1][0]))
+                    write_ingested_entries(dbconn, rows)
+                    count += len(rows)
+                    rows = []
+
+            if len(rows) > 0:
+                write_ingested_entries(dbconn, rows)
+                count += len(rows)
+
+            # Entries that are missing from the dump are queued as never fetched, so the crawler fetches them.
+
+            with close_when_done(dbconn.cursor()) as dbcursor:
+                query = "INSERT OR IGNORE INTO refresh_queue(oeis_id, next_due) VALUES (?, ?);"
+                dbcursor.executemany(query, ((oeis_id, NEVER_FETCHED) for oeis_id in range(1, highest_oeis_id + 1)))
+
+            dbconn.commit()
+
+            logger.info("Ingested {} entries up to A{:06} in {}.".format(count, highest_oeis_id, timer.duration_string()))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Seed a local sqlite3 OEIS database from the OEIS bulk dump files.")
+    parser.add_argument("--stripped" , default = "stripped.gz", help = "dump file with the terms of all entries (default: stripped.gz)")
+    parser.add_argument("--names"    , default = "names.gz", help = "dump file with the names of all entries (default: names.gz)")
+    parser.add_argument("--bfile-dir", help = "directory that holds b-files named 'bNNNNNN.txt', searched recursively")
+    parser.add_argument("database_filename", nargs = "?", default = "oeis.sqlite3", help = "sqlite3 database (default: oeis.sqlite3)")
+    args = parser.parse_args()
+
+    with setup_logging(None):
+        ingest_oeis_dump(args.database_filename, args.stripped, args.names, args.bfile_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#! /usr/bin/env python3
+
+"""Convert the content of a local sqlite3 OEIS database between plain text storage and compressed storage.
+
+Converting to compressed storage trains new dictionaries on a random sample of entries, stores them in the database,
+and re-encodes all entries. Converting to text storage decodes all entries.
+
+The storage mode is recorded in the database, so 'fetch_oeis_database.py' stores new content in the same mode.
+The conversion proceeds in batches, each in its own transaction, so the crawler may keep running while it is in progress.
+An entry is only re-encoded if its digests are unchanged since the batch was read; an entry that the crawler updated in
+the meantime is left as the crawler wrote it, i.e., in the storage mode recorded in the database.
+Older dictionaries are kept, since content written by the crawler during the conversion may still refer to them.
+
+See 'content_compression.py' for the storage format.
+"""
+
+import os
+import random
+import logging
+import sqlite3
+import argparse
+
+from fetch_oeis_database import ensure_database_schema_created, configure_database_connection, set_crawler_state, vacuum_database
+from fetch_oeis_database import CONTENT_STORAGE_TEXT, CONTENT_STORAGE_COMPRESSED
+from content_compression import ContentEncoder, load_content_dictionaries, store_content_dictionary, train_dictionary, decode_content
+from content_compression import DICTIONARY_KIND_MAIN, DICTIONARY_KIND_BFILE
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+def train_content_dictionaries(dbconn, sample_size):
+    """Train a main content dictionary and a b-file dictionary on a random sample of entries, and store them."""
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+
+        dbcursor.execute("SELECT oeis_id FROM oeis_entries;")
+        oeis_ids = [oeis_id for (oeis_id, ) in dbcursor.fetchall()]
+
+        sample = random.sample(oeis_ids, min(sample_size, len(oeis_ids)))
+
+        logger.info("Training content dictionaries on {} entries ...".format(len(sample)))
+
+        main_samples  = []
+        bfile_samples = []
+
+        BATCH_SIZE = 500
+
+        for i in range(0, len(sample), BATCH_SIZE):
+            batch = sample[i:i + BATCH_SIZE]
+            query = "SELECT main_content, bfile_content FROM oeis_entries WHERE oeis_id IN ({});".format(", ".join("?" * len(batch)))
+            dbcursor.execute(query, batch)
+            for (main_content, bfile_content) in dbcursor.fetchall():
+                main_samples.append(decode_content(main_content))
+                bfile_samples.append(decode_content(bfile_content))
+
+    main_dictionary_id  = store_content_dictionary(dbconn, DICTIONARY_KIND_MAIN , train_dictionary(main_samples))
+    bfile_dictionary_id = store_content_dictionary(dbconn, DICTIONARY_KIND_BFILE, train_dictionary(bfile_samples))
+
+    logger.info("Stored content dictionaries {} (main content) and {} (b-files).".format(main_dictionary_id, bfile_dictionary_id))
+
+def reencode_database_entries(dbconn, encoder):
+    """Re-encode the content of all entries. If 'encoder' is None, the content is stored as plain text."""
+
+    BATCH_SIZE = 1000
+
+    with start_timer() as timer:
+
+        count = 0
+        skipped_count = 0
+        last_oeis_id = 0
+
+        while True:
+
+            with close_when_done(dbconn.cursor()) as dbcursor:
+                query = "SELECT oeis_id, main_content, bfile_content, main_digest, bfile_digest FROM oeis_entries WHERE oeis_id > ? ORDER BY oeis_id LIMIT ?;"
+                dbcursor.execute(query, (last_oeis_id, BATCH_SIZE))
+                oeis_entries = dbcursor.fetchall()
+
+            if len(oeis_entries) == 0:
+                break
+
+            logger.log(logging.PROGRESS, "Re-encoding entries A{:06} to A{:06} ...".format(oeis_entries[0][0], oeis_entries[-1][0]))
+
+            updates = []
+            for (oeis_id, main_content, bfile_content, main_digest, bfile_digest) in oeis_entries:
+                main_content  = decode_content(main_content)
+                bfile_content = decode_content(bfile_content)
+                if encoder is not None:
+                    main_content  = encoder.encode_main_content(main_content)
+                    bfile_content = encoder.encode_bfile_content(bfile_content)
+                updates.append((main_content, bfile_content, oeis_id, main_digest, bfile_digest))
+
+            # The crawler may have written new content since the batch was read; that content must not be overwritten.
+
+            with close_when_done(dbconn.cursor()) as dbcursor:
+                dbcursor.executemany("UPDATE oeis_entries SET main_content = ?, bfile_content = ? WHERE oeis_id = ? AND main_digest IS ? AND bfile_digest IS ?;", updates)
+                updated_count = dbcursor.rowcount
+            dbconn.commit()
+
+            count += updated_count
+            skipped_count += len(oeis_entries) - updated_count
+            last_oeis_id = oeis_entries[-1][0]
+
+        logger.info("Re-encoded {} entries in {}; {} entries were updated by the crawler in the meantime, and left as they were.".format(count, timer.duration_string(), skipped_count))
+
+def migrate_database_storage(database_filename, storage_mode, sample_size, vacuum_flag):
+
+    if not os.path.exists(database_filename):
+        logger.critical("Database file '{}' not found! Unable to continue.".format(database_filename))
+        return
+
+    size_before = os.path.getsize(database_filename)
+
+    with close_when_done(sqlite3.connect(database_filename)) as dbconn:
+
+        configure_database_connection(dbconn)
+        ensure_database_schema_created(dbconn)
+        load_content_dictionaries(dbconn)
+
+        if storage_mode == CONTENT_STORAGE_COMPRESSED:
+            train_content_dictionaries(dbconn, sample_size)
+            encoder = ContentEncoder(dbconn)
+        else:
+            encoder = None
+
+        # From now on, the crawler stores new content in the new mode.
+
+        set_crawler_state(dbconn, "content_storage", storage_mode)
+
+        reencode_database_entries(dbconn, encoder)
+
+        if vacuum_flag:
+            vacuum_database(dbconn)
+
+    size_after = os.path.getsize(database_filename)
+
+    logger.info("Database file size: {} bytes before, {} bytes after migration to '{}' storage.".format(size_before, size_after, storage_mode))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Convert the content of a local sqlite3 OEIS database between text and compressed storage.")
+    parser.add_argument("--to"         , choices = [CONTENT_STORAGE_COMPRESSED, CONTENT_STORAGE_TEXT], default = CONTENT_STORAGE_COMPRESSED, help = "storage mode to convert to (default: compressed)")
+    parser.add_argument("--sample-size", type = int, default = 5000, help = "number of entries to train the dictionaries on (default: 5000)")
+    parser.add_argument("--no-vacuum"  , action = "store_true", help = "do not VACUUM the database afterwards")
+    parser.add_argument("database_filename", nargs = "?", default = "oeis.sqlite3", help = "sqlite3 database (default: oeis.sqlite3)")
+    args = parser.parse_args()
+
+    with setup_logging(None):
+        migrate_database_storage(args.database_filename, args.to, args.sample_size, not args.no_vacuum)
+
+if __name__ == "__main__":
+    main()
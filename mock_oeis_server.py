@@ -0,0 +1,353 @@
+#! /usr/bin/env python3
+
+"""A local stand-in for the oeis.org HTTP server, used to test and benchmark the crawler without touching the real server.
+
+The server answers the two kinds of requests made by the crawler:
+
+    /search?q=id:Annnnnn&fmt=text      the '%'-format main content of an entry.
+    /Annnnnn/bnnnnnn.txt               the b-file of an entry.
+
+The content is either synthesized (entries 1 up to and including 'highest_oeis_id' exist), or served from
+an existing local sqlite3 database as written by 'fetch_oeis_database.py' (see 'DatabaseContent').
+
+The server speaks HTTP/1.1 with keep-alive, and gzip-compresses responses if the client asks for it.
+b-files are served with 'ETag' and 'Last-Modified' headers, and conditional requests are honored.
+
+To see how the crawler copes with a real server, the following can be injected:
+
+    latency         a fixed delay before each response, plus a random delay up to 'latency_jitter'.
+    error_rate      the fraction of requests that fail with HTTP status 503 (Service Unavailable).
+    mutation_rate   the probability that an entry changes when its main content is fetched. A changed entry gets an
+                    extra '%E' line in its main content and an extra comment line in its b-file, and keeps them.
+    rate_limit      the number of requests per second that the server accepts, with a burst of as many requests.
+                    Requests beyond that get HTTP status 429 (Too Many Requests), with a 'Retry-After' header.
+
+The server counts its responses by HTTP status in 'status_counts'.
+"""
+
+import re
+import gzip
+import math
+import time
+import random
+import sqlite3
+import hashlib
+import email.utils
+import logging
+import argparse
+import threading
+import collections
+import http.server
+
+from content_compression import load_content_dictionaries, decode_content
+from crawl_controller    import TokenBucket
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+main_url_pattern  = re.compile("/search\\?q=id:A([0-9]{6})&fmt=text$")
+bfile_url_pattern = re.compile("/A([0-9]{6})/b([0-9]{6})\\.txt$")
+
+def make_main_content(oeis_id, directives):
+    """Wrap a list of (directive, value) pairs in the header and footer that the OEIS server produces."""
+
+    header = "# Greetings from The On-Line Encyclopedia of Integer Sequences! http://oeis.org/\n\nSearch: id:a{:06}\nShowing 1-1 of 1\n\n".format(oeis_id)
+    footer = "\n# Content is available under The OEIS End-User License Agreement: http://oeis.org/LICENSE\n"
+
+    lines = "".join("%{} A{:06}{}{}\n".format(directive, oeis_id, "" if value == "" else " ", value) for (directive, value) in directives)
+
+    return header + lines + footer
+
+def make_missing_content(oeis_id):
+    """The response of the OEIS server when searching for an entry that does not exist."""
+    return "# Greetings from The On-Line Encyclopedia of Integer Sequences! http://oeis.org/\n\nSearch: id:a{:06}\nNo results.\n\n# Content is available under The OEIS End-User License Agreement: http://oeis.org/LICENSE\n".format(oeis_id)
+
+SYNTHESIZED_CONTENT_TIMESTAMP = 946684800.0 # 2000-01-01; synthesized content never changes.
+
+def synthesize_values(oeis_id, count):
+    return [(oeis_id * n + n * n) % 1000003 for n in range(count)]
+
+def synthesize_main_content(oeis_id):
+    values = ",".join(str(value) for value in synthesize_values(oeis_id, 30))
+    directives = [
+        ("I", ""),
+        ("S", values),
+        ("N", "Synthesized sequence number {}.".format(oeis_id)),
+        ("H", "A. Uthor, <a href=\"/A{0:06}/b{0:06}.txt\">Table of n, a(n) for n = 0..999</a>".format(oeis_id)),
+        ("K", "nonn"),
+        ("O", "0,2"),
+        ("A", "_A. Uthor_, Jan 01 2000")
+    ]
+    return make_main_content(oeis_id, directives)
+
+def synthesize_bfile_content(oeis_id):
+    return "".join("{} {}\n".format(n, value) for (n, value) in enumerate(synthesize_values(oeis_id, 1000)))
+
+class SynthesizedContent:
+    """Synthesized entries 1 up to and including 'highest_oeis_id'."""
+
+    def __init__(self, highest_oeis_id):
+        self.highest_oeis_id = highest_oeis_id
+
+    def get_entry(self, oeis_id):
+        """Return (main_content, bfile_content, timestamp) for an entry, or None if the entry does not exist."""
+        if not (1 <= oeis_id <= self.highest_oeis_id):
+            return None
+        return (synthesize_main_content(oeis_id), synthesize_bfile_content(oeis_id), SYNTHESIZED_CONTENT_TIMESTAMP)
+
+class DatabaseContent:
+    """The entries of a local sqlite3 database, as written by 'fetch_oeis_database.py'.
+
+    The database is opened read-only; both plain text and compressed content storage are supported.
+    The b-file's 'Last-Modified' timestamp is the time at which the entry's content was first fetched (t1).
+    """
+
+    def __init__(self, database_filename):
+        self._dbconn = sqlite3.connect("file:{}?mode=ro".format(database_filename), uri = True, check_same_thread = False)
+        self._lock   = threading.Lock()
+        load_content_dictionaries(self._dbconn)
+        (self.highest_oeis_id, ) = self._dbconn.execute("SELECT coalesce(MAX(oeis_id), 0) FROM oeis_entries;").fetchone()
+
+    def get_entry(self, oeis_id):
+        """Return (main_content, bfile_content, timestamp) for an entry, or None if the entry does not exist."""
+
+        with self._lock:
+            row = self._dbconn.execute("SELECT main_content, bfile_content, t1 FROM oeis_entries WHERE oeis_id = ?;", (oeis_id, )).fetchone()
+
+        if row is None:
+            return None
+
+        (main_content, bfile_content, t1) = row
+
+        return (decode_content(main_content), decode_content(bfile_content), t1)
+
+    def close(self):
+        self._dbconn.close()
+
+def mutate_main_content(oeis_id, main_content, revision):
+    """Add an '%E' line for the given revision to the main content, just before the footer."""
+
+    footer_start = main_content.rfind("\n\n# Content is available")
+    if footer_start < 0:
+        footer_start = len(main_content)
+
+    return main_content[:footer_start] + "\n%E A{:06} Revision {}.".format(oeis_id, revision) + main_content[footer_start:]
+
+def mutate_bfile_content(bfile_content, revision):
+    return "# Revision {}.\n".format(revision) + bfile_content
+
+class MockOeisRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # enables keep-alive.
+
+    def log_message(self, format, *args):
+        pass # don't log every request.
+
+    def send_content(self, status, content, etag = None, last_modified = None, headers = None):
+
+        data = content.encode("utf-8")
+
+        use_gzip = "gzip" in (self.headers.get("Accept-Encoding") or "")
+        if use_gzip:
+            data = gzip.compress(data, compresslevel = 1)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if last_modified is not None:
+            self.send_header("Last-Modified", last_modified)
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count_response(status)
+
+    def send_validated_content(self, content, last_modified_timestamp):
+        """Send content with validators, or a 304 (Not Modified) response if the client already has it."""
+
+        etag = "\"{}\"".format(hashlib.md5(content.encode("utf-8")).hexdigest())
+        last_modified = email.utils.formatdate(last_modified_timestamp, usegmt = True)
+
+        if_none_match     = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+
+        if if_none_match is not None:
+            not_modified = (if_none_match == etag)
+        elif if_modified_since is not None:
+            try:
+                not_modified = (email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= last_modified_timestamp)
+            except (TypeError, ValueError):
+                not_modified = False
+        else:
+            not_modified = False
+
+        if not_modified:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            self.server.count_response(304)
+        else:
+            self.send_content(200, content, etag, last_modified)
+
+    def do_GET(self):
+
+        server = self.server
+
+        retry_after = server.admit_request()
+        if retry_after is not None:
+            self.send_content(429, "Too many requests.\n", headers = {"Retry-After": str(retry_after)})
+            return
+
+        delay = server.response_delay()
+        if delay > 0.0:
+            time.sleep(delay)
+
+        if server.inject_error():
+            self.send_content(503, "Service unavailable.\n")
+            return
+
+        match = main_url_pattern.match(self.path)
+        if match is not None:
+            oeis_id = int(match.group(1))
+            entry = server.get_entry(oeis_id, fetch_main = True)
+            if entry is not None:
+                self.send_content(200, entry[0])
+            else:
+                self.send_content(200, make_missing_content(oeis_id))
+            return
+
+        match = bfile_url_pattern.match(self.path)
+        if match is not None and match.group(1) == match.group(2):
+            oeis_id = int(match.group(1))
+            entry = server.get_entry(oeis_id, fetch_main = False)
+            if entry is not None:
+                self.send_validated_content(entry[1], entry[2])
+                return
+
+        self.send_content(404, "Not found.\n")
+
+class MockOeisServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    request_queue_size = 1024 # The default listen backlog (5) drops connections when many clients connect at once.
+
+    def __init__(self, address, highest_oeis_id = 300000, latency = 0.0, content = None,
+                 latency_jitter = 0.0, error_rate = 0.0, mutation_rate = 0.0, rate_limit = None, seed = None):
+
+        # Handle defaults
+
+        if content is None:
+            content = SynthesizedContent(highest_oeis_id)
+
+        super().__init__(address, MockOeisRequestHandler)
+
+        self.content         = content
+        self.highest_oeis_id = content.highest_oeis_id
+        self.latency         = latency
+        self.latency_jitter  = latency_jitter
+        self.error_rate      = error_rate
+        self.mutation_rate   = mutation_rate
+
+        self._lock      = threading.Lock()
+        self._random    = random.Random(seed)
+        self._bucket    = None if rate_limit is None else TokenBucket(rate_limit, capacity = max(1.0, rate_limit))
+        self._revisions = {} # oeis_id -> (revision, timestamp of the revision) for mutated entries.
+
+        self.status_counts = collections.Counter()
+
+    def base_url(self):
+        (host, port) = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def count_response(self, status):
+        with self._lock:
+            self.status_counts[status] += 1
+
+    def admit_request(self):
+        """Take a request from the rate limit. Returns None if the request is admitted, or the number of seconds to retry after."""
+
+        if self._bucket is None:
+            return None
+
+        with self._lock:
+            delay = self._bucket.reserve(1)
+            if delay <= 0.0:
+                return None
+            self._bucket.tokens += 1 # A rejected request does not count.
+            return math.ceil(delay)
+
+    def response_delay(self):
+        with self._lock:
+            return self.latency + self._random.uniform(0.0, self.latency_jitter)
+
+    def inject_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def get_entry(self, oeis_id, fetch_main):
+        """Return (main_content, bfile_content, timestamp) for an entry, including its mutations, or None if the entry does not exist.
+
+        A fetch of the main content may mutate the entry first, see 'mutation_rate'.
+        """
+
+        entry = self.content.get_entry(oeis_id)
+        if entry is None:
+            return None
+
+        with self._lock:
+            (revision, t_revision) = self._revisions.get(oeis_id, (0, None))
+            if fetch_main and self._random.random() < self.mutation_rate:
+                (revision, t_revision) = (revision + 1, time.time())
+                self._revisions[oeis_id] = (revision, t_revision)
+
+        if revision == 0:
+            return entry
+
+        (main_content, bfile_content, timestamp) = entry
+
+        return (mutate_main_content(oeis_id, main_content, revision), mutate_bfile_content(bfile_content, revision), max(timestamp, t_revision))
+
+def start_mock_server(highest_oeis_id = 300000, latency = 0.0, port = 0, content = None,
+                      latency_jitter = 0.0, error_rate = 0.0, mutation_rate = 0.0, rate_limit = None, seed = None):
+    """Start a mock server in a background thread. Use 'server.shutdown()' to stop it."""
+
+    server = MockOeisServer(("127.0.0.1", port), highest_oeis_id, latency, content, latency_jitter, error_rate, mutation_rate, rate_limit, seed)
+
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    return server
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Run a local stand-in for the oeis.org server.")
+    parser.add_argument("--port"           , type = int  , default = 8000  , help = "TCP port to listen on (default: 8000)")
+    parser.add_argument("--highest-oeis-id", type = int  , default = 300000, help = "highest entry ID that exists (default: 300000)")
+    parser.add_argument("--latency"        , type = float, default = 0.0   , help = "delay before each response, in seconds (default: 0)")
+    parser.add_argument("--latency-jitter" , type = float, default = 0.0   , help = "maximum random extra delay before each response, in seconds (default: 0)")
+    parser.add_argument("--error-rate"     , type = float, default = 0.0   , help = "fraction of requests that fail with HTTP status 503 (default: 0)")
+    parser.add_argument("--mutation-rate"  , type = float, default = 0.0   , help = "probability that an entry changes when it is fetched (default: 0)")
+    parser.add_argument("--rate-limit"     , type = float, default = None  , help = "requests per second accepted before answering HTTP status 429 (default: unlimited)")
+    parser.add_argument("--seed"           , type = int  , default = None  , help = "seed of the random number generator used for injection")
+    parser.add_argument("--database"       , default = None, help = "serve the entries of this local sqlite3 database instead of synthesized entries")
+    args = parser.parse_args()
+
+    with setup_logging(None):
+        content = None if args.database is None else DatabaseContent(args.database)
+        server = MockOeisServer(("127.0.0.1", args.port), args.highest_oeis_id, args.latency, content,
+                                args.latency_jitter, args.error_rate, args.mutation_rate, args.rate_limit, args.seed)
+        logger.info("Serving mock OEIS database ({} entries) at {} ...".format(server.highest_oeis_id, server.base_url()))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Keyboard interrupt request received, stopping server ...")
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 """A module to parse a fetched OEIS entry and its associated b-file into an object representation."""
 
 import re
+import sys
+import zlib
+import array
+import pickle
 import logging
 import collections
 
@@ -9,29 +13,99 @@ from charmap import acceptable_characters
 logger = logging.getLogger(__name__)
 
 class OeisEntry:
+    """A parsed OEIS entry.
+
+    A database of entries is kept in memory as a whole by several scripts, so entries are stored compactly: the entry
+    uses __slots__, its values are an array of 64-bit integers where possible (see 'compact_values'), and its keywords
+    are interned strings. The text fields other than the name are pickled together as a single zlib-compressed blob;
+    an unpickled entry only decodes them when one of them is accessed, and does not keep the decoded text.
+
+    Entries that were pickled as instances with a __dict__, by earlier versions of this class, can still be unpickled.
+    """
+
+    # The text fields that are stored compressed in a pickled entry.
+
+    text_fields = ("comments", "detailed_references", "links", "formulas", "examples", "maple_programs", "mathematica_programs",
+                   "other_programs", "cross_references", "author", "extensions_and_errors")
+
+    __slots__ = ("oeis_id", "identification", "values", "name", "keywords", "offset_a", "offset_b", "_text")
+
     def __init__(self, oeis_id, identification, values, name, comments, detailed_references, links, formulas, examples,
                  maple_programs, mathematica_programs, other_programs, cross_references, keywords, offset_a, offset_b, author, extensions_and_errors):
         self.oeis_id               = oeis_id
         self.identification        = identification
-        self.values                = values
+        self.values                = values if isinstance(values, array.array) else compact_values(list(values))
         self.name                  = name
-        self.comments              = comments
-        self.detailed_references   = detailed_references
-        self.links                 = links
-        self.formulas              = formulas
-        self.examples              = examples
-        self.maple_programs        = maple_programs
-        self.mathematica_programs  = mathematica_programs
-        self.other_programs        = other_programs
-        self.cross_references      = cross_references
-        self.keywords              = keywords
+        self.keywords              = [sys.intern(keyword) for keyword in keywords]
         self.offset_a              = offset_a
         self.offset_b              = offset_b
-        self.author                = author
-        self.extensions_and_errors = extensions_and_errors
+        self._text                 = (comments, detailed_references, links, formulas, examples, maple_programs, mathematica_programs,
+                                      other_programs, cross_references, author, extensions_and_errors)
     def __str__(self):
         return "A{:06d}".format(self.oeis_id)
 
+    def _text_values(self):
+        """Return the values of the text fields, decoding them if necessary."""
+        if isinstance(self._text, bytes):
+            return pickle.loads(zlib.decompress(self._text))
+        return self._text
+
+    def _text_field(index):
+        """Make a property for the text field at the given index in 'text_fields'."""
+        def get_text_field(self):
+            return self._text_values()[index]
+        def set_text_field(self, value):
+            text_values = list(self._text_values())
+            text_values[index] = value
+            self._text = tuple(text_values)
+        return property(get_text_field, set_text_field)
+
+    comments              = _text_field( 0)
+    detailed_references   = _text_field( 1)
+    links                 = _text_field( 2)
+    formulas              = _text_field( 3)
+    examples              = _text_field( 4)
+    maple_programs        = _text_field( 5)
+    mathematica_programs  = _text_field( 6)
+    other_programs        = _text_field( 7)
+    cross_references      = _text_field( 8)
+    author                = _text_field( 9)
+    extensions_and_errors = _text_field(10)
+
+    del _text_field
+
+    @property
+    def offset(self):
+        """The offset as a list of one or two numbers, as stored by earlier versions of this class."""
+        return [offset for offset in (self.offset_a, self.offset_b) if offset is not None]
+
+    def __getstate__(self):
+
+        text = self._text
+        if not isinstance(text, bytes):
+            text = zlib.compress(pickle.dumps(text))
+
+        return (self.oeis_id, self.identification, self.values, self.name, self.keywords, self.offset_a, self.offset_b, text)
+
+    def __setstate__(self, state):
+
+        if isinstance(state, tuple):
+            (self.oeis_id, self.identification, self.values, self.name, self.keywords, self.offset_a, self.offset_b, self._text) = state
+            self.keywords = [sys.intern(keyword) for keyword in self.keywords]
+            return
+
+        # The instance dictionary of an entry pickled by an earlier version of this class.
+
+        if "offset" in state and "offset_a" not in state:
+            offset = list(state["offset"] or [])
+            state = dict(state, offset_a = offset[0] if len(offset) > 0 else None, offset_b = offset[1] if len(offset) > 1 else None)
+
+        self.__init__(state.get("oeis_id"), state.get("identification"), state.get("values", []), state.get("name"), state.get("comments"),
+                      state.get("detailed_references"), state.get("links"), state.get("formulas"), state.get("examples"),
+                      state.get("maple_programs"), state.get("mathematica_programs"), state.get("other_programs"),
+                      state.get("cross_references"), state.get("keywords", []), state.get("offset_a"), state.get("offset_b"),
+                      state.get("author"), state.get("extensions_and_errors"))
+
 expected_directive_order = re.compile("I(?:S|ST|STU)(?:|V|VW|VWX)NC*D*H*F*e*p*t*o*Y*KO?A?E*$")
 
 identification_pattern = re.compile("[MN][0-9]{4}( [MN][0-9]{4})*$")
@@ -84,6 +158,21 @@ expected_keywords_set = frozenset(expected_keywords)
 
 bfile_line_pattern = re.compile("(-?[0-9]+)[ \t]+(-?[0-9]+)")
 
+# A b-file in the regular format: lines with an index and a value separated by a single space. See 'parse_bfile_content_in_bulk'.
+
+regular_bfile_pattern = re.compile("(?:-?[0-9]+ -?[0-9]+\n)*(?:-?[0-9]+ -?[0-9]+)?")
+
+BFILE_CHUNK_SIZE = 1 << 16
+
+# A value list is canonical if it is reproduced exactly by joining the string representations of its integer values.
+
+canonical_value_list_pattern = re.compile("(?:0|-?[1-9][0-9]*)(?:,(?:0|-?[1-9][0-9]*))*")
+
+# For each directive that has a set of acceptable characters, a pattern that matches any character outside that set.
+
+unacceptable_character_patterns = dict((directive, re.compile("[^{}]".format("".join(re.escape(c) for c in sorted(characters)))))
+                                       for (directive, characters) in acceptable_characters.items())
+
 def digits(n):
     return len(str(abs(n)))
 
@@ -105,7 +194,7 @@ def parse_optional_singleline_directive(dv, directive):
         assert len(dv[directive]) == 1
         return dv[directive][0]
 
-def parse_value_directives(dv, directives):
+def parse_value_directives(dv, directives, trusted = False):
 
     expect_next = 0 # -1 = no, 0 = maybe (first line), 1 = yes
 
@@ -136,7 +225,7 @@ def parse_value_directives(dv, directives):
 
     values = [int(value_string) for value_string in lines.split(",")]
 
-    assert ",".join(str(value) for value in values) == lines
+    assert trusted or canonical_value_list_pattern.fullmatch(lines)
     return values
 
 def check_keywords(oeis_id, keywords):
@@ -178,7 +267,88 @@ def check_keywords(oeis_id, keywords):
         if ("nonn" not in keywords) and ("sign" not in keywords):
             logger.warning("A{:06} (P30) Keyword 'nonn' or 'sign' are both absent.".format(oeis_id))
 
+def compact_values(values):
+    """Return a list of values as an array of 64-bit integers if they all fit, or as the list itself otherwise."""
+    try:
+        return array.array("q", values)
+    except OverflowError:
+        return values
+
+def parse_bfile_content_in_bulk(bfile_content):
+    """Parse a b-file in the regular format in bulk, without handling its lines one by one.
+
+    The regular format consists of leading comment lines, followed by lines with an index and a value separated by a
+    single space, with sequential indexes. Return (first_index, values) as 'parse_bfile_content' would, or None if the b-file is not in that format.
+
+    The b-file is processed in chunks of about BFILE_CHUNK_SIZE characters, to bound the memory used for intermediate results.
+    """
+
+    # Skip the leading comment lines.
+
+    start = 0
+    while bfile_content.startswith("#", start):
+        end = bfile_content.find("\n", start)
+        start = len(bfile_content) if end < 0 else end + 1
+
+    first_index = None
+    next_index  = None
+
+    values = array.array("q")
+
+    while start < len(bfile_content):
+
+        end = bfile_content.find("\n", min(start + BFILE_CHUNK_SIZE, len(bfile_content) - 1))
+        end = len(bfile_content) if end < 0 else end + 1
+
+        chunk = bfile_content[start:end]
+
+        if regular_bfile_pattern.fullmatch(chunk) is None:
+            return None
+
+        # The lines of the chunk are now known to hold exactly two numbers each, so the numbers can be split off in one go.
+
+        numbers = chunk.split()
+
+        indexes = list(map(int, numbers[0::2]))
+
+        if first_index is None:
+            first_index = next_index = indexes[0]
+
+        if indexes != list(range(next_index, next_index + len(indexes))):
+            return None
+
+        next_index += len(indexes)
+
+        # Avoid building a list of Python integers for values that fit in 64 bits.
+
+        value_strings = numbers[1::2]
+
+        if isinstance(values, array.array):
+            try:
+                values.extend(array.array("q", map(int, value_strings)))
+            except OverflowError:
+                values = values.tolist()
+
+        if isinstance(values, list):
+            values.extend(map(int, value_strings))
+
+        start = end
+
+    return (first_index, values)
+
 def parse_bfile_content(oeis_id, bfile_content):
+    """Parse a b-file, and return (first_index, values).
+
+    The values are an array of 64-bit integers, unless some value does not fit; then they are a list of Python integers.
+    Parsing stops at the first line that cannot be parsed (P12), or that has a non-sequential index (P08).
+    """
+
+    # Most b-files are in the regular format, and are parsed in bulk. Any other b-file is parsed line by line,
+    # which issues the diagnostics.
+
+    result = parse_bfile_content_in_bulk(bfile_content)
+    if result is not None:
+        return result
 
     lines = bfile_content.split("\n")
 
@@ -216,9 +386,28 @@ def parse_bfile_content(oeis_id, bfile_content):
 
     first_index = indexes[0] if len(indexes) > 0 else None
 
-    return (first_index, values)
+    return (first_index, compact_values(values))
+
+def tokenize_main_content(oeis_id, main_content):
+    """Yield (line_nr, directive, raw_value) for the directive lines of an entry's main content, in a single pass.
+
+    Directive lines are matched as by the pattern "%(.) A{:06}(.*)$" (multiline). The raw value includes the separating space.
+    The line number is None for a directive that does not start at the beginning of its line.
+    """
+
+    prefix = " A{:06}".format(oeis_id)
 
-def parse_main_content(oeis_id, main_content):
+    value_start = 2 + len(prefix)
+
+    for (line_nr, line) in enumerate(main_content.split("\n")):
+        if line.startswith(prefix, 2) and line.startswith("%"):
+            yield (line_nr, line[1], line[value_start:])
+        elif "%" in line:
+            # A directive may also be found further along a line; this does not happen for well-formed content.
+            for (directive, raw_value) in re.findall("%(.) A{:06}(.*)$".format(oeis_id), line):
+                yield (None, directive, raw_value)
+
+def parse_main_content(oeis_id, main_content, trusted = False, ingested = False):
 
     # The order and count of expected directives, for any given entry, is as follows:
     #
@@ -240,40 +429,52 @@ def parse_main_content(oeis_id, main_content):
     # - %A   zero or one        Author, submitter, or authority.
     # - %E   zero or more       Extensions and errors.
 
-    # Select only lines that have the proper directive format.
+    # With 'trusted' set, the diagnostics that only re-check the format of the content (P10, P17, and the exact
+    # reproduction of the value lists) are skipped. The warnings that concern the meaning of the entry are still issued.
+    #
+    # With 'ingested' set, the entry was synthesized from the dump files ('ingest_oeis_dump.py'), which have neither
+    # the author nor (unless there is a b-file) the offset. Their absence is expected, and not reported (P01, P02).
 
-    directive_line_pattern = "%(.) A{:06}(.*)$".format(oeis_id)
+    header = "# Greetings from The On-Line Encyclopedia of Integer Sequences! http://oeis.org/\n\nSearch: id:a{:06}\nShowing 1-1 of 1\n\n".format(oeis_id)
+    footer = "\n# Content is available under The OEIS End-User License Agreement: http://oeis.org/LICENSE\n"
 
-    lines = re.findall(directive_line_pattern, main_content, re.MULTILINE)
+    # Select only lines that have the proper directive format, and remove the space between Axxxxxx and value.
+    #
+    # The main content can be reconstructed from its directive lines (P17) if it consists of the header (5 lines),
+    # followed by consecutive directive lines that are in canonical format, followed by the footer (3 lines, the first
+    # of which is empty).
+
+    lines = []
 
-    # remove space between Axxxxxx and value
+    reconstructable = True
+    expected_line_nr = 5
 
-    new_lines = []
-    for (directive, directive_value) in lines:
+    for (line_nr, directive, directive_value) in tokenize_main_content(oeis_id, main_content):
         if directive_value != "":
             if directive_value.startswith(" "):
                 directive_value = directive_value[1:]
                 if directive_value == "":
                     logger.warning("[A{:06}] (P18) The %{} directive has a trailing space but no value.".format(oeis_id, directive))
+                    reconstructable = False
             else:
                 logger.warning("[A{:06}] (P16) The %{} directive should have a space before the start of its value.".format(oeis_id, directive))
+                reconstructable = False
 
-        new_lines.append((directive, directive_value))
+        if line_nr != expected_line_nr:
+            reconstructable = False
 
-    lines = new_lines
-    del new_lines
+        expected_line_nr += 1
 
-    if True: # check format
+        lines.append((directive, directive_value))
 
-        header = "# Greetings from The On-Line Encyclopedia of Integer Sequences! http://oeis.org/\n\nSearch: id:a{:06}\nShowing 1-1 of 1\n\n".format(oeis_id)
+    if not trusted: # check format
 
-        check_main_content = ["%{} A{:06}{}{}\n".format(directive, oeis_id, "" if directive_value == "" else " ", directive_value) for (directive, directive_value) in lines]
+        reconstructable = reconstructable and expected_line_nr == main_content.count("\n") - 2 and \
+            len(main_content) >= len(header) + len(footer) and main_content.startswith(header) and main_content.endswith("\n" + footer)
 
-        footer = "\n# Content is available under The OEIS End-User License Agreement: http://oeis.org/LICENSE\n"
-
-        check_main_content = header + "".join(check_main_content) + footer
-
-        if main_content != check_main_content:
+        if not reconstructable:
+            check_main_content = ["%{} A{:06}{}{}\n".format(directive, oeis_id, "" if directive_value == "" else " ", directive_value) for (directive, directive_value) in lines]
+            check_main_content = header + "".join(check_main_content) + footer
             logger.warning("[A{:06}] (P17) Main content reconstruction failed.".format(oeis_id))
             logger.info   ("[A{:06}]       original ............ : {!r}.".format(oeis_id, main_content))
             logger.info   ("[A{:06}]       reconstruction ...... : {!r}.".format(oeis_id, check_main_content))
@@ -295,16 +496,16 @@ def parse_main_content(oeis_id, main_content):
 
         dv[directive].append(value)
 
-        if directive in acceptable_characters:
-            unacceptable_characters = set(value) - acceptable_characters[directive]
-            if unacceptable_characters:
+        if not trusted and directive in unacceptable_character_patterns:
+            if unacceptable_character_patterns[directive].search(value):
+                unacceptable_characters = set(value) - acceptable_characters[directive]
                 logger.warning("[A{:06}] (P10) Unacceptable characters in value of %{} directive ({!r}): {}.".format(oeis_id, directive, value, ", ".join(["{!r}".format(c) for c in sorted(unacceptable_characters)])))
 
     # ========== parse all directives
 
     identification        = parse_mandatory_singleline_directive (dv, 'I')
-    stu_values            = parse_value_directives               (dv, "STU")
-    vwx_values            = parse_value_directives               (dv, "VWX")
+    stu_values            = parse_value_directives               (dv, "STU", trusted)
+    vwx_values            = parse_value_directives               (dv, "VWX", trusted)
     name                  = parse_mandatory_singleline_directive (dv, 'N')
     comments              = parse_optional_multiline_directive   (dv, 'C')
     detailed_references   = parse_optional_multiline_directive   (dv, 'D')
@@ -324,6 +525,8 @@ def parse_main_content(oeis_id, main_content):
 
     # We parse the keywords first, they may influence the warnings.
 
+    line_K = keywords
+
     keywords = keywords.split(",")
 
     # Check for unexpected keywords.
@@ -385,13 +588,14 @@ def parse_main_content(oeis_id, main_content):
 
     # ========== process %A directive
 
-    if author is None:
+    if author is None and not ingested:
         logger.warning("[A{:06}] (P01) Missing %A directive.".format(oeis_id))
 
     # ========== process %O directive
 
     if offset is None:
-        logger.warning("[A{:06}] (P02) Missing %O directive.".format(oeis_id))
+        if not ingested:
+            logger.warning("[A{:06}] (P02) Missing %O directive.".format(oeis_id))
         offset_a = None
         offset_b = None
     else:
@@ -410,11 +614,11 @@ def parse_main_content(oeis_id, main_content):
     return (identification, main_values, name, comments, detailed_references, links, formulas, examples,
             maple_programs, mathematica_programs, other_programs, cross_references, canonized_keywords, offset_a, offset_b, author, extensions_and_errors)
 
-def parse_oeis_entry(oeis_id, main_content, bfile_content):
+def parse_oeis_entry(oeis_id, main_content, bfile_content, trusted = False, ingested = False):
 
     (identification, main_values, name, comments, detailed_references, links, formulas, examples,
      maple_programs, mathematica_programs, other_programs, cross_references, keywords, offset_a, offset_b, author, extensions_and_errors) = \
-        parse_main_content (oeis_id, main_content)
+        parse_main_content (oeis_id, main_content, trusted, ingested)
 
     (bfile_first_index, bfile_values) = parse_bfile_content(oeis_id, bfile_content)
 
@@ -441,11 +645,11 @@ def parse_oeis_entry(oeis_id, main_content, bfile_content):
 
     if offset_b is not None:
 
-        indexes_where_magnitude_exceeds_1 = [i for i in range(len(values)) if abs(values[i]) > 1]
+        index_where_magnitude_exceeds_1 = next((i for (i, value) in enumerate(values) if abs(value) > 1), None)
 
-        if len(indexes_where_magnitude_exceeds_1) > 0:
+        if index_where_magnitude_exceeds_1 is not None:
 
-            first_index_where_magnitude_exceeds_1 = 1 + min(indexes_where_magnitude_exceeds_1)
+            first_index_where_magnitude_exceeds_1 = 1 + index_where_magnitude_exceeds_1
 
             if offset_b != first_index_where_magnitude_exceeds_1:
                 logger.error("[A{:06}] (P09) %O directive claims first index where magnitude exceeds 1 is {}, but values suggest this should be {}.".format(oeis_id, offset_b, first_index_where_magnitude_exceeds_1))
@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+
+"""Version history of the entries in the crawler database, and a change log that downstream consumers can tail.
+
+When 'process_responses' finds that the content of an entry changed, it overwrites the entry in the 'oeis_entries' table.
+Before it does, the superseded version is kept in the 'oeis_revisions' table, as a compact delta against its successor:
+
+    oeis_revisions   one row per change, in the order in which the changes were found. New entries get a row as well,
+                     without deltas. The revision ID is the position in the change log.
+
+A delta is a zlib-compressed list of varint-encoded operations that rebuild the superseded text from the lines of its successor:
+
+    DELTA_COPY   start, count   copy 'count' lines of the successor, starting at line 'start'.
+    DELTA_INSERT size, data     insert 'size' bytes of UTF-8 text that does not occur in the successor.
+
+Most changes touch a few lines of the main content, or extend a b-file, so a delta is usually a few dozen bytes.
+
+Consumers of the change log ('read_change_log') remember the ID of the last change they processed, and ask for the
+changes after it. 'entry_as_of' reconstructs the content of an entry at a given time, by applying the deltas of the
+changes after that time to the current content, newest first.
+
+This script can also be used from the command line:
+
+    oeis_revisions.py changes [--since REVISION_ID] [--limit N] [database]    print the change log.
+    oeis_revisions.py as-of OEIS_ID YYYY-MM-DD [database]                     print an entry as it was on the given date.
+"""
+
+import sys
+import zlib
+import time
+import difflib
+import logging
+import argparse
+import datetime
+import collections
+
+from content_compression import encode_varint, decode_varint, decode_content, load_content_dictionaries
+from xz_snapshot_reader  import open_database
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# The parts of an entry that changed, as a bit mask.
+
+CHANGED_MAIN  = 1
+CHANGED_BFILE = 2
+CHANGED_NEW   = 4 # The entry was fetched for the first time; it has no superseded version.
+
+DELTA_COPY   = 0
+DELTA_INSERT = 1
+
+Change = collections.namedtuple("Change", "revision_id oeis_id timestamp changed")
+
+def ensure_revisions_table_created(dbconn):
+    """Ensure that the 'oeis_revisions' table is present in the database."""
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS oeis_revisions (
+                 revision_id   INTEGER  PRIMARY KEY NOT NULL, -- position in the change log.
+                 oeis_id       INTEGER              NOT NULL, -- OEIS ID number.
+                 timestamp     REAL                 NOT NULL, -- timestamp of the fetch that found the change (t1 of the new version).
+                 changed       INTEGER              NOT NULL, -- the parts that changed: CHANGED_MAIN, CHANGED_BFILE, and/or CHANGED_NEW.
+                 t1            REAL                         , -- t1 of the superseded version; NULL for new entries.
+                 t2            REAL                         , -- t2 of the superseded version; NULL for new entries.
+                 main_delta    BLOB                         , -- delta that rebuilds the superseded main content; NULL if unchanged.
+                 bfile_delta   BLOB                           -- delta that rebuilds the superseded b-file content; NULL if unchanged.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+    dbconn.execute("CREATE INDEX IF NOT EXISTS oeis_revisions_oeis_id ON oeis_revisions(oeis_id, timestamp);")
+
+    dbconn.commit()
+
+def make_delta(old_text, new_text):
+    """Return a delta from which 'old_text' can be rebuilt, given 'new_text'."""
+
+    old_lines = old_text.splitlines(keepends = True)
+    new_lines = new_text.splitlines(keepends = True)
+
+    # The common prefix and suffix are matched directly. Most changes are local edits or an extended b-file,
+    # so this leaves little for the (much slower) SequenceMatcher.
+
+    prefix = 0
+    while prefix < min(len(old_lines), len(new_lines)) and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+
+    suffix = 0
+    while suffix < min(len(old_lines), len(new_lines)) - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+
+    matcher = difflib.SequenceMatcher(None, new_lines[prefix:len(new_lines) - suffix], old_lines[prefix:len(old_lines) - suffix], autojunk = False)
+
+    opcodes = [("equal", 0, prefix, 0, prefix)]
+    opcodes.extend((tag, prefix + i1, prefix + i2, prefix + j1, prefix + j2) for (tag, i1, i2, j1, j2) in matcher.get_opcodes())
+    opcodes.append(("equal", len(new_lines) - suffix, len(new_lines), len(old_lines) - suffix, len(old_lines)))
+
+    out = bytearray()
+
+    for (tag, i1, i2, j1, j2) in opcodes:
+        if tag == "equal":
+            if i2 > i1:
+                encode_varint(DELTA_COPY, out)
+                encode_varint(i1, out)
+                encode_varint(i2 - i1, out)
+        elif j2 > j1: # 'replace' or 'insert'; lines that only occur in the new text ('delete') are simply not copied.
+            data = "".join(old_lines[j1:j2]).encode("utf-8")
+            encode_varint(DELTA_INSERT, out)
+            encode_varint(len(data), out)
+            out += data
+
+    return zlib.compress(bytes(out), 9)
+
+def apply_delta(new_text, delta):
+    """Rebuild the old text from the new text and a delta made by 'make_delta'."""
+
+    new_lines = new_text.splitlines(keepends = True)
+
+    data = zlib.decompress(delta)
+
+    parts = []
+
+    position = 0
+    while position < len(data):
+        (operation, position) = decode_varint(data, position)
+        if operation == DELTA_COPY:
+            (start, position) = decode_varint(data, position)
+            (count, position) = decode_varint(data, position)
+            parts.extend(new_lines[start:start + count])
+        elif operation == DELTA_INSERT:
+            (size, position) = decode_varint(data, position)
+            parts.append(data[position:position + size].decode("utf-8"))
+            position += size
+        else:
+            raise ValueError("Bad delta operation {}.".format(operation))
+
+    return "".join(parts)
+
+def record_revisions(dbcursor, new_contents, status_new, status_updated):
+    """Record the changes found in a batch of responses, and keep the superseded versions of the updated entries.
+
+    This is called by 'process_responses', inside its transaction, after the staged responses have been classified,
+    and before the 'oeis_entries' table is updated. 'new_contents' maps the OEIS IDs of the responses to their
+    (main_content, bfile_download) pair; the b-file download is None if the b-file was not fetched, or did not change.
+    """
+
+    # New entries have no superseded version.
+
+    query = """
+            INSERT INTO main.oeis_revisions(oeis_id, timestamp, changed)
+                SELECT oeis_id, timestamp, ? FROM temp.staged_responses WHERE status = ? ORDER BY oeis_id;
+            """
+    dbcursor.execute(query, (CHANGED_NEW | CHANGED_MAIN | CHANGED_BFILE, status_new))
+
+    # Only the content that changed is read back from the database.
+
+    query = """
+            SELECT s.oeis_id, s.timestamp, e.t1, e.t2,
+                   CASE WHEN e.main_digest IS s.main_digest THEN NULL ELSE e.main_content END,
+                   CASE WHEN e.bfile_digest IS s.bfile_digest THEN NULL ELSE e.bfile_content END
+            FROM temp.staged_responses AS s, main.oeis_entries AS e WHERE s.status = ? AND e.oeis_id = s.oeis_id ORDER BY s.oeis_id;
+            """
+    dbcursor.execute(query, (status_updated, ))
+    superseded_versions = dbcursor.fetchall()
+
+    revision_rows = []
+
+    for (oeis_id, timestamp, t1, t2, old_main_content, old_bfile_content) in superseded_versions:
+
+        (main_content, bfile_download) = new_contents[oeis_id]
+
+        changed = 0
+        main_delta = None
+        bfile_delta = None
+
+        if old_main_content is not None:
+            changed |= CHANGED_MAIN
+            main_delta = make_delta(decode_content(old_main_content), main_content)
+
+        if old_bfile_content is not None and bfile_download is not None:
+            changed |= CHANGED_BFILE
+            bfile_delta = make_delta(decode_content(old_bfile_content), bfile_download.text())
+
+        revision_rows.append((oeis_id, timestamp, changed, t1, t2, main_delta, bfile_delta))
+
+    query = "INSERT INTO main.oeis_revisions(oeis_id, timestamp, changed, t1, t2, main_delta, bfile_delta) VALUES (?, ?, ?, ?, ?, ?, ?);"
+    dbcursor.executemany(query, revision_rows)
+
+def read_change_log(dbconn, after_revision_id = 0, limit = 1000):
+    """Return the changes after the given revision ID, as a list of Change tuples, oldest first.
+
+    A consumer processes the changes, remembers the revision ID of the last one, and passes it in the next call.
+    """
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+        dbcursor.execute("SELECT revision_id, oeis_id, timestamp, changed FROM oeis_revisions WHERE revision_id > ? ORDER BY revision_id LIMIT ?;", (after_revision_id, limit))
+        return [Change(*row) for row in dbcursor.fetchall()]
+
+def entry_as_of(dbconn, oeis_id, timestamp):
+    """Return the (main_content, bfile_content) of an entry as it was known at the given time.
+
+    This is the version fetched most recently at or before that time. Returns None if the entry had not been fetched yet.
+    """
+
+    with close_when_done(dbconn.cursor()) as dbcursor:
+
+        dbcursor.execute("SELECT t1, main_content, bfile_content FROM oeis_entries WHERE oeis_id = ?;", (oeis_id, ))
+        row = dbcursor.fetchone()
+
+        if row is None:
+            return None
+
+        (t1, main_content, bfile_content) = row
+
+        main_content  = decode_content(main_content)
+        bfile_content = decode_content(bfile_content)
+
+        if timestamp >= t1:
+            return (main_content, bfile_content)
+
+        # Undo the changes found after the given time, newest first.
+
+        dbcursor.execute("SELECT changed, t1, main_delta, bfile_delta FROM oeis_revisions WHERE oeis_id = ? AND timestamp > ? ORDER BY timestamp DESC, revision_id DESC;", (oeis_id, timestamp))
+
+        for (changed, t1, main_delta, bfile_delta) in dbcursor:
+
+            if changed & CHANGED_NEW:
+                return None
+
+            if main_delta is not None:
+                main_content = apply_delta(main_content, main_delta)
+
+            if bfile_delta is not None:
+                bfile_content = apply_delta(bfile_content, bfile_delta)
+
+            if timestamp >= t1:
+                return (main_content, bfile_content)
+
+    # The history of the entry does not go back that far (e.g., it was fetched before revisions were kept).
+
+    return None
+
+def describe_changes(changed):
+    return ", ".join(name for (flag, name) in ((CHANGED_NEW, "new"), (CHANGED_MAIN, "main"), (CHANGED_BFILE, "b-file")) if changed & flag)
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Show the change log of a local sqlite3 OEIS database, or an entry as it was at a given date.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    parser_changes = subparsers.add_parser("changes", help = "print the change log")
+    parser_changes.add_argument("--since", type = int, default = 0   , help = "print the changes after this revision ID (default: 0)")
+    parser_changes.add_argument("--limit", type = int, default = 1000, help = "maximum number of changes to print (default: 1000)")
+    parser_changes.add_argument("database_filename", nargs = "?", default = "oeis.sqlite3", help = "sqlite3 database (default: oeis.sqlite3)")
+
+    parser_as_of = subparsers.add_parser("as-of", help = "print an entry as it was on a given date")
+    parser_as_of.add_argument("oeis_id", type = lambda value: int(value.lstrip("Aa")), help = "OEIS ID, e.g. A000045")
+    parser_as_of.add_argument("date", type = datetime.date.fromisoformat, help = "date (YYYY-MM-DD); the entry is shown as it was at the end of that day (UTC)")
+    parser_as_of.add_argument("database_filename", nargs = "?", default = "oeis.sqlite3", help = "sqlite3 database (default: oeis.sqlite3)")
+
+    args = parser.parse_args()
+
+    with setup_logging(None), close_when_done(open_database(args.database_filename)) as dbconn:
+
+        if args.command == "changes":
+            for change in read_change_log(dbconn, args.since, args.limit):
+                print("{}\tA{:06}\t{}\t{}".format(change.revision_id, change.oeis_id, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(change.timestamp)), describe_changes(change.changed)))
+            return
+
+        load_content_dictionaries(dbconn)
+
+        timestamp = datetime.datetime.combine(args.date + datetime.timedelta(days = 1), datetime.time(), datetime.timezone.utc).timestamp()
+
+        entry = entry_as_of(dbconn, args.oeis_id, timestamp)
+
+        if entry is None:
+            logger.error("Entry A{:06} is not known as of {}.".format(args.oeis_id, args.date))
+            sys.exit(1)
+
+        (main_content, bfile_content) = entry
+
+        sys.stdout.write(main_content)
+        sys.stdout.write(bfile_content)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""Parallel compression to, and block index reading of, the '.xz' file format.
+
+The 'lzma' module compresses on a single thread. This module splits the input into chunks, compresses the chunks
+independently on a process pool, and assembles the results into a single standard xz stream with one block per chunk
+and a combined index. The output can be decompressed by stock 'xz', and by the 'lzma' module.
+
+Each chunk is compressed with 'lzma.compress' into a complete single-block xz stream. Since every stream uses the
+same check type, its block can be copied verbatim into the output stream; only the stream header, the index, and the
+stream footer are written by this module.
+
+The block index of an xz file gives the compressed and uncompressed offsets of every block. 'read_xz_block_index'
+reads it, so that a single block can be decompressed without decompressing the blocks before it.
+
+The format is described in "The .xz File Format", https://tukaani.org/xz/xz-file-format.txt.
+"""
+
+import os
+import lzma
+import struct
+import zlib
+import collections
+import multiprocessing
+import concurrent.futures
+
+STREAM_HEADER_MAGIC = b"\xfd7zXZ\x00"
+STREAM_FOOTER_MAGIC = b"YZ"
+
+STREAM_HEADER_SIZE = 12
+STREAM_FOOTER_SIZE = 12
+
+CHECK_SIZES = {lzma.CHECK_NONE: 0, lzma.CHECK_CRC32: 4, lzma.CHECK_CRC64: 8, lzma.CHECK_SHA256: 32}
+
+DEFAULT_CHUNK_SIZE = 64 * 1048576 # 64 MiB; equal to the dictionary size of presets 8 and 9.
+
+# The memory used by an xz compressor, by preset, in MiB (from the 'xz' manual page).
+
+COMPRESSOR_MEMORY = {0: 3, 1: 9, 2: 17, 3: 32, 4: 48, 5: 94, 6: 94, 7: 186, 8: 370, 9: 674}
+
+# A block as listed in the index of an xz file.
+#
+#   compressed_offset    offset of the block header in the file.
+#   unpadded_size        size of the block header, compressed data, and check (but not the block padding).
+#   uncompressed_offset  offset of the block's data in the uncompressed data.
+#   uncompressed_size    size of the block's uncompressed data.
+
+XzBlock = collections.namedtuple("XzBlock", ["compressed_offset", "unpadded_size", "uncompressed_offset", "uncompressed_size"])
+
+class XzFormatError(Exception):
+    def __init__(self, message):
+        self.message = message
+    def __str__(self):
+        return self.message
+
+def padded_size(size):
+    """Round 'size' up to a multiple of four."""
+    return (size + 3) & ~3
+
+def encode_multibyte_integer(value):
+    """Encode an integer in the variable-length format used by xz: 7 bits per byte, least significant group first."""
+
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+    return bytes(out)
+
+def decode_multibyte_integer(data, position):
+    """Decode an xz variable-length integer from 'data' at 'position'. Returns (value, new_position)."""
+
+    value = 0
+    for i in range(9):
+        byte = data[position + i]
+        value |= (byte & 0x7f) << (7 * i)
+        if byte < 0x80:
+            return (value, position + i + 1)
+
+    raise XzFormatError("Invalid multibyte integer.")
+
+def encode_stream_flags(check):
+    return bytes([0x00, check])
+
+def encode_stream_header(check):
+    flags = encode_stream_flags(check)
+    return STREAM_HEADER_MAGIC + flags + struct.pack("<I", zlib.crc32(flags))
+
+def encode_stream_footer(check, index_size):
+    flags = encode_stream_flags(check)
+    backward_size = struct.pack("<I", index_size // 4 - 1)
+    return struct.pack("<I", zlib.crc32(backward_size + flags)) + backward_size + flags + STREAM_FOOTER_MAGIC
+
+def encode_index(records):
+    """Encode an index, given a list of (unpadded_size, uncompressed_size) records."""
+
+    index = bytearray(b"\x00")
+    index += encode_multibyte_integer(len(records))
+    for (unpadded_size, uncompressed_size) in records:
+        index += encode_multibyte_integer(unpadded_size)
+        index += encode_multibyte_integer(uncompressed_size)
+
+    index += bytes(padded_size(len(index)) - len(index))
+    index += struct.pack("<I", zlib.crc32(index))
+
+    return bytes(index)
+
+def decode_index(data):
+    """Decode an index, returning a list of (unpadded_size, uncompressed_size) records."""
+
+    if data[0] != 0x00:
+        raise XzFormatError("Invalid index indicator.")
+
+    if struct.unpack("<I", data[-4:])[0] != zlib.crc32(data[:-4]):
+        raise XzFormatError("Index CRC32 mismatch.")
+
+    (count, position) = decode_multibyte_integer(data, 1)
+
+    records = []
+    for i in range(count):
+        (unpadded_size    , position) = decode_multibyte_integer(data, position)
+        (uncompressed_size, position) = decode_multibyte_integer(data, position)
+        records.append((unpadded_size, uncompressed_size))
+
+    return records
+
+def decode_stream_footer(footer):
+    """Decode a stream footer, returning (check, index_size)."""
+
+    if footer[10:12] != STREAM_FOOTER_MAGIC:
+        raise XzFormatError("Invalid stream footer magic.")
+
+    if struct.unpack("<I", footer[0:4])[0] != zlib.crc32(footer[4:10]):
+        raise XzFormatError("Stream footer CRC32 mismatch.")
+
+    (backward_size, ) = struct.unpack("<I", footer[4:8])
+    check = footer[9] & 0x0f
+
+    return (check, (backward_size + 1) * 4)
+
+def split_single_block_stream(stream):
+    """Split a complete xz stream with a single block, as produced by 'lzma.compress', into (check, block, unpadded_size, uncompressed_size).
+
+    The block is returned including its padding and check.
+    """
+
+    if stream[:6] != STREAM_HEADER_MAGIC:
+        raise XzFormatError("Invalid stream header magic.")
+
+    (check, index_size) = decode_stream_footer(stream[-STREAM_FOOTER_SIZE:])
+
+    index_start = len(stream) - STREAM_FOOTER_SIZE - index_size
+
+    records = decode_index(stream[index_start:len(stream) - STREAM_FOOTER_SIZE])
+
+    if len(records) != 1:
+        raise XzFormatError("Expected a single block, found {}.".format(len(records)))
+
+    (unpadded_size, uncompressed_size) = records[0]
+
+    block = stream[STREAM_HEADER_SIZE:index_start]
+
+    if len(block) != padded_size(unpadded_size):
+        raise XzFormatError("Block size does not match the index.")
+
+    return (check, block, unpadded_size, uncompressed_size)
+
+def compress_chunk(chunk, preset, check):
+    """Compress a chunk into a single xz block. Runs in a worker process."""
+    return split_single_block_stream(lzma.compress(chunk, format = lzma.FORMAT_XZ, check = check, preset = preset))
+
+def worker_memory_usage(preset, chunk_size = DEFAULT_CHUNK_SIZE):
+    """Return the approximate memory used per worker by 'compress_file_parallel', in bytes: its compressor, and two chunks in flight."""
+    return (COMPRESSOR_MEMORY[preset] << 20) + 2 * chunk_size
+
+def compress_file_parallel(from_filename, to_filename, preset = 6, check = lzma.CHECK_CRC64, chunk_size = DEFAULT_CHUNK_SIZE, max_workers = None, progress = None):
+    """Compress a file to a single multi-block xz stream, compressing the blocks in parallel on a process pool.
+
+    At most two chunks per worker are in flight, which bounds the memory use to about 2 * max_workers * chunk_size
+    plus the memory used by the compressors (for preset 9, about 700 MiB per worker); see 'worker_memory_usage'.
+    By default, there is one worker per CPU core.
+
+    The workers are started fresh ('spawn'), not forked: the caller may have other threads (e.g., the crawler's
+    fetch threads and asyncio loop), and a forked child would inherit their locks in whatever state they are in.
+
+    If given, 'progress' is called with (bytes_done, bytes_total) of the input after each block is written.
+    An exception raised by it aborts the compression; chunks that have not been started are not compressed.
+
+    Returns the number of blocks written.
+    """
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    records = []
+
+    bytes_total = os.path.getsize(from_filename)
+    bytes_done  = 0
+
+    with open(from_filename, "rb") as fi, open(to_filename, "wb") as fo, concurrent.futures.ProcessPoolExecutor(max_workers, mp_context = multiprocessing.get_context("spawn")) as pool:
+
+        fo.write(encode_stream_header(check))
+
+        pending = collections.deque()
+
+        def write_block(future):
+            nonlocal bytes_done
+            (block_check, block, unpadded_size, uncompressed_size) = future.result()
+            assert block_check == check
+            fo.write(block)
+            records.append((unpadded_size, uncompressed_size))
+            bytes_done += uncompressed_size
+            if progress is not None:
+                progress(bytes_done, bytes_total)
+
+        try:
+
+            while True:
+
+                chunk = fi.read(chunk_size)
+                if len(chunk) == 0:
+                    break
+
+                pending.append(pool.submit(compress_chunk, chunk, preset, check))
+
+                # Write the oldest block once the pipeline is full, so the blocks are written in order.
+
+                if len(pending) >= 2 * max_workers:
+                    write_block(pending.popleft())
+
+            while len(pending) > 0:
+                write_block(pending.popleft())
+
+        except BaseException:
+            # Do not wait for chunks that have not been started.
+            for future in pending:
+                future.cancel()
+            raise
+
+        index = encode_index(records)
+
+        fo.write(index)
+        fo.write(encode_stream_footer(check, len(index)))
+
+    return len(records)
+
+def read_xz_block_index(f):
+    """Read the block index of an xz file, given a binary file object that supports seeking.
+
+    Returns a list of XzBlock instances, ordered by offset. Files that consist of multiple concatenated streams,
+    possibly with stream padding in between, are supported.
+    """
+
+    f.seek(0, os.SEEK_END)
+    stream_end = f.tell()
+
+    streams = []
+
+    while stream_end > 0:
+
+        # Skip stream padding (a multiple of four null bytes).
+
+        f.seek(stream_end - 4)
+        if f.read(4) == b"\x00\x00\x00\x00":
+            stream_end -= 4
+            continue
+
+        f.seek(stream_end - STREAM_FOOTER_SIZE)
+        (check, index_size) = decode_stream_footer(f.read(STREAM_FOOTER_SIZE))
+
+        index_start = stream_end - STREAM_FOOTER_SIZE - index_size
+        f.seek(index_start)
+        records = decode_index(f.read(index_size))
+
+        stream_start = index_start - sum(padded_size(unpadded_size) for (unpadded_size, uncompressed_size) in records) - STREAM_HEADER_SIZE
+
+        f.seek(stream_start)
+        if f.read(6) != STREAM_HEADER_MAGIC:
+            raise XzFormatError("Invalid stream header magic at offset {}.".format(stream_start))
+
+        streams.append((stream_start, check, records))
+
+        stream_end = stream_start
+
+    blocks = []
+    uncompressed_offset = 0
+
+    for (stream_start, check, records) in reversed(streams):
+        compressed_offset = stream_start + STREAM_HEADER_SIZE
+        for (unpadded_size, uncompressed_size) in records:
+            blocks.append(XzBlock(compressed_offset, unpadded_size, uncompressed_offset, uncompressed_size))
+            compressed_offset   += padded_size(unpadded_size)
+            uncompressed_offset += uncompressed_size
+
+    return blocks
+
+def read_xz_stream_check(f):
+    """Return the check type of the first stream of an xz file."""
+
+    f.seek(0)
+    header = f.read(STREAM_HEADER_SIZE)
+
+    if header[:6] != STREAM_HEADER_MAGIC:
+        raise XzFormatError("Invalid stream header magic.")
+
+    return header[7] & 0x0f
+
+def decompress_xz_block(f, block, check):
+    """Decompress a single block of an xz file, given its XzBlock index entry and the check type of its stream.
+
+    The block is decompressed by wrapping it in a minimal stream of its own (header, block, index, and footer).
+    """
+
+    f.seek(block.compressed_offset)
+    data = f.read(padded_size(block.unpadded_size))
+
+    index = encode_index([(block.unpadded_size, block.uncompressed_size)])
+
+    stream = encode_stream_header(check) + data + index + encode_stream_footer(check, len(index))
+
+    return lzma.decompress(stream, format = lzma.FORMAT_XZ)
@@ -1,20 +1,46 @@
 #! /usr/bin/env python3
 
 # Code to process raw OEIS entries, by parsing them.
+#
+# The parsed database is updated incrementally: for each parsed entry, the digests of the content it was parsed from
+# are recorded in the 'parsed_sources' table. On the next run, only the entries that were added or changed since are
+# parsed, and the entries that disappeared are deleted. Use '--full' to parse all entries again (e.g., after a change
+# to the parser).
+#
+# By default, the entries are read by this process and parsed by a process pool. With '--sharded', each worker process
+# opens the source database read-only, parses its own range of entries into a shard database, and the shards are merged
+# into the output database; the entries then do not pass through this process, which would otherwise be the bottleneck.
+#
+# The value lists and keywords are stored in binary form; see 'value_list_encoding.py' for their encodings and decoders.
+#
+# Entries that were ingested from dump files and not fetched yet ('ingest_oeis_dump.py') are parsed without reporting
+# their missing %A and %O directives, and are marked with source = 'dump': their author is unknown, and so is their
+# offset if they have no b-file. They are parsed again when they have been fetched, as their digests then change.
 
 import os
-import sys
+import glob
 import logging
+import argparse
+import functools
 import sqlite3
 import concurrent.futures
 
-from oeis_entry    import parse_oeis_entry
-from timer         import start_timer
-from exit_scope    import close_when_done
-from setup_logging import setup_logging
+from oeis_entry          import parse_oeis_entry
+from value_list_encoding import encode_value_list, encode_keywords
+from content_compression import load_content_dictionaries, set_content_dictionaries, decode_content
+from xz_snapshot_reader  import open_database, strip_snapshot_extension
+from timer               import start_timer
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
 
 logger = logging.getLogger(__name__)
 
+# The number of entries that are parsed and committed together.
+BATCH_SIZE = 1000
+
+# In the sharded mode, the number of shards per worker process.
+SHARDS_PER_WORKER = 4
+
 def create_database_schema(dbconn):
     """Ensure that the 'oeis_entries' table is present in the database."""
 
@@ -22,7 +48,7 @@ def create_database_schema(dbconn):
              CREATE TABLE IF NOT EXISTS oeis_entries (
                  oeis_id               INTEGER  PRIMARY KEY NOT NULL, -- OEIS ID number.
                  identification        TEXT,
-                 value_list            TEXT     NOT NULL,
+                 value_list            BLOB     NOT NULL,             -- see 'value_list_encoding.py'.
                  name                  TEXT     NOT NULL,
                  comments              TEXT,
                  detailed_references   TEXT,
@@ -33,11 +59,13 @@ def create_database_schema(dbconn):
                  mathematica_programs  TEXT,
                  other_programs        TEXT,
                  cross_references      TEXT,
-                 keywords              TEXT     NOT NULL,
+                 keywords              INTEGER  NOT NULL,             -- bitmask; see 'value_list_encoding.py'.
+                 unexpected_keywords   TEXT,                          -- keywords not in the bitmask, comma-separated.
                  offset_a              INTEGER,
                  offset_b              INTEGER,
                  author                TEXT,
-                 extensions_and_errors TEXT
+                 extensions_and_errors TEXT,
+                 source                TEXT                           -- NULL if fetched from the server; 'dump' if ingested from dump files.
              );
              """
 
@@ -48,17 +76,94 @@ def create_database_schema(dbconn):
 
     dbconn.execute(schema)
 
+    # The source of each parsed entry, identified by the digests of its main content and b-file in the source database.
+
+    schema = """
+             CREATE TABLE IF NOT EXISTS parsed_sources (
+                 oeis_id               INTEGER  PRIMARY KEY NOT NULL, -- OEIS ID number.
+                 main_digest           BLOB,                          -- 'main_digest' of the source entry; NULL if unknown.
+                 bfile_digest          BLOB                           -- 'bfile_digest' of the source entry; NULL if unknown.
+             );
+             """
+
+    schema = "\n".join(line[13:] for line in schema.split("\n"))[1:-1]
+
+    dbconn.execute(schema)
+
+def source_digest_columns(dbconn_in):
+    """Return the columns to select for the digests of the source entries: NULL if the source database predates the digest columns."""
+
+    columns = [row[1] for row in dbconn_in.execute("PRAGMA table_info(oeis_entries);")]
+
+    if "main_digest" in columns and "bfile_digest" in columns:
+        return "main_digest, bfile_digest"
+
+    return "NULL, NULL"
+
+def source_origin_column(dbconn_in):
+    """Return the column to select for the origin of the source entries: NULL if the source database predates the 'source' column."""
+
+    columns = [row[1] for row in dbconn_in.execute("PRAGMA table_info(oeis_entries);")]
+
+    if "source" in columns:
+        return "source"
+
+    return "NULL"
+
+def find_changed_entries(dbconn_in, dbconn_out):
+    """Compare the source database with the parsed database, and return the lists of changed and removed OEIS IDs.
 
-def process_oeis_entry(oeis_entry):
+    An entry has changed if it was not parsed yet, or if the digests of its content differ from those it was parsed from.
+    Entries of which the source digests are unknown (in databases that predate the digest columns) are always parsed.
 
-    (oeis_id, main_content, bfile_content) = oeis_entry
+    Both tables are scanned in order of OEIS ID, and merged. The content columns of the source database are not read.
+    """
 
-    parsed_entry = parse_oeis_entry(oeis_id, main_content, bfile_content)
+    changed_entries = []
+    removed_entries = []
+
+    end = (float("inf"), None, None)
+
+    with close_when_done(dbconn_in.cursor()) as dbcursor_in, close_when_done(dbconn_out.cursor()) as dbcursor_out:
+
+        source_rows = iter(dbcursor_in.execute("SELECT oeis_id, {} FROM oeis_entries ORDER BY oeis_id;".format(source_digest_columns(dbconn_in))))
+        parsed_rows = iter(dbcursor_out.execute("SELECT oeis_id, main_digest, bfile_digest FROM parsed_sources ORDER BY oeis_id;"))
+
+        source = next(source_rows, end)
+        parsed = next(parsed_rows, end)
+
+        while source is not end or parsed is not end:
+            if source[0] < parsed[0]:
+                changed_entries.append(source[0])
+                source = next(source_rows, end)
+            elif source[0] > parsed[0]:
+                removed_entries.append(parsed[0])
+                parsed = next(parsed_rows, end)
+            else:
+                if source[1] is None or source[2] is None or source[1:] != parsed[1:]:
+                    changed_entries.append(source[0])
+                source = next(source_rows, end)
+                parsed = next(parsed_rows, end)
+
+    return (changed_entries, removed_entries)
+
+def process_oeis_entry(oeis_entry, trusted = False):
+
+    (oeis_id, main_content, bfile_content, source) = oeis_entry
+
+    # The content may be stored compressed; see 'content_compression.py'.
+
+    main_content  = decode_content(main_content)
+    bfile_content = decode_content(bfile_content)
+
+    parsed_entry = parse_oeis_entry(oeis_id, main_content, bfile_content, trusted, ingested = source is not None)
+
+    (keywords, unexpected_keywords) = encode_keywords(parsed_entry.keywords)
 
     result = (
         parsed_entry.oeis_id,
         parsed_entry.identification,
-        ",".join(str(value) for value in parsed_entry.values),
+        encode_value_list(parsed_entry.values),
         parsed_entry.name,
         parsed_entry.comments,
         parsed_entry.detailed_references,
@@ -69,74 +174,203 @@ def process_oeis_entry(oeis_entry):
         parsed_entry.mathematica_programs,
         parsed_entry.other_programs,
         parsed_entry.cross_references,
-        ",".join(str(keyword) for keyword in parsed_entry.keywords),
+        keywords,
+        unexpected_keywords,
         parsed_entry.offset_a,
         parsed_entry.offset_b,
         parsed_entry.author,
-        parsed_entry.extensions_and_errors
+        parsed_entry.extensions_and_errors,
+        source
     )
 
     return result
 
 
-def process_database_entries(database_filename_in):
+def parse_entry_batches(dbconn_in, dbconn_out, oeis_ids, trusted_flag, map_function = map, progress_flag = True):
+    """Parse the given entries of the source database into the output database, in batches of BATCH_SIZE entries.
+
+    The entries of a batch are parsed by 'map_function', which may distribute them over a process pool.
+    Returns the number of entries parsed; entries that are no longer present in the source database are skipped.
+    """
+
+    parsed_count = 0
+
+    digest_columns = source_digest_columns(dbconn_in)
+    origin_column  = source_origin_column(dbconn_in)
+
+    with close_when_done(dbconn_in.cursor()) as dbcursor_in, close_when_done(dbconn_out.cursor()) as dbcursor_out:
+
+        for batch_start in range(0, len(oeis_ids), BATCH_SIZE):
+
+            batch = oeis_ids[batch_start:batch_start + BATCH_SIZE]
+
+            query = "SELECT oeis_id, main_content, bfile_content, {}, {} FROM oeis_entries WHERE oeis_id IN ({}) ORDER BY oeis_id;".format(origin_column, digest_columns, ", ".join("?" * len(batch)))
+            dbcursor_in.execute(query, batch)
+            oeis_entries = dbcursor_in.fetchall()
+            if len(oeis_entries) == 0:
+                continue # The entries were removed from the source database in the meantime.
+
+            if progress_flag:
+                logger.log(logging.PROGRESS, "Processing OEIS entries A{:06} to A{:06} ...".format(oeis_entries[0][0], oeis_entries[-1][0]))
+
+            query = "INSERT OR REPLACE INTO oeis_entries(oeis_id, identification, value_list, name, comments, detailed_references, links, formulas, examples, maple_programs, mathematica_programs, other_programs, cross_references, keywords, unexpected_keywords, offset_a, offset_b, author, extensions_and_errors, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+
+            dbcursor_out.executemany(query, map_function(functools.partial(process_oeis_entry, trusted = trusted_flag), (oeis_entry[:4] for oeis_entry in oeis_entries)))
+
+            # The source digests are committed together with the parsed entries, so an interrupted run can be resumed.
+
+            query = "INSERT OR REPLACE INTO parsed_sources(oeis_id, main_digest, bfile_digest) VALUES (?, ?, ?);"
+
+            dbcursor_out.executemany(query, ((oeis_entry[0], oeis_entry[4], oeis_entry[5]) for oeis_entry in oeis_entries))
+
+            dbconn_out.commit()
+
+            parsed_count += len(oeis_entries)
+
+    return parsed_count
+
+def parse_shard(database_filename_in, shard_filename, oeis_ids, trusted_flag):
+    """Parse the given entries into a shard database. Runs in a worker process, in the sharded mode.
+
+    The worker reads the source database itself, so the entries do not pass through the parent process.
+    Returns (shard_filename, parsed_count).
+    """
+
+    if os.path.exists(shard_filename):
+        os.remove(shard_filename)
+
+    with close_when_done(open_database(database_filename_in, read_only = True)) as dbconn_in:
+        with close_when_done(sqlite3.connect(shard_filename)) as dbconn_out:
+
+            # A shard is merged into the output database and removed, so it need not survive a crash.
+
+            dbconn_out.execute("PRAGMA journal_mode = OFF;")
+            dbconn_out.execute("PRAGMA synchronous = OFF;")
+
+            create_database_schema(dbconn_out)
+
+            load_content_dictionaries(dbconn_in)
+
+            parsed_count = parse_entry_batches(dbconn_in, dbconn_out, oeis_ids, trusted_flag, progress_flag = False)
+
+    return (shard_filename, parsed_count)
+
+def merge_shard(dbconn_out, shard_filename):
+    """Copy the parsed entries and their sources from a shard database into the output database, and remove the shard."""
+
+    dbconn_out.execute("ATTACH DATABASE ? AS shard;", (shard_filename, ))
+
+    dbconn_out.execute("INSERT OR REPLACE INTO oeis_entries SELECT * FROM shard.oeis_entries;")
+    dbconn_out.execute("INSERT OR REPLACE INTO parsed_sources SELECT * FROM shard.parsed_sources;")
+
+    dbconn_out.commit()
+
+    dbconn_out.execute("DETACH DATABASE shard;")
+
+    os.remove(shard_filename)
+
+def process_database_entries(database_filename_in, full_flag = False, trusted_flag = False, sharded_flag = False, workers = None):
 
     if not os.path.exists(database_filename_in):
         logger.critical("Database file '{}' not found! Unable to continue.".format(database_filename_in))
         return
 
-    (root, ext) = os.path.splitext(database_filename_in)
+    # A compressed snapshot 'oeis_vYYYYMMDD.sqlite3.xz' is parsed to 'oeis_vYYYYMMDD_parsed.sqlite3'.
+
+    (root, ext) = os.path.splitext(strip_snapshot_extension(database_filename_in))
 
     database_filename_out = root + "_parsed" + ext
 
-    if os.path.exists(database_filename_out):
+    # A parsed database without source digests, with value lists stored as TEXT, or without the 'source' column,
+    # cannot be updated incrementally.
+
+    if os.path.exists(database_filename_out) and not full_flag:
+        with close_when_done(sqlite3.connect(database_filename_out)) as dbconn_out:
+            columns = [(row[1], row[2]) for row in dbconn_out.execute("PRAGMA table_info(oeis_entries);")]
+            full_flag = dbconn_out.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'parsed_sources';").fetchone() is None or \
+                        ("value_list", "TEXT") in columns or "source" not in (name for (name, column_type) in columns)
+
+    if os.path.exists(database_filename_out) and full_flag:
         logger.info("Removing stale file '{}' ...".format(database_filename_out))
         os.remove(database_filename_out)
 
-    # ========== fetch and process database entries, ordered by oeis_id.
+    # Shards that were left behind by an interrupted run are of no use.
+
+    for shard_filename in glob.glob(glob.escape(database_filename_out) + ".shard*"):
+        logger.info("Removing stale shard '{}' ...".format(shard_filename))
+        os.remove(shard_filename)
+
+    if workers is None:
+        workers = os.cpu_count()
 
-    BATCH_SIZE = 1000
+    # ========== fetch and process the changed database entries, ordered by oeis_id.
 
     with start_timer() as timer:
-        with close_when_done(sqlite3.connect(database_filename_in)) as dbconn_in, close_when_done(dbconn_in.cursor()) as dbcursor_in:
-            with close_when_done(sqlite3.connect(database_filename_out)) as dbconn_out, close_when_done(dbconn_out.cursor()) as dbcursor_out:
+        with close_when_done(open_database(database_filename_in)) as dbconn_in:
+            with close_when_done(sqlite3.connect(database_filename_out)) as dbconn_out:
 
                 create_database_schema(dbconn_out)
 
-                with concurrent.futures.ProcessPoolExecutor() as pool:
+                (changed_entries, removed_entries) = find_changed_entries(dbconn_in, dbconn_out)
 
-                    dbcursor_in.execute("SELECT oeis_id, main_content, bfile_content FROM oeis_entries ORDER BY oeis_id;")
+                logger.info("Entries to parse: {}; entries to remove: {}.".format(len(changed_entries), len(removed_entries)))
 
-                    while True:
+                dbconn_out.executemany("DELETE FROM oeis_entries WHERE oeis_id = ?;", ((oeis_id, ) for oeis_id in removed_entries))
+                dbconn_out.executemany("DELETE FROM parsed_sources WHERE oeis_id = ?;", ((oeis_id, ) for oeis_id in removed_entries))
 
-                        oeis_entries = dbcursor_in.fetchmany(BATCH_SIZE)
-                        if len(oeis_entries) == 0:
-                            break
+                dbconn_out.commit()
 
-                        logger.log(logging.PROGRESS, "Processing OEIS entries A{:06} to A{:06} ...".format(oeis_entries[0][0], oeis_entries[-1][0]))
+                if not sharded_flag:
 
-                        query = "INSERT INTO oeis_entries(oeis_id, identification, value_list, name, comments, detailed_references, links, formulas, examples, maple_programs, mathematica_programs, other_programs, cross_references, keywords, offset_a, offset_b, author, extensions_and_errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+                    # The entries are read here, and parsed by a process pool.
 
-                        dbcursor_out.executemany(query, pool.map(process_oeis_entry, oeis_entries))
+                    content_dictionaries = load_content_dictionaries(dbconn_in)
 
-                        dbconn_out.commit()
+                    with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = set_content_dictionaries, initargs = (content_dictionaries, )) as pool:
+                        parsed_count = parse_entry_batches(dbconn_in, dbconn_out, changed_entries, trusted_flag, pool.map)
 
-        logger.info("Processed all database entries in {}.".format(timer.duration_string()))
+                else:
+
+                    # Each worker process parses a range of the changed entries into its own shard, which is merged
+                    # here as soon as it is complete. There are several shards per worker, to balance the load.
+
+                    shard_count = min(len(changed_entries), workers * SHARDS_PER_WORKER)
+
+                    shards = [changed_entries[len(changed_entries) * k // shard_count:len(changed_entries) * (k + 1) // shard_count] for k in range(shard_count)]
+
+                    parsed_count = 0
+
+                    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+
+                        futures = [pool.submit(parse_shard, database_filename_in, "{}.shard{:03}".format(database_filename_out, k), shard, trusted_flag)
+                                   for (k, shard) in enumerate(shards)]
+
+                        for future in concurrent.futures.as_completed(futures):
+                            (shard_filename, shard_parsed_count) = future.result()
+                            merge_shard(dbconn_out, shard_filename)
+                            parsed_count += shard_parsed_count
+                            logger.log(logging.PROGRESS, "Merged shard '{}' ({} entries); {} of {} entries done.".format(shard_filename, shard_parsed_count, parsed_count, len(changed_entries)))
+
+        logger.info("Processed {} changed database entries in {}.".format(parsed_count, timer.duration_string()))
 
 
 def main():
 
-    if len(sys.argv) != 2:
-        print("Please specify the name of an OEIS database in Sqlite3 format.")
-        return
+    parser = argparse.ArgumentParser(description = "Parse the entries of a local sqlite3 OEIS database, or of a compressed database snapshot, into a '_parsed' database.")
+    parser.add_argument("--full", action = "store_true", help = "parse all entries again, rather than only those that were added or changed")
+    parser.add_argument("--trusted", action = "store_true", help = "skip the diagnostics that only re-check the format of the entries (P10, P17)")
+    parser.add_argument("--sharded", action = "store_true", help = "let each worker process read its own range of entries and write it to a shard, then merge the shards")
+    parser.add_argument("--workers", type = int, help = "number of worker processes (default: number of CPUs)")
+    parser.add_argument("database_filename", help = "sqlite3 database, or compressed database snapshot")
+    args = parser.parse_args()
 
-    database_filename_in = sys.argv[1]
+    database_filename_in = args.database_filename
 
-    (root, ext) = os.path.splitext(database_filename_in)
+    (root, ext) = os.path.splitext(strip_snapshot_extension(database_filename_in))
     logfile = root + "_parsed.log"
 
     with setup_logging(logfile):
-        process_database_entries(database_filename_in)
+        process_database_entries(database_filename_in, args.full, args.trusted, args.sharded, args.workers)
 
 
 if __name__ == "__main__":
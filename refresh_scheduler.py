@@ -0,0 +1,62 @@
+"""Estimate how likely it is that a local copy of an OEIS entry is stale, and schedule refreshes accordingly.
+
+Each entry is modeled as changing at random moments (a Poisson process) with its own change rate.
+For each entry, the crawler keeps two statistics:
+
+    change_count    the number of fetches that found changed content.
+    observed_time   the total time [seconds] covered by consecutive fetches, i.e., the time during which changes would have been noticed.
+
+The change rate is estimated as (change_count + PRIOR_CHANGES) / (observed_time + PRIOR_TIME).
+The prior keeps the estimate sensible for entries that have rarely been observed: without evidence, we assume an entry
+changes about once a year.
+
+The probability that an entry with change rate 'rate' has changed in the 'age' seconds since it was last fetched is
+1 - exp(-rate * age). Given a refresh budget, the entries with the highest staleness probability are refreshed first.
+
+To find those entries quickly, the refresh queue stores, for each entry, the moment at which its staleness probability
+reaches STALENESS_THRESHOLD. See 'next_due_time'.
+"""
+
+import math
+
+PRIOR_CHANGES = 1.0                  # [changes]
+PRIOR_TIME    = 365.25 * 86400.0     # [seconds]
+
+STALENESS_THRESHOLD = 0.01
+
+REQUESTS_PER_REFRESH = 2 # main content and b-file.
+
+def estimate_change_rate(change_count, observed_time):
+    """Estimate the change rate of an entry, in changes per second."""
+    return (change_count + PRIOR_CHANGES) / (observed_time + PRIOR_TIME)
+
+def staleness_probability(change_rate, age):
+    """The probability that an entry with the given change rate has changed in the last 'age' seconds."""
+    return -math.expm1(-change_rate * max(age, 0.0))
+
+def staleness_horizon():
+    """The product (change rate * age) at which the staleness probability reaches STALENESS_THRESHOLD."""
+    return -math.log1p(-STALENESS_THRESHOLD)
+
+def next_due_time(last_fetch_time, change_count, observed_time):
+    """The moment at which the staleness probability of an entry reaches STALENESS_THRESHOLD."""
+    return last_fetch_time + staleness_horizon() / estimate_change_rate(change_count, observed_time)
+
+def refresh_count_for_budget(requests_per_hour, elapsed_time):
+    """The number of entries that can be refreshed in 'elapsed_time' seconds with the given request budget."""
+    return int(requests_per_hour * elapsed_time / 3600.0 / REQUESTS_PER_REFRESH)
+
+def select_stalest_entries(candidates, howmany, t_current):
+    """Select the 'howmany' entries that are most likely to be stale at time 't_current'.
+
+    The 'candidates' are (oeis_id, last_fetch_time, change_count, observed_time) tuples.
+    Returns a list of OEIS IDs, stalest first.
+    """
+
+    def staleness(candidate):
+        (oeis_id, last_fetch_time, change_count, observed_time) = candidate
+        return staleness_probability(estimate_change_rate(change_count, observed_time), t_current - last_fetch_time)
+
+    candidates = sorted(candidates, key = staleness, reverse = True)
+
+    return [oeis_id for (oeis_id, last_fetch_time, change_count, observed_time) in candidates[:howmany]]
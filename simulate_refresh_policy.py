@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+"""Score refresh policies by replaying the fetch history recorded in a local sqlite3 OEIS database.
+
+The 'fetch_log' table written by 'fetch_oeis_database.py' tells us, for each fetch, whether the content had changed since
+the previous fetch of the same entry. From this, a ground truth is reconstructed: each detected change is placed at a
+random moment between the two fetches that bracket it. (Changes that were never detected are missing from the ground
+truth, so all scores are somewhat optimistic.)
+
+Each policy is then simulated over the time span of the log. At every time step, it may refresh a number of entries
+determined by the request budget. A policy only knows what it has observed itself: when it last fetched each entry, and
+whether the content had changed at that time.
+
+The score of a policy is the time-averaged fraction of entries for which the local copy is fresh (i.e., identical to the
+remote content).
+"""
+
+import os
+import logging
+import sqlite3
+import argparse
+import numpy as np
+
+from refresh_scheduler import PRIOR_CHANGES, PRIOR_TIME, REQUESTS_PER_REFRESH
+from exit_scope        import close_when_done
+from setup_logging     import setup_logging
+
+logger = logging.getLogger(__name__)
+
+STATUS_UPDATED = 2 # see 'process_responses' in 'fetch_oeis_database.py'.
+
+def read_fetch_log(database_filename):
+    """Read the fetch log, sorted by OEIS ID and timestamp."""
+
+    with close_when_done(sqlite3.connect(database_filename)) as dbconn, close_when_done(dbconn.cursor()) as dbcursor:
+        dbcursor.execute("SELECT oeis_id, timestamp, status FROM fetch_log ORDER BY oeis_id, timestamp;")
+        data = dbcursor.fetchall()
+
+    data_dtype = np.dtype([
+            ("oeis_id"  , np.int64),
+            ("timestamp", np.float64),
+            ("status"   , np.int64)
+        ]
+    )
+
+    return np.array(data, dtype = data_dtype)
+
+def reconstruct_changes(fetch_log, rng):
+    """Reconstruct the moments at which entries changed, from the fetch log.
+
+    Returns the array of distinct OEIS IDs, and two arrays (entry index, change time) with one element per change,
+    sorted by change time.
+    """
+
+    (oeis_ids, entry_index) = np.unique(fetch_log["oeis_id"], return_inverse = True)
+
+    timestamp = fetch_log["timestamp"]
+
+    # A change is detected by a fetch that has a preceding fetch of the same entry.
+
+    detected = (fetch_log["status"][1:] == STATUS_UPDATED) & (entry_index[1:] == entry_index[:-1])
+
+    t_before = timestamp[:-1][detected]
+    t_after  = timestamp[1:][detected]
+
+    change_entry = entry_index[1:][detected]
+    change_time  = t_before + rng.random(len(t_before)) * (t_after - t_before)
+
+    order = np.argsort(change_time, kind = "stable")
+
+    return (oeis_ids, change_entry[order], change_time[order])
+
+class PolicyState:
+    """What a policy has observed about the entries."""
+
+    def __init__(self, n, t_start):
+        self.t1              = np.full(n, t_start) # first fetch in the current state.
+        self.t2              = np.full(n, t_start) # most recent fetch.
+        self.change_count    = np.zeros(n)
+        self.observed_time   = np.zeros(n)
+        self.fetched_version = np.zeros(n, dtype = np.int64)
+
+    def refresh(self, index, t_current, true_version):
+
+        changed = (self.fetched_version[index] != true_version[index])
+
+        self.change_count [index] += changed
+        self.observed_time[index] += t_current - self.t2[index]
+
+        self.t1[index[changed]] = t_current
+        self.t2[index]          = t_current
+
+        self.fetched_version[index] = true_version[index]
+
+def score_random(state, t_current, rng):
+    return rng.random(len(state.t2))
+
+def score_age(state, t_current, rng):
+    return t_current - state.t2
+
+def score_priority(state, t_current, rng):
+    """The priority used by 'fetch_oeis_database.py' before change statistics were introduced: age divided by stability."""
+    return (t_current - state.t2) / np.maximum(state.t2 - state.t1, 1e-6)
+
+def score_change_rate(state, t_current, rng):
+    """The staleness probability, as used by 'refresh_scheduler.py'."""
+    change_rate = (state.change_count + PRIOR_CHANGES) / (state.observed_time + PRIOR_TIME)
+    return -np.expm1(-change_rate * (t_current - state.t2))
+
+POLICIES = {
+    "random"      : score_random,
+    "age"         : score_age,
+    "priority"    : score_priority,
+    "change_rate" : score_change_rate
+}
+
+def simulate_policy(policy, oeis_ids, change_entry, change_time, t_start, t_end, time_step, requests_per_hour, seed):
+    """Simulate a refresh policy and return the time-averaged fraction of fresh entries."""
+
+    rng = np.random.default_rng(seed)
+
+    n = len(oeis_ids)
+
+    refreshes_per_step = min(n, int(round(requests_per_hour * time_step / 3600.0 / REQUESTS_PER_REFRESH)))
+
+    # All entries are assumed to be fetched at the start of the simulation.
+
+    state = PolicyState(n, t_start)
+
+    true_version = np.zeros(n, dtype = np.int64)
+
+    change_index = 0
+    fresh_fractions = []
+
+    for t_current in np.arange(t_start + time_step, t_end + time_step, time_step):
+
+        # Apply the changes that happened during this step.
+
+        next_change_index = np.searchsorted(change_time, t_current, side = "right")
+        np.add.at(true_version, change_entry[change_index:next_change_index], 1)
+        change_index = next_change_index
+
+        fresh_fractions.append(np.mean(state.fetched_version == true_version))
+
+        # Refresh the entries with the highest scores.
+
+        if refreshes_per_step > 0:
+            score = POLICIES[policy](state, t_current, rng)
+            index = np.argpartition(-score, refreshes_per_step - 1)[:refreshes_per_step]
+            state.refresh(index, t_current, true_version)
+
+    return np.mean(fresh_fractions)
+
+def simulate_refresh_policies(database_filename, policies, requests_per_hour, time_step, seed):
+
+    if not os.path.exists(database_filename):
+        logger.critical("Database file '{}' not found! Unable to continue.".format(database_filename))
+        return
+
+    fetch_log = read_fetch_log(database_filename)
+
+    if len(fetch_log) == 0:
+        logger.critical("The fetch log of database '{}' is empty! Unable to continue.".format(database_filename))
+        return
+
+    rng = np.random.default_rng(seed)
+
+    (oeis_ids, change_entry, change_time) = reconstruct_changes(fetch_log, rng)
+
+    t_start = np.min(fetch_log["timestamp"])
+    t_end   = np.max(fetch_log["timestamp"])
+
+    logger.info("Replaying {} fetches of {} entries with {} detected changes over {:.1f} hours, at {} requests/hour ...".format(
+        len(fetch_log), len(oeis_ids), len(change_time), (t_end - t_start) / 3600.0, requests_per_hour))
+
+    for policy in policies:
+        fresh_fraction = simulate_policy(policy, oeis_ids, change_entry, change_time, t_start, t_end, time_step, requests_per_hour, seed)
+        logger.info("Policy '{}': fresh entries {:.3f} % of the time.".format(policy, 100.0 * fresh_fraction))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Score refresh policies by replaying the fetch log of a local sqlite3 OEIS database.")
+    parser.add_argument("--budget"  , type = int  , default = 7200  , help = "refresh budget in requests per hour (default: 7200)")
+    parser.add_argument("--step"    , type = float, default = 3600.0, help = "simulation time step in seconds (default: 3600)")
+    parser.add_argument("--seed"    , type = int  , default = 0     , help = "random seed (default: 0)")
+    parser.add_argument("--policies", nargs = "+" , default = sorted(POLICIES), metavar = "policy", help = "policies to score: {} (default: all)".format(", ".join(sorted(POLICIES))))
+    parser.add_argument("database_filename", nargs = "?", default = "oeis.sqlite3", help = "sqlite3 database (default: oeis.sqlite3)")
+    args = parser.parse_args()
+
+    for policy in args.policies:
+        if policy not in POLICIES:
+            parser.error("unknown policy '{}'".format(policy))
+
+    with setup_logging(None):
+        simulate_refresh_policies(args.database_filename, args.policies, args.budget, args.step, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -16,9 +16,10 @@ from catalog import read_catalog_files
 from timer import start_timer
 import concurrent.futures
 
-from oeis_entry    import parse_oeis_entry
-from exit_scope    import close_when_done
-from setup_logging import setup_logging
+from oeis_entry          import parse_oeis_entry
+from content_compression import load_content_dictionaries, set_content_dictionaries, decode_content
+from exit_scope          import close_when_done
+from setup_logging       import setup_logging
 
 logger = logging.getLogger(__name__)
 
@@ -236,6 +237,9 @@ def process_oeis_entry(work):
 
     (oeis_id, main_content, bfile_content, terms) = work
 
+    main_content  = decode_content(main_content)
+    bfile_content = decode_content(bfile_content)
+
     parsed_entry = parse_oeis_entry(oeis_id, main_content, bfile_content)
 
     if parsed_entry.offset_a is None:
@@ -280,7 +284,9 @@ def solve_linear_recurrences(database_filename_in, terms, exclude_entries = None
 
         with close_when_done(sqlite3.connect(database_filename_in)) as dbconn_in, close_when_done(dbconn_in.cursor()) as dbcursor_in:
 
-            with concurrent.futures.ProcessPoolExecutor() as pool:
+            content_dictionaries = load_content_dictionaries(dbconn_in)
+
+            with concurrent.futures.ProcessPoolExecutor(initializer = set_content_dictionaries, initargs = (content_dictionaries, )) as pool:
 
                 dbcursor_in.execute("SELECT oeis_id, main_content, bfile_content FROM oeis_entries ORDER BY oeis_id;")
 
@@ -53,7 +53,7 @@ class TimerContextManager:
 
         tempo = work_completed / (t_current - self.t_enter)
 
-        etc = np.nan if tempo == 0.0 else work_remaining / tempo
+        etc = math.nan if tempo == 0.0 else work_remaining / tempo
 
         return etc
 
@@ -61,6 +61,9 @@ class TimerContextManager:
 
         etc = self.etc(work_completed, work_remaining)
 
+        if math.isnan(etc):
+            return "unknown (no work completed yet)"
+
         return duration_as_string(etc)
 
 def start_timer(total_work = None):
@@ -0,0 +1,131 @@
+"""Binary encodings of the value list and the keywords of parsed entries, as stored in the parsed database.
+
+The 'value_list' column of the parsed database ('parse_oeis_database.py') holds a BLOB in the following format:
+
+    width (1 byte) | payload
+
+The widths are:
+
+    1, 2, 4, 8     the payload is the list of differences between consecutive values (the first value is taken as
+                   the difference from zero), as signed little-endian integers of 'width' bytes each.
+    WIDTH_VARINT   the payload is the list of differences between consecutive values, as zigzag-encoded varints.
+
+The width is the smallest one that holds all values and differences. Value lists with values or differences that do
+not fit in 64 bits use WIDTH_VARINT, which holds integers of any size. A fixed width is preferred whenever possible, because
+a fixed-width payload is decoded in bulk, whereas varints are decoded one by one.
+
+The 'keywords' column holds a bitmask of the expected keywords, with bit i set for keyword_bits[i]. Keywords that
+are not in keyword_bits are stored as comma-separated TEXT in the 'unexpected_keywords' column, or NULL if there are
+none. Decoding yields the expected keywords in the order of keyword_bits, followed by the unexpected keywords.
+"""
+
+import sys
+import array
+import itertools
+
+from content_compression import encode_varint, decode_varint, zigzag, unzigzag
+
+WIDTH_VARINT = 0
+
+# The array type codes of the signed integer types, by width in bytes.
+
+typecodes = dict((array.array(typecode).itemsize, typecode) for typecode in "qlihb")
+
+# The keyword of each bit of the keyword bitmask. New keywords must be appended, so that stored bitmasks remain valid.
+
+keyword_bits = (
+    "allocated", "allocating", "base", "bref", "changed", "cofr", "cons", "core", "dead", "dumb", "dupe", "easy",
+    "eigen", "fini", "frac", "full", "hard", "hear", "less", "look", "more", "mult", "new", "nice", "nonn", "obsc",
+    "probation", "recycled", "sign", "tabf", "tabl", "uned", "unkn", "walk", "word"
+)
+
+keyword_masks = dict((keyword, 1 << bit) for (bit, keyword) in enumerate(keyword_bits))
+
+def encode_value_list(values):
+    """Encode a list of integer values as a BLOB."""
+
+    differences = [value - previous_value for (value, previous_value) in zip(values, itertools.chain([0], values))]
+
+    low  = min(itertools.chain(values, differences), default = 0)
+    high = max(itertools.chain(values, differences), default = 0)
+
+    for width in (1, 2, 4, 8):
+        limit = 1 << (8 * width - 1)
+        if -limit <= low and high < limit:
+            payload = array.array(typecodes[width], differences)
+            if sys.byteorder != "little":
+                payload.byteswap()
+            return bytes([width]) + payload.tobytes()
+
+    out = bytearray([WIDTH_VARINT])
+    for difference in differences:
+        encode_varint(zigzag(difference), out)
+
+    return bytes(out)
+
+def iterate_value_list(blob):
+    """Yield the values of an encoded value list one by one. For a fixed width, the differences are decoded in bulk."""
+
+    width = blob[0]
+
+    if width == WIDTH_VARINT:
+        value = 0
+        position = 1
+        while position < len(blob):
+            (difference, position) = decode_varint(blob, position)
+            value += unzigzag(difference)
+            yield value
+        return
+
+    differences = array.array(typecodes[width])
+    differences.frombytes(blob[1:])
+    if sys.byteorder != "little":
+        differences.byteswap()
+
+    yield from itertools.accumulate(differences)
+
+def decode_value_list(blob):
+    """Decode a value list into a list of integers."""
+    return list(iterate_value_list(blob))
+
+def decode_value_list_as_numpy(blob):
+    """Decode a value list into a NumPy array of 64-bit integers, or of Python integers if the values do not fit.
+
+    NumPy is only imported when this function is called.
+    """
+
+    import numpy
+
+    width = blob[0]
+
+    if width == WIDTH_VARINT:
+        return numpy.array(decode_value_list(blob), dtype = object)
+
+    if len(blob) == 1:
+        return numpy.zeros(0, dtype = numpy.int64)
+
+    return numpy.cumsum(numpy.frombuffer(blob, dtype = "<i{}".format(width), offset = 1), dtype = numpy.int64)
+
+def encode_keywords(keywords):
+    """Encode a list of keywords as (bitmask, unexpected_keywords); the latter is None if all keywords are expected."""
+
+    bitmask = 0
+    unexpected_keywords = []
+
+    for keyword in keywords:
+        if keyword in keyword_masks:
+            bitmask |= keyword_masks[keyword]
+        else:
+            unexpected_keywords.append(keyword)
+
+    return (bitmask, ",".join(unexpected_keywords) if len(unexpected_keywords) > 0 else None)
+
+def decode_keywords(bitmask, unexpected_keywords):
+    """Decode a keyword bitmask and the unexpected keywords into a list of keywords."""
+
+    keywords = [keyword for (bit, keyword) in enumerate(keyword_bits) if bitmask & (1 << bit)]
+
+    if unexpected_keywords is not None:
+        keywords.extend(unexpected_keywords.split(","))
+
+    return keywords
@@ -0,0 +1,283 @@
+#! /usr/bin/env python3
+
+"""Random-access, read-only use of compressed database snapshots ('oeis_vYYYYMMDD.sqlite3.xz').
+
+The snapshots written by 'fetch_oeis_database.py' are multi-block xz files (see 'parallel_xz.py').
+The block index at the end of the file tells us where each block starts, in both the compressed and uncompressed data,
+so any byte range of the database file can be read by decompressing only the blocks that contain it.
+
+The layers are:
+
+    XzRandomAccessFile   a read-only file-like view of the uncompressed data, with a bounded LRU cache of decompressed blocks.
+    XzSnapshotVFS        an SQLite VFS that serves database pages from an XzRandomAccessFile. It requires the 'apsw' module,
+                         since the standard 'sqlite3' module cannot register a VFS.
+    SnapshotConnection   a read-only connection with the subset of the 'sqlite3.Connection' interface that our scripts use.
+
+Use 'open_database' to open either a plain database file or a snapshot.
+
+Snapshots made before the database was consolidated in multiple blocks consist of a single block, which is decompressed
+in its entirety on first access. Snapshots of a database in WAL mode are opened as immutable, so no WAL file is needed.
+
+This script can also be used to run ad-hoc queries on a snapshot:
+
+    xz_snapshot_reader.py oeis_vYYYYMMDD.sqlite3.xz "SELECT oeis_id, t2 FROM oeis_entries WHERE oeis_id = 45;"
+"""
+
+import os
+import sys
+import bisect
+import logging
+import sqlite3
+import itertools
+import threading
+import collections
+import urllib.parse
+
+from parallel_xz   import read_xz_block_index, read_xz_stream_check, decompress_xz_block
+from exit_scope    import close_when_done
+from setup_logging import setup_logging
+
+try:
+    import apsw
+except ImportError:
+    apsw = None
+
+logger = logging.getLogger(__name__)
+
+VFS_NAME = "xzsnapshot"
+
+DEFAULT_CACHE_BLOCKS = 8
+
+class XzRandomAccessFile:
+    """A read-only, random-access view of the uncompressed content of a multi-block xz file. Thread-safe."""
+
+    def __init__(self, filename, cache_blocks = DEFAULT_CACHE_BLOCKS):
+
+        self._f = open(filename, "rb")
+
+        self.blocks = read_xz_block_index(self._f)
+        self.check  = read_xz_stream_check(self._f)
+
+        self.size = sum(block.uncompressed_size for block in self.blocks)
+
+        self._block_offsets = [block.uncompressed_offset for block in self.blocks]
+
+        self.cache_blocks = max(1, cache_blocks)
+        self._cache = collections.OrderedDict() # block number -> decompressed data, least recently used first.
+        self._lock  = threading.Lock()
+
+        self.block_decompressions = 0
+
+    def _block_data(self, block_number):
+        """Return the decompressed data of a block, from the cache if possible. Called with the lock held."""
+
+        data = self._cache.get(block_number)
+
+        if data is not None:
+            self._cache.move_to_end(block_number)
+            return data
+
+        data = decompress_xz_block(self._f, self.blocks[block_number], self.check)
+        self.block_decompressions += 1
+
+        self._cache[block_number] = data
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last = False)
+
+        return data
+
+    def read(self, offset, size):
+        """Read up to 'size' bytes at 'offset'. Fewer bytes are returned at the end of the data."""
+
+        size = max(0, min(size, self.size - offset))
+
+        parts = []
+
+        with self._lock:
+
+            block_number = bisect.bisect_right(self._block_offsets, offset) - 1
+
+            while size > 0:
+                block = self.blocks[block_number]
+                data = self._block_data(block_number)
+                start = offset - block.uncompressed_offset
+                part = data[start:start + size]
+                parts.append(part)
+                offset += len(part)
+                size   -= len(part)
+                block_number += 1
+
+        return b"".join(parts)
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self._f.close()
+
+if apsw is not None:
+
+    class XzSnapshotVFSFile:
+        """A read-only SQLite database file, served from an XzRandomAccessFile."""
+
+        def __init__(self, filename, cache_blocks):
+            self._file = XzRandomAccessFile(filename, cache_blocks)
+
+        def xRead(self, amount, offset):
+            return self._file.read(offset, amount)
+
+        def xFileSize(self):
+            return self._file.size
+
+        def xWrite(self, data, offset):
+            raise apsw.ReadOnlyError("Database snapshots are read-only.")
+
+        def xTruncate(self, newsize):
+            raise apsw.ReadOnlyError("Database snapshots are read-only.")
+
+        def xSync(self, flags):
+            pass
+
+        def xLock(self, level):
+            pass
+
+        def xUnlock(self, level):
+            pass
+
+        def xCheckReservedLock(self):
+            return False
+
+        def xFileControl(self, op, ptr):
+            return False
+
+        def xSectorSize(self):
+            return 4096
+
+        def xDeviceCharacteristics(self):
+            return 0
+
+        def xClose(self):
+            self._file.close()
+
+    class XzSnapshotVFS(apsw.VFS):
+        """An SQLite VFS that opens '.xz' database files as read-only snapshots. Other files are handled by the default VFS.
+
+        The number of decompressed blocks to cache can be given in the 'cache_blocks' URI parameter.
+        """
+
+        def __init__(self):
+            super().__init__(VFS_NAME, "")
+
+        def xOpen(self, name, flags):
+
+            filename = name.filename() if isinstance(name, apsw.URIFilename) else name
+
+            if filename is None or not filename.endswith(".xz"):
+                return super().xOpen(name, flags)
+
+            cache_blocks = name.uri_int("cache_blocks", DEFAULT_CACHE_BLOCKS) if isinstance(name, apsw.URIFilename) else DEFAULT_CACHE_BLOCKS
+
+            return XzSnapshotVFSFile(filename, cache_blocks)
+
+        def xAccess(self, pathname, flags):
+            if pathname.endswith(".xz"):
+                return os.path.exists(pathname) and flags != apsw.mapping_access["SQLITE_ACCESS_READWRITE"]
+            return super().xAccess(pathname, flags)
+
+snapshot_vfs = None # The XzSnapshotVFS instance, registered on first use.
+
+class SnapshotCursor:
+    """A cursor on a SnapshotConnection, with the subset of the 'sqlite3.Cursor' interface that our scripts use."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._rows   = iter(())
+
+    def execute(self, query, parameters = ()):
+        self._rows = iter(self._cursor.execute(query, parameters))
+        return self
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size = 1):
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        self._cursor.close()
+
+class SnapshotConnection:
+    """A read-only connection to a compressed database snapshot, with the subset of the 'sqlite3.Connection' interface that our scripts use."""
+
+    def __init__(self, filename, cache_blocks = DEFAULT_CACHE_BLOCKS):
+
+        global snapshot_vfs
+
+        if apsw is None:
+            raise RuntimeError("Opening compressed database snapshots requires the 'apsw' module.")
+
+        if snapshot_vfs is None:
+            snapshot_vfs = XzSnapshotVFS()
+
+        uri = "file:{}?immutable=1&cache_blocks={}".format(urllib.parse.quote(os.path.abspath(filename)), cache_blocks)
+
+        self._connection = apsw.Connection(uri, flags = apsw.SQLITE_OPEN_READONLY | apsw.SQLITE_OPEN_URI, vfs = VFS_NAME)
+
+    def cursor(self):
+        return SnapshotCursor(self._connection.cursor())
+
+    def execute(self, query, parameters = ()):
+        return self.cursor().execute(query, parameters)
+
+    def commit(self):
+        pass # read-only.
+
+    def close(self):
+        self._connection.close()
+
+def is_snapshot_filename(filename):
+    return filename.endswith(".xz")
+
+def strip_snapshot_extension(filename):
+    """Return the filename of the database inside a snapshot, e.g. 'oeis_v20250101.sqlite3' for 'oeis_v20250101.sqlite3.xz'."""
+    return filename[:-len(".xz")] if is_snapshot_filename(filename) else filename
+
+def open_database(filename, cache_blocks = DEFAULT_CACHE_BLOCKS, read_only = False):
+    """Open a database for reading. Compressed snapshots ('.xz' files) are opened as a SnapshotConnection.
+
+    A plain database file is opened read-only if 'read_only' is set. Snapshots are always read-only.
+    """
+
+    if is_snapshot_filename(filename):
+        return SnapshotConnection(filename, cache_blocks)
+
+    if read_only:
+        return sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(filename))), uri = True)
+
+    return sqlite3.connect(filename)
+
+def main():
+
+    if len(sys.argv) != 3:
+        print("Please specify the name of a compressed OEIS database snapshot, and an SQL query.")
+        return
+
+    (snapshot_filename, query) = sys.argv[1:]
+
+    with setup_logging(None):
+
+        if not os.path.exists(snapshot_filename):
+            logger.critical("Snapshot file '{}' not found! Unable to continue.".format(snapshot_filename))
+            return
+
+        with close_when_done(open_database(snapshot_filename)) as dbconn, close_when_done(dbconn.cursor()) as dbcursor:
+            for row in dbcursor.execute(query):
+                print("|".join(str(value) for value in row))
+
+if __name__ == "__main__":
+    main()